@@ -1,4 +1,6 @@
 import cherrypy
+from bson.errors import InvalidId
+from bson.objectid import ObjectId
 
 from girder import plugin
 from girder.api.describe import Description, autoDescribeRoute
@@ -9,6 +11,7 @@ from girder.api.rest import (
     setContentDisposition,
 )
 from girder.constants import AccessType, TokenScope
+from girder.exceptions import RestException
 
 from girder.models.file import File
 from girder.models.item import Item
@@ -18,30 +21,25 @@ from girder.models.folder import Folder
 # server settings (from girder.cfg file probably) for proxiable endpoint below
 from girder.utility import config
 
-from .dicom import setupEventHandlers
+from . import loadable, manifest_cache, parse_cache, volumes
+from .bundle import StoredZip, seriesFiles
+from .admin import VolViewAdminResource
+from .ingest import setupEventHandlers
+from .series import DicomSeries
 from .backend import addBackendRoutes
 from .backend.launch import (
     downloadManifest,
     downloadResourceManifest,
+    downloadResourceManifestPage,
     getFolderConfigFile,
     saveToItem,
     saveToFolder,
 )
-from .utils import isLoadableImage, isSessionFile
+from .loadable import isLoadableFolder, isLoadableItem, loadableIds
+from .utils import ensureDicomFilterIndexesInBackground, idStringToIdList
 
-
-def hasLoadableFile(files, user=None):
-    # Mirror what the launch manifest would actually resolve: a session file
-    # opens through (restore), and anything else must be a loadable image that
-    # is not working data (job outputs, transient staged inputs) — otherwise
-    # the Open-in-VolView button would launch an empty viewer.
-    itemCache = {}
-    folderCache = {}
-    for fileEntry in files:
-        file = fileEntry[1] if isinstance(fileEntry, tuple) else fileEntry
-        if isSessionFile(file) or isLoadableImage(file, user, itemCache, folderCache):
-            return True
-    return False
+# Ids one volview/loadable request may ask about.
+MAX_LOADABLE_BATCH = 1000
 
 
 @access.public(cookie=True, scope=TokenScope.DATA_READ)
@@ -56,9 +54,7 @@ def hasLoadableFile(files, user=None):
     .errorResponse("Read access was denied for the folder.", 403)
 )
 def volViewLoadableItem(self, item):
-    files = Item().fileList(item, subpath=False, data=False)
-    loadable = hasLoadableFile(files, user=self.getCurrentUser())
-    return {"loadable": loadable}
+    return {"loadable": isLoadableItem(item)}
 
 
 @access.public(cookie=True, scope=TokenScope.DATA_READ)
@@ -73,76 +69,102 @@ def volViewLoadableItem(self, item):
     .errorResponse("Read access was denied for the folder.", 403)
 )
 def volViewLoadableFolder(self, folder):
-    # The aggregation below replaces:
-    #   files = Folder().fileList(
-    #       folder, user=self.getCurrentUser(), subpath=False, data=False
-    #   )
-    # excepting that it just returns a cursor that yields files, not an
-    # iterator that yields a tuple of (path, file).  The aggregation is much
-    # faster, as it only takes one database roundtrip, rather than one per
-    # folder and one per item.
-    files = Folder().collection.aggregate(
-        [
-            {"$match": {"_id": folder["_id"]}},
-            {
-                "$graphLookup": {
-                    "from": "folder",
-                    "startWith": folder["_id"],
-                    "connectFromField": "_id",
-                    "connectToField": "parentId",
-                    "as": "__children",
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "folder",
-                    "localField": "_id",
-                    "foreignField": "_id",
-                    "as": "__self",
-                }
-            },
-            {
-                "$project": {
-                    "__children": {
-                        "$concatArrays": [
-                            "$__self",
-                            "$__children",
-                        ]
-                    }
-                }
-            },
-            {"$unwind": {"path": "$__children"}},
-            {"$replaceRoot": {"newRoot": "$__children"}},
-            {
-                "$match": Folder().permissionClauses(
-                    self.getCurrentUser(), level=AccessType.READ
-                )
-            },
-            {
-                "$lookup": {
-                    "from": "item",
-                    "let": {"fid": "$_id"},
-                    "pipeline": [
-                        {"$match": {"$expr": {"$eq": ["$$fid", "$folderId"]}}},
-                        {"$project": {"_id": 1}},
-                    ],
-                    "as": "__items",
-                }
-            },
-            {
-                "$lookup": {
-                    "from": "file",
-                    "localField": "__items._id",
-                    "foreignField": "itemId",
-                    "as": "__files",
-                }
-            },
-            {"$unwind": "$__files"},
-            {"$replaceRoot": {"newRoot": "$__files"}},
-        ]
+    # From the folder's maintained count (see ``loadable``), else inside Mongo:
+    # the subtree walk stops at the first file that would open.
+    return {"loadable": isLoadableFolder(folder, self.getCurrentUser())}
+
+
+def _objectIds(idString):
+    try:
+        return [ObjectId(id) for id in idStringToIdList(idString or "")]
+    except InvalidId:
+        raise RestException("Invalid id list") from None
+
+
+@access.public(cookie=True, scope=TokenScope.DATA_READ)
+@boundHandler
+@autoDescribeRoute(
+    Description("Check many folders and items for files VolView can load.")
+    .notes(
+        "Answers for every id in one request: {folders: {id: loadable}, items: "
+        "{id: loadable}}. Ids that do not exist or cannot be read answer false. "
+        "At most %d ids per request." % MAX_LOADABLE_BATCH
+    )
+    .param("folders", "Comma-separated folder IDs.", required=False)
+    .param("items", "Comma-separated item IDs.", required=False)
+    .produces(["application/json"])
+    .errorResponse("An id was invalid, or too many were given.")
+)
+def volViewLoadableBatch(self, folders, items):
+    folderIds = _objectIds(folders)
+    itemIds = _objectIds(items)
+    if len(folderIds) + len(itemIds) > MAX_LOADABLE_BATCH:
+        raise RestException("At most %d ids per request" % MAX_LOADABLE_BATCH)
+    loadableFolders, loadableItems = loadableIds(
+        folderIds, itemIds, self.getCurrentUser()
     )
-    loadable = hasLoadableFile(files, user=self.getCurrentUser())
-    return {"loadable": loadable}
+    return {
+        "folders": {str(id): id in loadableFolders for id in folderIds},
+        "items": {str(id): id in loadableItems for id in itemIds},
+    }
+
+
+@access.public(cookie=True, scope=TokenScope.DATA_READ)
+@boundHandler
+@autoDescribeRoute(
+    Description("List the DICOM series directly in a folder.")
+    .notes(
+        "One summary per SeriesInstanceUID, maintained as slices are tagged: "
+        "slice count, item ids in slice order, spacing, orientation, modality "
+        "and total bytes."
+    )
+    .modelParam("folderId", model=Folder, level=AccessType.READ)
+    .produces(["application/json"])
+    .errorResponse("ID was invalid.")
+    .errorResponse("Read access was denied for the folder.", 403)
+)
+def volViewDicomSeries(self, folder):
+    return list(DicomSeries().findForFolder(folder["_id"]))
+
+
+def _requestedRange(size):
+    """The ``(offset, endByte)`` of a request's first byte range, or the whole.
+
+    ``None`` once an unsatisfiable ``Range`` has been answered with a 416.
+    """
+    rangeRequest = cherrypy.request.headers.get("Range")
+    if not rangeRequest:
+        return 0, size
+    rangeHeader = cherrypy.lib.httputil.get_ranges(rangeRequest, size)
+    if not rangeHeader:
+        # cherrypy found something wrong with range request headers in get_ranges
+        cherrypy.response.status = 416
+        cherrypy.response.headers["Content-Range"] = f"bytes */{size}"
+        return None
+    # Only support the first range
+    return rangeHeader[0]
+
+
+def _rangeResponse(size, name, contentType):
+    """Status and headers for an attachment of ``size`` bytes, whole or by range.
+
+    Returns the ``(offset, endByte)`` to send, or ``None`` after a 416.
+    """
+    span = _requestedRange(size)
+    if span is None:
+        return None
+    offset, endByte = span
+    setResponseHeader("Content-Type", contentType)
+    setContentDisposition(name)
+    cherrypy.response.headers["Accept-Ranges"] = "bytes"
+    cherrypy.response.headers["Content-Length"] = str(endByte - offset)
+    if offset > 0 or endByte < size:
+        cherrypy.response.status = 206
+        # endByte is non-inclusive, so set Content-Range accordingly
+        cherrypy.response.headers["Content-Range"] = (
+            f"bytes {offset}-{endByte - 1}/{size}"
+        )
+    return span
 
 
 @access.public(scope=TokenScope.DATA_READ, cookie=True)
@@ -158,56 +180,88 @@ def downloadProxiableFile(self, file, name):
     proxyRequest = config.getConfig().get("volview", {}).get("proxy_assetstores", True)
 
     # below modified from girder.api.v1.file.download
-    rangeRequest = cherrypy.request.headers.get("Range")
-    if rangeRequest and file.get("size") is None:
+    if cherrypy.request.headers.get("Range") and file.get("size") is None:
         # Ensure the file size is updated
         File().updateSize(file)
 
-    rangeHeader = cherrypy.lib.httputil.get_ranges(rangeRequest, file.get("size", 0))
-
-    if rangeRequest:
-        if not rangeHeader:
-            # cherrypy found something wrong with range request headers in get_ranges
-            cherrypy.response.status = 416
-            cherrypy.response.headers["Content-Range"] = f"bytes */{file['size']}"
-            return ""
-        # Only support the first range
-        offset, endByte = rangeHeader[0]
-    else:
-        offset = 0
-        endByte = None
-
-    # to get s3_assetstore_adapter to proxy s3, we set headers to False, but that
-    # also suppresses Girder's default download headers. Set safe ones explicitly
-    # so a proxied file always downloads (attachment) with an inert content type
-    # and can never render inline in a browser. Transparent to the engine's fetch,
-    # which reads the response body regardless of these headers.
     if proxyRequest:
-        setResponseHeader("Content-Type", "application/octet-stream")
-        setContentDisposition(file["name"])
-
-    # to have a correct partial response, fill in headers and status code
-    if proxyRequest and (
-        offset > 0 or (endByte is not None and endByte < file["size"])
-    ):
-        cherrypy.response.status = 206
-        cherrypy.response.headers["Accept-Ranges"] = "bytes"
-        if endByte is None:
-            endByte = file["size"]
-        # endByte is non-inclusive, so set Content-Range accordingly
-        cherrypy.response.headers["Content-Range"] = (
-            f"bytes {offset}-{endByte - 1}/{file['size']}"
-        )
-        cherrypy.response.headers["Content-Length"] = str(endByte - offset)
-    elif proxyRequest:
-        cherrypy.response.headers["Accept-Ranges"] = "bytes"
-        cherrypy.response.headers["Content-Length"] = str(file["size"])
-
+        # to get s3_assetstore_adapter to proxy s3, we set headers to False, but
+        # that also suppresses Girder's default download headers. Set safe ones
+        # explicitly so a proxied file always downloads (attachment) with an
+        # inert content type and can never render inline in a browser.
+        # Transparent to the engine's fetch, which reads the response body
+        # regardless of these headers.
+        span = _rangeResponse(file["size"], file["name"], "application/octet-stream")
+    else:
+        span = _requestedRange(file.get("size", 0))
+    if span is None:
+        return ""
+    offset, endByte = span
     return File().download(
         file, offset=offset, endByte=endByte, headers=not proxyRequest
     )
 
 
+@access.public(scope=TokenScope.DATA_READ, cookie=True)
+@boundHandler
+@autoDescribeRoute(
+    Description("Download a DICOM series as one uncompressed zip.")
+    .notes(
+        "Bundles the files of the series' items directly in the folder, in "
+        "slice order, streamed from the assetstore. Supports a single byte "
+        "range. Limited to 65534 files and 4 GiB."
+    )
+    .modelParam("folderId", model=Folder, level=AccessType.READ)
+    .param("name", "The name of the archive. This is ignored.", paramType="path")
+    .param("series", "The SeriesInstanceUID to bundle.")
+    .errorResponse("ID was invalid.")
+    .errorResponse("Read access was denied for the folder.", 403)
+    .errorResponse("The folder holds no files of the series.", 404)
+)
+def downloadSeriesBundle(self, folder, name, series):
+    files = seriesFiles(folder["_id"], series)
+    if not files:
+        raise RestException("The folder holds no files of the series.", code=404)
+    archive = StoredZip(files)
+    span = _rangeResponse(archive.size, name, "application/zip")
+    if span is None:
+        return ""
+    return archive.stream(*span)
+
+
+@access.public(scope=TokenScope.DATA_READ, cookie=True)
+@boundHandler
+@autoDescribeRoute(
+    Description("Download a DICOM series converted to one NRRD volume.")
+    .notes(
+        "Available once volume conversion is enabled and the series has been "
+        "converted from its current slices. Supports a single byte range."
+    )
+    .modelParam("folderId", model=Folder, level=AccessType.READ)
+    .param("name", "The name of the volume. This is ignored.", paramType="path")
+    .param("series", "The SeriesInstanceUID of the volume.")
+    .param(
+        "preview",
+        "Download the volume's downsampled preview instead.",
+        dataType="boolean",
+        required=False,
+        default=False,
+    )
+    .errorResponse("ID was invalid.")
+    .errorResponse("Read access was denied for the folder.", 403)
+    .errorResponse("The series has no current volume.", 404)
+)
+def downloadSeriesVolume(self, folder, name, series, preview):
+    file = volumes.currentVolumeFile(folder["_id"], series, preview)
+    if file is None:
+        raise RestException("The series has no current volume.", code=404)
+    span = _rangeResponse(file["size"], name, "application/octet-stream")
+    if span is None:
+        return ""
+    offset, endByte = span
+    return File().download(file, offset=offset, endByte=endByte, headers=False)
+
+
 class GirderPlugin(plugin.GirderPlugin):
     DISPLAY_NAME = "VolView"
     CLIENT_SOURCE_PATH = "web_client"
@@ -215,6 +269,11 @@ class GirderPlugin(plugin.GirderPlugin):
     def load(self, info):
         plugin.getPlugin("large_image").load(info)
         setupEventHandlers()
+        manifest_cache.setupEventHandlers()
+        loadable.setupEventHandlers()
+        parse_cache.setupEventHandlers()
+        volumes.setupEventHandlers()
+        ensureDicomFilterIndexesInBackground()
 
         info["apiRoot"].item.route(
             "GET", (":itemId", "volview_loadable"), volViewLoadableItem
@@ -222,10 +281,16 @@ class GirderPlugin(plugin.GirderPlugin):
         info["apiRoot"].folder.route(
             "GET", (":folderId", "volview_loadable"), volViewLoadableFolder
         )
+        info["apiRoot"].folder.route(
+            "GET", (":folderId", "volview_dicom_series"), volViewDicomSeries
+        )
         info["apiRoot"].item.route("GET", (":itemId", "volview"), downloadManifest)
         info["apiRoot"].folder.route(
             "GET", (":folderId", "volview"), downloadResourceManifest
         )
+        info["apiRoot"].folder.route(
+            "GET", (":folderId", "volview_page"), downloadResourceManifestPage
+        )
         # Session-zip save: item-scoped stuffs the zip into the item,
         # folder-scoped creates a new session.volview.zip item. Each returns a
         # resumeUrl the client repoints its urls= at, so a later F5 reloads the
@@ -238,4 +303,12 @@ class GirderPlugin(plugin.GirderPlugin):
         info["apiRoot"].folder.route(
             "GET", (":folderId", "volview_config", ":name"), getFolderConfigFile
         )
+        info["apiRoot"].folder.route(
+            "GET", (":folderId", "volview_bundle", ":name"), downloadSeriesBundle
+        )
+        info["apiRoot"].folder.route(
+            "GET", (":folderId", "volview_volume", ":name"), downloadSeriesVolume
+        )
+        info["apiRoot"].volview = VolViewAdminResource()
+        info["apiRoot"].volview.route("GET", ("loadable",), volViewLoadableBatch)
         addBackendRoutes(info)
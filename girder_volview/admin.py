@@ -0,0 +1,101 @@
+"""Admin-only operational routes, mounted at ``/volview``.
+
+Read-mostly views onto the plugin's background machinery (the DICOM ingest
+queue, the launch manifest cache) so an operator can watch an import drain
+without shell access, plus the trigger for a DICOM metadata backfill. The
+plugin also mounts its public batch loadability check here
+(``GET volview/loadable``).
+"""
+
+from girder.api import access
+from girder.api.describe import Description, autoDescribeRoute
+from girder.api.rest import Resource, boundHandler
+from girder.exceptions import RestException
+from girder.utility.model_importer import ModelImporter
+from girder_jobs.models.job import Job
+
+from . import backfill, manifest_cache, parse_cache, parse_metrics, projection
+from .ingest import ingestQueue
+
+
+@access.admin
+@boundHandler
+@autoDescribeRoute(
+    Description("Get the DICOM tag-extraction queue depth and counters.")
+    .notes(
+        "queued is the backlog not yet picked up by a worker; overflowed counts "
+        "saves that found the queue full and were parsed inline instead. "
+        "parseCache counts content-keyed parse cache lookups; unchangedItems "
+        "are hits whose item already carried the cached tags, so nothing was "
+        "downloaded or written. projection reports the configured tag rules and "
+        "the average per-item meta.dicom size before and after them. "
+        "parseMetrics counts skipped files by reason and holds latency "
+        "histograms (milliseconds) for download, dcmread, coerce and write, "
+        "plus the bytes and ranged reads spent per parsed file."
+    )
+    .produces(["application/json"])
+    .errorResponse("Admin access was denied.", 403)
+)
+def getDicomIngestStatus(self):
+    status = ingestQueue().status()
+    status["parseCache"] = parse_cache.status()
+    status["projection"] = projection.status()
+    status["parseMetrics"] = parse_metrics.status()
+    return status
+
+
+@access.admin
+@boundHandler
+@autoDescribeRoute(
+    Description("Tag existing DICOM files under a folder or collection.")
+    .notes(
+        "Parses the files of every item under the resource that has no "
+        "meta.dicom yet, as a background job. Calling again for a resource with "
+        "an unfinished backfill resumes it from its last checkpoint."
+    )
+    .param(
+        "resourceType",
+        "The type of the resource to walk.",
+        enum=["folder", "collection"],
+    )
+    .param("id", "The ID of the resource to walk.")
+    .param(
+        "processes",
+        "Parse worker processes; 0 parses in the server process.",
+        dataType="integer",
+        required=False,
+    )
+    .errorResponse("Admin access was denied.", 403)
+)
+def startDicomBackfill(self, resourceType, id, processes):
+    if processes is not None and processes < 0:
+        raise RestException("processes must not be negative")
+    resource = ModelImporter.model(resourceType).load(id, force=True, exc=True)
+    job = backfill.startBackfill(
+        self.getCurrentUser(), resourceType, resource, processes=processes
+    )
+    return Job().filter(job, self.getCurrentUser())
+
+
+@access.admin
+@boundHandler
+@autoDescribeRoute(
+    Description("Get the launch manifest cache's size and hit rate.")
+    .notes(
+        "invalidated counts entries dropped because an item, file or folder "
+        "beneath them changed; expired counts entries that outlived the TTL."
+    )
+    .produces(["application/json"])
+    .errorResponse("Admin access was denied.", 403)
+)
+def getManifestCacheStatus(self):
+    return manifest_cache.manifestCache().status()
+
+
+class VolViewAdminResource(Resource):
+    def __init__(self):
+        super().__init__()
+        self.resourceName = "volview"
+        self.route("GET", ("dicom_ingest",), getDicomIngestStatus)
+        self.route("POST", ("dicom_backfill",), startDicomBackfill)
+        self.route("GET", ("manifest_cache",), getManifestCacheStatus)
@@ -8,8 +8,12 @@ subsequent reloads (F5); the save target itself stays launch-provided, so
 folder saves mint a new ``session.volview.zip`` item per save.
 """
 
+import base64
+import binascii
 import copy
 import errno
+import hashlib
+import json
 
 import cherrypy
 import yaml
@@ -27,11 +31,24 @@ from girder.models.item import Item
 from girder.models.setting import Setting
 from girder.models.upload import Upload
 from girder.utility import RequestBodyStream
+from girder.utility.config import getConfig
 from girder.utility.server import getApiRoot
 
 from .config import buildProcessingConfigBlock
+from ..bundle import bundledManifest
+from ..volumes import withVolumes
+from ..loadable import knownFolderCounts
+from ..manifest_cache import (
+    aclFingerprint,
+    cachedManifest,
+    manifestKey,
+    manifestVersion,
+)
 from ..utils import (
+    MANIFEST_FORMATS,
+    MANIFEST_ORDERS,
     SESSION_ZIP_EXTENSION,
+    compactManifest,
     isJobOutputFolderItem,
     isLaunchFile,
     isLoadableImage,
@@ -44,13 +61,40 @@ from ..utils import (
     getLinkedResources,
     idStringToIdList,
     findNewestSession,
+    folderSessionFile,
     loadModels,
     normalizeLinkedResources,
     sessionNameFromFilter,
+    streamManifest,
+    subtreeFileEntries,
+    subtreeFileRows,
+    nextSubtreeFolder,
+    subtreeFolder,
+    subtreeItemPage,
 )
 
 LARGE_IMAGE_CONFIG_FOLDER = "large_image.config_folder"
 
+# Bare folder-opens of folders counted at this many loadable files or more
+# stream their manifest.
+DEFAULT_MANIFEST_STREAM_THRESHOLD = 10000
+
+# Items per page of the paginated folder manifest.
+MANIFEST_PAGE_DEFAULT = 500
+MANIFEST_PAGE_MAX = 5000
+
+MANIFEST_FORMAT_DESCRIPTION = (
+    "resources (default): a {resources: [{url, name}]} list VolView loads. "
+    "compact: {urlTemplate, series: [{seriesInstanceUID, ids, names}], "
+    "resources}, each file's URL being urlTemplate with its id and "
+    "percent-encoded name substituted; resources keeps the other entries. "
+    "bundled: as resources, but each whole DICOM series is one uncompressed "
+    "zip resource (volview_bundle) in place of its slices."
+)
+
+# Reshapings of the standard manifest, by format.
+MANIFEST_RESHAPES = {"compact": compactManifest, "bundled": bundledManifest}
+
 BASE_CONFIG = {
     "io": {
         "segmentGroupExtension": "seg",
@@ -233,6 +277,59 @@ def saveToFolder(self, folderId, metadata):
     return _saveResponse(fileDic["itemId"])
 
 
+def _notModified(etag):
+    """Set ``etag`` on the response; 304 it when the client already has it.
+
+    Responses are per-user (cookie auth), so shared caches must not keep them,
+    and the client revalidates on every load.
+    """
+    cherrypy.response.headers["ETag"] = etag
+    cherrypy.response.headers["Cache-Control"] = "private, no-cache"
+    ifNoneMatch = cherrypy.request.headers.get("If-None-Match")
+    if not ifNoneMatch:
+        return False
+    for candidate in ifNoneMatch.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate in ("*", etag):
+            cherrypy.response.status = 304
+            return True
+    return False
+
+
+def _etag(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+        digest.update(b"\0")
+    return '"%s"' % digest.hexdigest()[:32]
+
+
+def _manifestEtag(manifest):
+    # The manifest names each file by id and name only, so it is its own
+    # validator: identical bodies are interchangeable.
+    return _etag(manifest)
+
+
+def _revalidatedManifest(format, key, compute, user, scopes, roots):
+    """``_cachedInFormat``'s manifest, or ``None`` once 304'd.
+
+    With the manifest cache's shared change counters, the tag is taken from
+    them (``manifestVersion``) before anything is computed, so a reload of an
+    unchanged manifest costs one small read. Read first, it can only be older
+    than the body it goes out with, never newer. Without them the body is
+    hashed.
+    """
+    version = manifestVersion(key, roots)
+    if version is not None and _notModified(_etag(version, format)):
+        return None
+    manifest = _cachedInFormat(format, key, compute, user, scopes, roots)
+    if version is None and _notModified(_manifestEtag(manifest)):
+        return None
+    return manifest
+
+
 @access.public(cookie=True, scope=TokenScope.DATA_READ)
 @boundHandler
 @autoDescribeRoute(
@@ -242,12 +339,45 @@ def saveToFolder(self, folderId, metadata):
         "images (fresh)."
     )
     .modelParam("itemId", model=Item, level=AccessType.READ)
+    .param(
+        "format",
+        MANIFEST_FORMAT_DESCRIPTION,
+        required=False,
+        default="resources",
+        enum=list(MANIFEST_FORMATS),
+    )
     .produces(["application/json"])
     .errorResponse("ID was invalid.")
     .errorResponse("Read access was denied for the item.", 403)
 )
-def downloadManifest(self, item):
+def downloadManifest(self, item, format):
     user = self.getCurrentUser()
+    return _revalidatedManifest(
+        format,
+        manifestKey("item", item["_id"], user),
+        lambda: _itemManifest(item, user),
+        user,
+        scopes=[item["_id"], item["folderId"]],
+        roots=[item.get("baseParentId")],
+    )
+
+
+def _cachedInFormat(format, key, compute, user, scopes, roots):
+    """``cachedManifest``, reshaped (and cached reshaped) to ``format``."""
+    manifest = cachedManifest(
+        key, lambda: withVolumes(compute(), user), scopes=scopes, roots=roots
+    )
+    if format not in MANIFEST_RESHAPES:
+        return manifest
+    return cachedManifest(
+        key + (format,),
+        lambda: MANIFEST_RESHAPES[format](manifest),
+        scopes=scopes,
+        roots=roots,
+    )
+
+
+def _itemManifest(item, user):
     # Job outputs stay durable in the folder but out of the launch manifest: a
     # direct open of an item inside a job's private output folder yields nothing.
     if isJobOutputFolderItem(item):
@@ -282,20 +412,211 @@ def downloadManifest(self, item):
         "Filter (dict) or filter list (array of dicts) to apply within a folder.",
         required=False,
     )
+    .param(
+        "format",
+        MANIFEST_FORMAT_DESCRIPTION,
+        required=False,
+        default="resources",
+        enum=list(MANIFEST_FORMATS),
+    )
+    .param(
+        "order",
+        "listing (default): files in folder listing order. position: each "
+        "tagged DICOM series' slices together along the slice normal. "
+        "middle-out: as position, but each series starts from its center slice "
+        "and alternates outwards, for a meaningful first paint.",
+        required=False,
+        default="listing",
+        enum=list(MANIFEST_ORDERS),
+    )
     .produces(["application/json"])
     .errorResponse("ID was invalid.")
     .errorResponse("Read access was denied for the folders or items.", 403)
 )
-def downloadResourceManifest(self, folder, folders, items, filters):
+def downloadResourceManifest(self, folder, folders, items, filters, format, order):
     user = self.getCurrentUser()
-    itemCache = {}
-    folderCache = {}
     folders = idStringToIdList(folders or "")
     items = idStringToIdList(items or "")
     # filters is either a dict, a list of dicts, or absent. Anything else
     # (bare scalar) is rejected here rather than 500ing in Mongo.
     if filters is not None and not isinstance(filters, (dict, list)):
         raise RestException("filters must be a JSON object or array of objects")
+    if (
+        format == "resources"
+        and order == "listing"
+        and not (folders or items or filters)
+        and _streamsManifest(folder)
+    ):
+        return _streamedFolderManifest(folder, user)
+    return _revalidatedManifest(
+        format,
+        manifestKey(
+            "folder",
+            folder["_id"],
+            user,
+            folders=folders,
+            items=items,
+            filters=filters,
+            order=order,
+        ),
+        lambda: _resourceManifest(folder, folders, items, filters, user, order),
+        user,
+        scopes=[folder["_id"], *folders, *items],
+        # Checked picks may live in any tree.
+        roots=None if folders or items else [folder.get("baseParentId")],
+    )
+
+
+def _streamsManifest(folder):
+    threshold = int(
+        getConfig()
+        .get("volview", {})
+        .get("manifest_stream_threshold", DEFAULT_MANIFEST_STREAM_THRESHOLD)
+    )
+    if threshold <= 0:
+        return False
+    count = knownFolderCounts([folder["_id"]]).get(folder["_id"])
+    return count is not None and count >= threshold
+
+
+def _streamedFolderManifest(folder, user):
+    """A bare folder-open written out as the subtree cursor is read.
+
+    Same resume rule as ``_resourceManifest``; the raw images come in cursor
+    order, and the response is neither cached nor tagged, since its body is
+    only known once it has been sent.
+    """
+    session = folderSessionFile(folder)
+    if session is not None:
+        files = [session]
+    else:
+        folderCache = {}
+
+        def loadableRows():
+            for file, item, parent in subtreeFileRows(folder, user):
+                folderCache.setdefault(str(parent["_id"]), parent)
+                itemCache = {item["_id"]: item}
+                if isLoadableImage(file, user, itemCache, folderCache):
+                    yield None, file
+
+        files = loadableRows()
+    cherrypy.response.headers["Content-Type"] = "application/json"
+    cherrypy.response.headers["Cache-Control"] = "private, no-cache"
+    return streamManifest(files, folder["_id"])
+
+
+def _encodeManifestCursor(folderId, itemId=None):
+    """The folder the walk is in, and the last item of it already listed."""
+    value = {"folder": str(folderId), "id": None if itemId is None else str(itemId)}
+    payload = json.dumps(value, separators=(",", ":")).encode("utf8")
+    return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=")
+
+
+def _decodeManifestCursor(cursor):
+    from bson.errors import InvalidId
+    from bson.objectid import ObjectId
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value = json.loads(base64.urlsafe_b64decode(padded).decode("utf8"))
+        itemId = value["id"]
+        return (
+            ObjectId(value["folder"]),
+            None if itemId is None else ObjectId(itemId),
+        )
+    except (
+        TypeError,
+        ValueError,
+        KeyError,
+        InvalidId,
+        json.JSONDecodeError,
+        binascii.Error,
+    ):
+        raise RestException("Invalid manifest cursor", code=400) from None
+
+
+def _manifestPageSize(limit):
+    try:
+        pageSize = int(limit if limit is not None else MANIFEST_PAGE_DEFAULT)
+        if pageSize < 1 or pageSize > MANIFEST_PAGE_MAX:
+            raise ValueError()
+        return pageSize
+    except (TypeError, ValueError):
+        raise RestException("Invalid manifest page limit", code=400) from None
+
+
+@access.public(cookie=True, scope=TokenScope.DATA_READ)
+@boundHandler
+@autoDescribeRoute(
+    Description("Download a bare folder-open's VolView launch manifest by pages.")
+    .notes(
+        "Each page is {resources, nextCursor}; pass nextCursor back for the next "
+        "page until it is null. The first page carries config.json, and is the "
+        "only page when the folder resumes its newest session. Otherwise pages "
+        "walk the folder's subtree depth first, each folder's items in id "
+        "order, listing their loadable images, so a page may hold fewer "
+        "resources than its limit, or none."
+    )
+    .modelParam("folderId", model=Folder, level=AccessType.READ)
+    .param(
+        "limit",
+        "Items per page (1-%d)." % MANIFEST_PAGE_MAX,
+        required=False,
+        dataType="integer",
+    )
+    .param("cursor", "Opaque continuation cursor.", required=False)
+    .produces(["application/json"])
+    .errorResponse("ID was invalid.")
+    .errorResponse("Read access was denied for the folder.", 403)
+)
+def downloadResourceManifestPage(self, folder, limit, cursor):
+    user = self.getCurrentUser()
+    pageSize = _manifestPageSize(limit)
+    if cursor:
+        folderId, after = _decodeManifestCursor(cursor)
+        current = subtreeFolder(folder, folderId, user)
+        if current is None:
+            # Moved out of the subtree, removed, or never in it.
+            raise RestException("Invalid manifest cursor", code=400)
+    else:
+        session = folderSessionFile(folder)
+        if session is not None:
+            return dict(filesToManifest([session], folder["_id"]), nextCursor=None)
+        current, after = folder, None
+    # The cursor names the folder the walk is in, so a page costs a query per
+    # folder it lists rather than a walk of the whole subtree. Empty folders
+    # count against the limit too, so a page never walks unboundedly.
+    files = []
+    listed = visited = 0
+    while current is not None and listed < pageSize and visited < pageSize:
+        items = subtreeItemPage([current["_id"]], after, pageSize - listed)
+        visited += 1
+        folderCache = {str(current["_id"]): current}
+        for item in items:
+            itemCache = {item["_id"]: item}
+            files.extend(
+                (None, file)
+                for file in item.pop("files")
+                if isLoadableImage(file, user, itemCache, folderCache)
+            )
+            after = item["_id"]
+        listed += len(items)
+        if listed < pageSize:
+            # The folder is done.
+            current, after = nextSubtreeFolder(folder, current, user), None
+    manifest = filesToManifest(files, folder["_id"])
+    if cursor:
+        # config.json came with the first page.
+        manifest["resources"].pop()
+    manifest["nextCursor"] = (
+        None if current is None else _encodeManifestCursor(current["_id"], after)
+    )
+    return manifest
+
+
+def _resourceManifest(folder, folders, items, filters, user, order="listing"):
+    itemCache = {}
+    folderCache = {}
     # An explicit folders/items selection wins over filters: a stale/bookmarked
     # URL carrying both must load the checked resources, not silently
     # substitute the filter set.
@@ -322,7 +643,9 @@ def downloadResourceManifest(self, folder, folders, items, filters):
         # save), checking a session item (exactly that save), or re-entering a
         # filter row (newest filter save).
         selectedFolders = loadModels(user, Folder, folders)
-        files = getFiles(Folder, selectedFolders) + getFiles(Item, selectedItems)
+        files = getFiles(
+            Folder, selectedFolders, user, itemCache, folderCache
+        ) + getFiles(Item, selectedItems)
         primeLoadableImageCaches([f[1] for f in files], user, itemCache, folderCache)
         files = [
             f for f in files if isLoadableImage(f[1], user, itemCache, folderCache)
@@ -348,7 +671,10 @@ def downloadResourceManifest(self, folder, folders, items, filters):
         # Bare folder-open -> resume the folder's newest session.volview.zip,
         # else all its raw images. Filter-linked sessions are excluded (they are
         # only meaningful re-entered through their filter).
-        filesInFolder = list(Folder().fileList(folder, subpath=False, data=False))
+        # A folder counted at zero holds neither sessions nor images.
+        if knownFolderCounts([folder["_id"]]).get(folder["_id"]) == 0:
+            return filesToManifest([], folder["_id"])
+        filesInFolder = subtreeFileEntries(folder, user, itemCache, folderCache)
         files = singleVolViewZipOrImageFiles(
             filesInFolder,
             user=user,
@@ -356,7 +682,7 @@ def downloadResourceManifest(self, folder, folders, items, filters):
             itemCache=itemCache,
             folderCache=folderCache,
         )
-    return filesToManifest(files, folder["_id"])
+    return filesToManifest(files, folder["_id"], order=order)
 
 
 def _mergeDictionaries(a, b):
@@ -413,6 +739,38 @@ def adjustConfigForUser(config, user):
     return config
 
 
+def _configFolders(folder, user):
+    """
+    Yield the folders a named config file is looked up in, nearest first: the
+    folder and its ancestors, then the root's ``.config`` folder, then the
+    large_image config folder setting.
+    """
+    last = False
+    while folder:
+        yield folder
+        if last:
+            break
+        if folder["parentCollection"] != "folder":
+            if folder["name"] != ".config":
+                folder = Folder().findOne(
+                    {
+                        "parentId": folder["parentId"],
+                        "parentCollection": folder["parentCollection"],
+                        "name": ".config",
+                    }
+                )
+            else:
+                last = "setting"
+            if not folder or last == "setting":
+                folderId = Setting().get(LARGE_IMAGE_CONFIG_FOLDER)
+                if not folderId:
+                    break
+                folder = Folder().load(folderId, force=True)
+                last = True
+        else:
+            folder = Folder().load(folder["parentId"], user=user, level=AccessType.READ)
+
+
 # Modified from https://github.com/girder/large_image/blob/aa1dc05665944e87eb9cb8553085221fab16ae92/girder/girder_large_image/__init__.py#L434-L483
 def yamlConfigFile(folder, name, user, addConfig):
     """
@@ -423,9 +781,8 @@ def yamlConfigFile(folder, name, user, addConfig):
     :param user: the user that the response if adjusted for.
     :returns: either None if no config file, or a yaml record.
     """
-    last = False
-    while folder:
-        item = Item().findOne({"folderId": folder["_id"], "name": name})
+    for configFolder in _configFolders(folder, user):
+        item = Item().findOne({"folderId": configFolder["_id"], "name": name})
         if item:
             for file in Item().childFiles(item):
                 if file["size"] > 10 * 1024**2:
@@ -449,30 +806,35 @@ def yamlConfigFile(folder, name, user, addConfig):
                         return config
                     config.pop("__inherit__")
                     addConfig = config
-        if last:
-            break
-        if folder["parentCollection"] != "folder":
-            if folder["name"] != ".config":
-                folder = Folder().findOne(
-                    {
-                        "parentId": folder["parentId"],
-                        "parentCollection": folder["parentCollection"],
-                        "name": ".config",
-                    }
-                )
-            else:
-                last = "setting"
-            if not folder or last == "setting":
-                folderId = Setting().get(LARGE_IMAGE_CONFIG_FOLDER)
-                if not folderId:
-                    break
-                folder = Folder().load(folderId, force=True)
-                last = True
-        else:
-            folder = Folder().load(folder["parentId"], user=user, level=AccessType.READ)
     return addConfig
 
 
+def configFileEtag(folder, name, user):
+    """
+    An ETag for ``getFolderConfigFile``, found without reading any config file.
+
+    Covers every config file the lookup could read (their item and file ids,
+    ``updated`` times and sizes), the launch folder (the processing block names
+    it), the caller (``access`` / ``groups`` sections) and ``BASE_CONFIG``.
+    Config files further up than the one that ends the lookup are covered too,
+    so editing one of those changes the tag without changing the body.
+    """
+    parts = [BASE_CONFIG, aclFingerprint(user), folder["_id"], folder.get("name")]
+    for configFolder in _configFolders(folder, user):
+        item = Item().findOne(
+            {"folderId": configFolder["_id"], "name": name}, fields=["updated"]
+        )
+        if item:
+            parts.append((item["_id"], item.get("updated")))
+            parts.extend(
+                (file["_id"], file.get("updated"), file.get("size"), file.get("sha512"))
+                for file in Item().childFiles(
+                    item, fields=["updated", "size", "sha512"]
+                )
+            )
+    return _etag(*parts)
+
+
 @access.public(cookie=True, scope=TokenScope.DATA_READ)
 @boundHandler()
 @autoDescribeRoute(
@@ -500,6 +862,8 @@ def yamlConfigFile(folder, name, user, addConfig):
 )
 def getFolderConfigFile(self, folder, name):
     user = self.getCurrentUser()
+    if _notModified(configFileEtag(folder, name, user)):
+        return None
     baseConfig = copy.deepcopy(BASE_CONFIG)
     config = yamlConfigFile(folder, name, user, None) or {}
     config = _mergeDictionaries(baseConfig, config)
@@ -0,0 +1,296 @@
+"""Resumable backfill of ``meta.dicom`` for data the ingest hook never tagged.
+
+Items imported before the plugin was enabled, or whose parse failed
+transiently, carry no ``meta.dicom`` and nothing will revisit them. A backfill
+walks the untagged items under a folder or collection in ``_id`` order, in
+batches, and runs each batch's candidate files through the same cached parse
+as the live hook:
+
+* assetstore reads run on a small thread pool (they are I/O bound);
+* ``dcmread`` + coercion run on a ``spawn`` process pool, since they are CPU
+  bound and hold the GIL -- a worker that needs more of the header raises
+  ``_PrefixExhaustedError`` back to the parent, which fetches the rest;
+* tags are written through a ``DicomMetadataWriter`` and flushed per batch.
+
+Progress is a Girder job, but its run gets a thread of its own rather than
+Girder's local job handler: that handler runs asynchronous jobs on
+``events.daemon``, the one thread per process that also serves every other
+asynchronous event, and a backfill can hold it for hours. Folders are walked a
+level at a time and their items listed ``FOLDER_CHUNK_SIZE`` folders at a
+time, so no query names every folder of a large collection. After each batch
+lands, the folder chunk reached and the last item id in it are checkpointed on
+the job document; starting a backfill on a resource that has an unfinished one
+(a server restart kills the run, leaving it ``RUNNING``) resumes from that
+checkpoint instead of starting over.
+
+Each checkpoint also renews the run's claim on the job. Starting a backfill
+only starts a run if it can claim the job, so two requests -- or two server
+processes -- never run one job twice; a claim not renewed for
+``CLAIM_SECONDS`` (its run died) lapses.
+"""
+
+import concurrent.futures
+import datetime
+import os
+import threading
+import time
+
+from girder import logger
+from girder.models.file import File
+from girder.models.item import Item
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+
+from . import dicom, parse_pool
+from .ingest import DicomMetadataWriter, isIngestCandidate
+from .utils import FOLDER_CHUNK_SIZE, subtreeFolderIds
+
+JOB_TYPE = "volview_dicom_backfill"
+DEFAULT_BATCH_SIZE = 200
+CLAIM_SECONDS = 600
+_STATE_FIELD = "volviewBackfill"
+_CLAIM_FIELD = "%s.claimed" % _STATE_FIELD
+_UNFINISHED = (
+    JobStatus.INACTIVE,
+    JobStatus.QUEUED,
+    JobStatus.RUNNING,
+    JobStatus.ERROR,
+)
+
+
+def defaultProcesses():
+    return min(4, os.cpu_count() or 1)
+
+
+def findResumableJob(resourceType, resourceId):
+    return Job().findOne(
+        {
+            "type": JOB_TYPE,
+            "%s.resourceType" % _STATE_FIELD: resourceType,
+            "%s.resourceId" % _STATE_FIELD: resourceId,
+            "status": {"$in": list(_UNFINISHED)},
+        },
+        sort=[("created", -1)],
+    )
+
+
+def claimJob(job):
+    """Claim ``job`` for a new run; ``False`` while a live run holds it."""
+    now = datetime.datetime.utcnow()
+    claimed = Job().collection.find_one_and_update(
+        {
+            "_id": job["_id"],
+            "$or": [
+                {_CLAIM_FIELD: None},
+                {
+                    _CLAIM_FIELD: {
+                        "$lt": now - datetime.timedelta(seconds=CLAIM_SECONDS)
+                    }
+                },
+            ],
+        },
+        {"$set": {_CLAIM_FIELD: now}},
+    )
+    return claimed is not None
+
+
+def startBackfill(user, resourceType, resource, processes=None):
+    """Start (or resume) a backfill of ``resource`` as a local Girder job.
+
+    Returns the job; one a live run already holds is returned as is.
+    """
+    job = findResumableJob(resourceType, resource["_id"])
+    if job is None:
+        job = Job().createLocalJob(
+            module=__name__,
+            function="run",
+            title="VolView DICOM metadata backfill: %s" % resource["name"],
+            type=JOB_TYPE,
+            user=user,
+            public=False,
+            asynchronous=True,
+            otherFields={
+                _STATE_FIELD: {
+                    "resourceType": resourceType,
+                    "resourceId": resource["_id"],
+                    "processes": None,
+                    "lastFolderId": None,
+                    "lastItemId": None,
+                    "items": 0,
+                    "files": 0,
+                    "tagged": 0,
+                    "seconds": 0.0,
+                    "claimed": None,
+                }
+            },
+        )
+    if not claimJob(job):
+        return job
+    job = Job().updateJob(job, status=JobStatus.QUEUED)
+    if processes is not None:
+        job[_STATE_FIELD]["processes"] = processes
+    threading.Thread(
+        target=run, args=(job,), name="volview-backfill", daemon=True
+    ).start()
+    return job
+
+
+def folderChunks(folderIds, lastFolderId, chunkSize=FOLDER_CHUNK_SIZE):
+    """The sorted ``folderIds`` after ``lastFolderId``, ``chunkSize`` at a time.
+
+    New folders sort after existing ones, so a checkpointed ``lastFolderId``
+    still marks where a walk had reached.
+    """
+    remaining = [
+        folderId
+        for folderId in folderIds
+        if lastFolderId is None or folderId > lastFolderId
+    ]
+    for start in range(0, len(remaining), chunkSize):
+        yield remaining[start : start + chunkSize]
+
+
+def pendingItemsQuery(folderIds, lastItemId):
+    query = {"folderId": {"$in": folderIds}, "meta.dicom": {"$exists": False}}
+    if lastItemId is not None:
+        query["_id"] = {"$gt": lastItemId}
+    return query
+
+
+def candidateFilesByItem(itemIds):
+    """Each item's ingest-candidate files in ``_id`` order."""
+    byItem = {itemId: [] for itemId in itemIds}
+    for file in File().find({"itemId": {"$in": list(itemIds)}}, sort=[("_id", 1)]):
+        if isIngestCandidate(file):
+            byItem[file["itemId"]].append(file)
+    return byItem
+
+
+def tagItem(files, writer, parse):
+    """Tag an item from the first of its files that parses as DICOM.
+
+    Returns ``(filesParsed, tagged)``.
+    """
+    for index, file in enumerate(files):
+        if dicom.addDicomTagsToItemMetadata(file, writer=writer, parse=parse):
+            return index + 1, True
+    return len(files), False
+
+
+def backfillBatch(byItem, writer, parse, fetchers):
+    """Tag one batch of items and land its writes; returns per-batch counts."""
+    results = list(
+        fetchers.map(lambda files: tagItem(files, writer, parse), byItem.values())
+    )
+    writer.flush()
+    return {
+        "items": len(results),
+        "files": sum(files for files, _ in results),
+        "tagged": sum(1 for _, tagged in results if tagged),
+    }
+
+
+def _pendingItemIds(folderIds, lastItemId, batchSize):
+    return [
+        item["_id"]
+        for item in Item().find(
+            pendingItemsQuery(folderIds, lastItemId),
+            sort=[("_id", 1)],
+            limit=batchSize,
+            fields=["_id"],
+        )
+    ]
+
+
+def run(job, batchSize=DEFAULT_BATCH_SIZE):
+    jobModel = Job()
+    state = job[_STATE_FIELD]
+    try:
+        state["claimed"] = datetime.datetime.utcnow()
+        job = jobModel.updateJob(
+            job,
+            status=JobStatus.RUNNING,
+            log=(
+                "Resuming after folder %s, item %s\n"
+                % (state.get("lastFolderId"), state["lastItemId"])
+                if state["lastItemId"] or state.get("lastFolderId")
+                else "Starting\n"
+            ),
+            otherFields={_STATE_FIELD: state},
+        )
+        folderIds = subtreeFolderIds(state["resourceType"], state["resourceId"])
+        chunks = list(folderChunks(folderIds, state.get("lastFolderId")))
+        total = sum(
+            Item().collection.count_documents(
+                pendingItemsQuery(chunk, state["lastItemId"] if not index else None)
+            )
+            for index, chunk in enumerate(chunks)
+        )
+        processes = state.get("processes")
+        processes = defaultProcesses() if processes is None else processes
+        writer = DicomMetadataWriter(batchSize=batchSize)
+        pool = parse_pool.ParsePool(processes) if processes > 0 else None
+        parse = pool.parse if pool else dicom.parseDicomBytes
+        priorSeconds = state["seconds"]
+        started = time.monotonic()
+        runItems = runFiles = 0
+
+        def checkpoint(job):
+            elapsed = time.monotonic() - started
+            state["seconds"] = priorSeconds + elapsed
+            state["claimed"] = datetime.datetime.utcnow()
+            return jobModel.updateJob(
+                job,
+                progressTotal=total,
+                progressCurrent=runItems,
+                progressMessage="%d files parsed, %.1f files/s"
+                % (runFiles, runFiles / elapsed if elapsed else 0.0),
+                otherFields={_STATE_FIELD: state},
+            )
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max(2, 2 * processes),
+                thread_name_prefix="volview-dicom-backfill-fetch",
+            ) as fetchers:
+                for chunk in chunks:
+                    while True:
+                        current = jobModel.load(
+                            job["_id"], force=True, includeLog=False
+                        )
+                        if current is None or current["status"] == JobStatus.CANCELED:
+                            return
+                        itemIds = _pendingItemIds(chunk, state["lastItemId"], batchSize)
+                        if not itemIds:
+                            break
+                        counts = backfillBatch(
+                            candidateFilesByItem(itemIds), writer, parse, fetchers
+                        )
+                        runItems += counts["items"]
+                        runFiles += counts["files"]
+                        for key, value in counts.items():
+                            state[key] += value
+                        state["lastItemId"] = itemIds[-1]
+                        job = checkpoint(job)
+                    state["lastFolderId"] = chunk[-1]
+                    state["lastItemId"] = None
+                    job = checkpoint(job)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        elapsed = time.monotonic() - started
+        summary = "Tagged %d of %d items from %d files in %.1fs (%.1f files/s)" % (
+            state["tagged"],
+            state["items"],
+            state["files"],
+            state["seconds"],
+            runFiles / elapsed if elapsed else 0.0,
+        )
+        logger.info("DICOM backfill %s: %s", job["_id"], summary)
+        jobModel.updateJob(job, status=JobStatus.SUCCESS, log=summary + "\n")
+    except Exception as exc:
+        logger.exception("DICOM backfill %s failed", job["_id"])
+        jobModel.updateJob(job, status=JobStatus.ERROR, log="%s\n" % exc)
+    finally:
+        # Resumable at once, by the next start.
+        Job().collection.update_one({"_id": job["_id"]}, {"$set": {_CLAIM_FIELD: None}})
@@ -0,0 +1,321 @@
+"""Series bundles: every file of a DICOM series as one uncompressed zip.
+
+Opening a series slice by slice costs a request, a permission check and an
+assetstore open per slice. A bundle sends the files of one series -- the items
+of a ``SeriesInstanceUID`` directly in one folder -- in a single response, read
+from the assetstore as the archive is written, without temporary files.
+
+The archive's byte layout follows from its member names and sizes alone, so its
+length is known up front and ``Range`` requests are served without building the
+rest of it. CRCs are only known once a member has been read: each follows its
+member in a data descriptor and is repeated in the central directory, so a
+range that reaches the central directory reads (without sending) the members
+before the range whose CRC is not known yet. A CRC, once read, is stored on
+the file document under ``volviewCrc32`` with the file's content key, so later
+bundles of the same files do not read them again. There is no ZIP64: a bundle
+holds fewer than 65535 files and less than 4 GiB.
+"""
+
+import struct
+import zlib
+from urllib.parse import quote
+
+from bson.objectid import ObjectId
+from girder.exceptions import RestException
+from girder.models.file import File
+from girder.models.item import Item
+from girder.utility.server import getApiRoot
+
+from .handles import parseFileHandle
+from .parse_cache import cacheKey
+from .series import DicomSeries
+from .utils import fileSeries, safeNameComponent
+
+ZIP_MAX_MEMBERS = 0xFFFF - 1
+ZIP_MAX_BYTES = 0xFFFFFFFF
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_DESCRIPTOR = struct.Struct("<IIII")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_RECORD = struct.Struct("<IHHHHIIH")
+
+# CRC and sizes follow the data (bit 3); names are UTF-8 (bit 11).
+_FLAGS = 0x0008 | 0x0800
+_VERSION = 20
+# 1980-01-01 00:00 for every member, so a bundle's bytes depend on its files only.
+_DOS_TIME = 0
+_DOS_DATE = (1 << 5) | 1
+
+# ``{"crc": <CRC-32>, "key": <content key>}`` on a file document.
+CRC_FIELD = "volviewCrc32"
+
+
+def _asBytes(chunk):
+    # S3 assetstores yield an empty ``str`` for a file of no bytes.
+    return chunk.encode("utf8") if isinstance(chunk, str) else chunk
+
+
+class StoredZip:
+    """A stored zip of Girder ``files``, written on demand, whole or by range."""
+
+    def __init__(self, files):
+        if len(files) > ZIP_MAX_MEMBERS:
+            raise RestException("Too many files for one bundle.")
+        self.files = files
+        # Numbered so names never collide and list in bundle order.
+        self.names = [
+            ("%05d_%s" % (index, file["name"].replace("/", "_"))).encode("utf8")
+            for index, file in enumerate(files, 1)
+        ]
+        self.offsets = []
+        self._crcs = {}
+        for index, file in enumerate(files):
+            stored = file.get(CRC_FIELD)
+            key = cacheKey(file)
+            if stored and key is not None and stored.get("key") == key:
+                self._crcs[index] = stored["crc"]
+        self._segments = []
+        offset = 0
+        for index, name in enumerate(self.names):
+            self.offsets.append(offset)
+            for kind, length in (
+                ("local", _LOCAL_HEADER.size + len(name)),
+                ("data", self._size(index)),
+                ("descriptor", _DESCRIPTOR.size),
+            ):
+                self._segments.append((offset, length, kind, index))
+                offset += length
+        self.centralOffset = offset
+        centralSize = sum(_CENTRAL_HEADER.size + len(name) for name in self.names)
+        self._segments.append((offset, centralSize, "central", None))
+        offset += centralSize
+        self._segments.append((offset, _END_RECORD.size, "end", None))
+        self.size = offset + _END_RECORD.size
+        # 0xFFFFFFFF itself is the ZIP64 sentinel.
+        if self.centralOffset >= ZIP_MAX_BYTES:
+            raise RestException("Too many bytes for one bundle.")
+
+    def _size(self, index):
+        return self.files[index].get("size") or 0
+
+    def _read(self, index, offset=0, endByte=None):
+        return File().download(
+            self.files[index], offset=offset, endByte=endByte, headers=False
+        )()
+
+    def _remember(self, index, crc):
+        self._crcs[index] = crc
+        file = self.files[index]
+        key = cacheKey(file)
+        if key is not None:
+            # Written directly: a model save would fire the file's save events.
+            File().collection.update_one(
+                {"_id": file["_id"]}, {"$set": {CRC_FIELD: {"crc": crc, "key": key}}}
+            )
+
+    def _crc(self, index):
+        if index not in self._crcs:
+            crc = 0
+            for chunk in self._read(index):
+                crc = zlib.crc32(_asBytes(chunk), crc)
+            self._remember(index, crc)
+        return self._crcs[index]
+
+    def _data(self, index, lo, hi, needCrc):
+        if not needCrc or index in self._crcs:
+            for chunk in self._read(index, lo, hi):
+                if chunk:
+                    yield _asBytes(chunk)
+            return
+        # Read from the start to learn the CRC, sending only [lo, hi).
+        crc = 0
+        position = 0
+        for chunk in self._read(index):
+            chunk = _asBytes(chunk)
+            crc = zlib.crc32(chunk, crc)
+            part = chunk[max(lo - position, 0) : max(hi - position, 0)]
+            if part:
+                yield part
+            position += len(chunk)
+        self._remember(index, crc)
+
+    def _local(self, index):
+        name = self.names[index]
+        header = _LOCAL_HEADER.pack(
+            0x04034B50, _VERSION, _FLAGS, 0, _DOS_TIME, _DOS_DATE, 0, 0, 0, len(name), 0
+        )
+        return header + name
+
+    def _descriptor(self, index):
+        size = self._size(index)
+        return _DESCRIPTOR.pack(0x08074B50, self._crc(index), size, size)
+
+    def _central(self):
+        records = []
+        for index, name in enumerate(self.names):
+            size = self._size(index)
+            records.append(
+                _CENTRAL_HEADER.pack(
+                    0x02014B50,
+                    _VERSION,
+                    _VERSION,
+                    _FLAGS,
+                    0,
+                    _DOS_TIME,
+                    _DOS_DATE,
+                    self._crc(index),
+                    size,
+                    size,
+                    len(name),
+                    0,
+                    0,
+                    0,
+                    0,
+                    0,
+                    self.offsets[index],
+                )
+                + name
+            )
+        return b"".join(records)
+
+    def _end(self):
+        count = len(self.names)
+        centralSize = self.size - _END_RECORD.size - self.centralOffset
+        return _END_RECORD.pack(
+            0x06054B50, 0, 0, count, count, centralSize, self.centralOffset, 0
+        )
+
+    def stream(self, offset=0, endByte=None):
+        """A generator function writing bytes ``[offset, endByte)`` of the zip."""
+        endByte = self.size if endByte is None else min(endByte, self.size)
+
+        def stream():
+            for start, length, kind, index in self._segments:
+                lo = max(offset - start, 0)
+                hi = min(endByte - start, length)
+                if lo >= hi:
+                    continue
+                if kind == "data":
+                    needCrc = endByte > start + length
+                    yield from self._data(index, lo, hi, needCrc)
+                elif kind == "local":
+                    yield self._local(index)[lo:hi]
+                elif kind == "descriptor":
+                    yield self._descriptor(index)[lo:hi]
+                elif kind == "central":
+                    yield self._central()[lo:hi]
+                else:
+                    yield self._end()[lo:hi]
+
+        return stream
+
+
+def seriesFiles(folderId, seriesInstanceUid):
+    """The files of a series' items directly in a folder, in slice order.
+
+    Slices follow the series summary's ``order``; items it does not list yet
+    come last, by id. Link files, which have no bytes to send, are left out.
+    """
+    items = list(
+        Item().find(
+            {"folderId": folderId, "meta.dicom.SeriesInstanceUID": seriesInstanceUid},
+            fields=["_id"],
+        )
+    )
+    if not items:
+        return []
+    summary = DicomSeries().collection.find_one(
+        {"folderId": folderId, "seriesInstanceUID": seriesInstanceUid},
+        {"order": True},
+    )
+    ranks = {
+        itemId: rank for rank, itemId in enumerate((summary or {}).get("order", ()))
+    }
+    itemRanks = {
+        item["_id"]: (ranks.get(str(item["_id"]), len(ranks)), item["_id"])
+        for item in items
+    }
+    files = File().find(
+        {"itemId": {"$in": list(itemRanks)}, "assetstoreId": {"$exists": True}}
+    )
+    return sorted(files, key=lambda file: (itemRanks[file["itemId"]], file["_id"]))
+
+
+def bundleName(seriesInstanceUid):
+    return "%s.zip" % safeNameComponent(seriesInstanceUid)
+
+
+def bundleUrl(folderId, seriesInstanceUid):
+    return "/%s/folder/%s/volview_bundle/%s?series=%s" % (
+        getApiRoot(),
+        folderId,
+        quote(bundleName(seriesInstanceUid), safe=""),
+        quote(seriesInstanceUid, safe=""),
+    )
+
+
+def wholeSeries(resources):
+    """The series ``resources`` lists in full, at least two files of each.
+
+    Yields ``((folderId, seriesInstanceUid), indexes, files)``: the positions
+    of the series' file resources, and the files ``seriesFiles`` finds for it
+    -- exactly the files those resources name.
+    """
+    fileIds = {}
+    for index, resource in enumerate(resources):
+        handle = parseFileHandle(resource["url"])
+        if handle is not None:
+            fileIds[index] = handle[0]
+    seriesOf = fileSeries([ObjectId(fileId) for fileId in fileIds.values()])
+    groups = {}
+    for index, fileId in fileIds.items():
+        key = seriesOf.get(fileId)
+        if key is not None:
+            groups.setdefault(key, []).append(index)
+    for key, indexes in groups.items():
+        if len(indexes) < 2:
+            continue
+        files = seriesFiles(*key)
+        if {str(file["_id"]) for file in files} == {fileIds[i] for i in indexes}:
+            yield key, indexes, files
+
+
+def replaceResources(resources, replacements):
+    """``resources`` with each group of ``replacements`` folded into its entries.
+
+    ``replacements`` maps a tuple of resource positions to the list of entries
+    taking the place of the first of them; the others are dropped.
+    """
+    replaced = {}
+    dropped = set()
+    for indexes, entries in replacements.items():
+        replaced[indexes[0]] = entries
+        dropped.update(indexes[1:])
+    folded = []
+    for index, resource in enumerate(resources):
+        if index not in dropped:
+            folded.extend(replaced.get(index, [resource]))
+    return folded
+
+
+def bundledManifest(manifest):
+    """``manifest`` with each whole series it lists replaced by its bundle.
+
+    A series is bundled where the manifest holds exactly the files its bundle
+    would, at least two of them, within the zip limits; the bundle takes the
+    place of the series' first file. Anything else is left as it was.
+    """
+    resources = manifest["resources"]
+    replacements = {}
+    for (folderId, seriesInstanceUid), indexes, files in wholeSeries(resources):
+        try:
+            StoredZip(files)
+        except RestException:
+            continue
+        replacements[tuple(indexes)] = [
+            {
+                "url": bundleUrl(folderId, seriesInstanceUid),
+                "name": bundleName(seriesInstanceUid),
+            }
+        ]
+    return {"resources": replaceResources(resources, replacements)}
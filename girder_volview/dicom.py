@@ -1,8 +1,11 @@
 import datetime
 import io
-import sys
+import time
 
 import pydicom
+import pydicom.datadict
+import pydicom.dataelem
+import pydicom.values
 import pydicom.valuerep
 import pydicom.multival
 import pydicom.sequence
@@ -12,85 +15,294 @@ from girder.models.item import Item
 from girder.models.file import File
 from girder.exceptions import GirderException
 
+from . import parse_cache, parse_metrics
+from .projection import estimateSize, recordProjection, tagProjection
+from .utils import isDicomFile
+
 MAX_TAG_SIZE = 1024 * 128  # bytes
-BUFFER_SIZE_CUTOFF = 1 * 1024 * 1024  # 1MB - buffer files smaller than this in memory
+# Header-only reads: fetch this much of a file first, then grow the fetched
+# prefix geometrically until pydicom reaches the pixel data. A typical slice's
+# header fits in the first ranged read.
+PREFETCH_INITIAL_BYTES = 16 * 1024
+# Upper bound on how much one growth step adds by doubling; a read past a large
+# deferred element jumps straight to the offset pydicom asked for instead.
+PREFETCH_MAX_STEP_BYTES = 1 * 1024 * 1024
+
+
+# Triggered once per write of ``meta.dicom`` to a batch of items, after their
+# mimeTypes are upgraded. The ingest writer and the DICOMDIR reader write with
+# ``bulk_write``, which fires no ``model.item.save`` events, so whatever tracks
+# DICOM tags -- this plugin's series summaries, manifest cache and loadable
+# counts included -- binds this instead.
+TAGGED_EVENT = "volview.dicom.tagged"
+
+
+def announceTagged(itemTags):
+    """Trigger ``volview.dicom.tagged`` for items whose tags were just written.
+
+    ``event.info`` is ``{"itemIds": [...], "itemTags": {itemId: (tags, bytes)}}``.
+    """
+    events.trigger(TAGGED_EVENT, info={"itemIds": list(itemTags), "itemTags": itemTags})
+
+
+# asset store import can set mimeType to None.  Manual upload sets
+# mimeType to "application/octet-stream"
+UPGRADABLE_MIME_TYPES = (None, "application/octet-stream")
+
 
+def needsMimeTypeUpgrade(file):
+    return file.get("mimeType") in UPGRADABLE_MIME_TYPES
 
-def setupEventHandlers():
-    events.bind("model.file.save.after", "girder_volview", handleFileSave)
 
+# Extensions DICOM files are saved under, besides none at all and numbers
+# (``1.2.840...`` UIDs, ``IM.0001``).
+_DICOM_SUFFIXES = ("dcm", "dicom", "dic", "ima")
 
-def handleFileSave(event):
-    return addDicomTagsToItemMetadata(event.info)
+
+def mayBeDicom(file):
+    """Whether ``file``'s name and mimeType leave open that it is DICOM.
+
+    A file typed as something else, or named with another format's extension,
+    is not worth remembering as not-DICOM: nothing expects it to be.
+    """
+    if isDicomFile(file):
+        return True
+    if not needsMimeTypeUpgrade(file):
+        return False
+    name = file.get("name") or ""
+    if "." not in name:
+        return True
+    suffix = name.rsplit(".", 1)[1].lower()
+    return suffix.isdigit() or suffix in _DICOM_SUFFIXES
 
 
 def maybeUpgradeMimeType(file):
-    mimeType = file.get("mimeType")
-    # asset store import can set mimeType to None.  Manual upload sets
-    # mimeType to "application/octet-stream"
-    if mimeType is None or mimeType == "application/octet-stream":
+    if needsMimeTypeUpgrade(file):
         file["mimeType"] = "application/dicom"
         # Don't trigger events to avoid recursive processing
         File().save(file, triggerEvents=False)
 
 
 # Code modified from https://github.com/girder/girder/blob/master/plugins/dicom_viewer/girder_dicom_viewer/__init__.py
-def addDicomTagsToItemMetadata(file):
+def addDicomTagsToItemMetadata(file, writer=None, parse=None):
+    """Parse ``file`` and store its tags as the parent item's ``meta.dicom``.
+
+    With a ``writer`` (``ingest.DicomMetadataWriter``) the item and mimeType
+    writes are handed over to be coalesced with other files' writes; without
+    one they are written immediately. ``parse`` replaces ``parseDicomBytes``
+    (e.g. to run it in another process). Returns the tags written, if any.
+
+    Outcomes are looked up in and recorded to the content-keyed
+    ``parse_cache``; a cache hit whose tags the item already carries costs
+    one small read and no write.
+    """
     itemId = file.get("itemId")
     if itemId is None:
         return
 
-    dicomMetadata = _parseFile(file)
+    dicomMetadata = _cachedParse(file, parse or parseDicomBytes)
     if dicomMetadata is None:
-        return  # not a dicom file
+        return None  # not a dicom file
+    if writer is not None:
+        writer.add(file, dicomMetadata)
+        return dicomMetadata
+    started = time.perf_counter()
     maybeUpgradeMimeType(file)
     itemMeta = {"dicom": dicomMetadata}
     item = Item().load(itemId, force=True)
     Item().setMetadata(item, itemMeta)
+    parse_metrics.observe("write", time.perf_counter() - started)
+    announceTagged({itemId: (dicomMetadata, file.get("size"))})
+    return dicomMetadata
+
+
+def _cachedParse(file, parse):
+    """``_parseFile`` through the parse cache.
+
+    Returns ``None`` both for non-DICOM files and for a cache hit the item is
+    already up to date with, so the caller has nothing to write.
+    """
+    if _isSkipped(file) or not parse_cache.isEnabled():
+        return _parseFile(file, parse)
+    key = parse_cache.cacheKey(file)
+    if key is None:
+        parse_cache.count("uncacheable")
+        return _parseFile(file, parse)
+    if tagProjection().fingerprint:
+        # Tags stored under other projection rules must not be reused.
+        key += "|" + tagProjection().fingerprint
+
+    cache = parse_cache.DicomParseCache()
+    entry = cache.lookup(key)
+    if entry is not None:
+        parse_cache.count("hits")
+        tags = entry.get("tags")
+        if tags is not None and _itemIsCurrent(file, tags):
+            parse_cache.count("unchangedItems")
+            return None
+        return tags
+
+    parse_cache.count("misses")
+    try:
+        tags = _fetchAndParse(file, parse)
+    except pydicom.errors.InvalidDicomError as exc:
+        # Not DICOM is a property of the bytes: remember it, where the file
+        # could have been taken for DICOM.
+        _recordSkip(exc)
+        if mayBeDicom(file):
+            cache.store(key, None)
+        return None
+    except _PARSE_ERRORS as exc:
+        _recordSkip(exc)
+        return None
+    cache.store(key, tags)
+    return tags
+
+
+def _itemIsCurrent(file, tags):
+    if needsMimeTypeUpgrade(file):
+        return False
+    item = Item().load(file["itemId"], force=True, fields=["meta.dicom"], exc=False)
+    return item is not None and item.get("meta", {}).get("dicom") == tags
+
+
+# Checked most-derived first: a datetime.datetime is also a datetime.date.
+_BASE_TYPES = (datetime.datetime, datetime.date, datetime.time, int, float, str)
+# Exact value type -> the base type it is cast back to (None: not a base type).
+_baseTypes = {}
+
+
+def _baseType(valueType):
+    try:
+        return _baseTypes[valueType]
+    except KeyError:
+        base = next((b for b in _BASE_TYPES if issubclass(valueType, b)), None)
+        _baseTypes[valueType] = base
+        return base
 
 
 def _coerceValue(value):
+    # Many pydicom value types are subclasses of base types; to ensure the
+    # value can be serialized to MongoDB, cast the value back to its base type
+    base = _baseType(type(value))
+    if base is not None:
+        return base(value)
+
     # Handle lists (MultiValue) recursively
     if isinstance(value, pydicom.multival.MultiValue):
         if isinstance(value, pydicom.sequence.Sequence):
             # A pydicom Sequence is a nested list of Datasets, which is too
             # complicated to flatten now
             raise ValueError("Cannot coerce a Sequence")
-        return list(map(_coerceValue, value))
+        return [_coerceValue(entry) for entry in value]
 
     # pydicom does not treat the PersonName type as a subclass of a text type
     if isinstance(value, pydicom.valuerep.PersonName):
         return str(value)
 
-    # Many pydicom value types are subclasses of base types; to ensure the
-    # value can be serialized to MongoDB, cast the value back to its base type
-    for knownBaseType in {
-        datetime.datetime,
-        datetime.date,
-        datetime.time,
-        int,
-        float,
-        str,
-    }:
-        if isinstance(value, knownBaseType):
-            return knownBaseType(value)
-
     if isinstance(value, bytes):
-        if b"\x00" in value:
-            raise ValueError("Binary data with null")
-        # For binary data, see if it can be coerced further into utf8 data.  If
-        # not, mongo won't store it, so don't accept it here.
-        try:
-            value.decode()
-            return value
-        except UnicodeDecodeError:
-            raise ValueError("Binary data that cannot be stored as utf-8") from None
+        return _coerceBytes(value)
 
     raise ValueError("Unknown type", type(value))
 
 
-def _coerceMetadata(dataset):
+def _coerceText(value):
+    if type(value) is str:
+        return value
+    return _coerceValue(value)
+
+
+def _coerceBytes(value):
+    if not isinstance(value, bytes):
+        return _coerceValue(value)
+    if b"\x00" in value:
+        raise ValueError("Binary data with null")
+    # For binary data, see if it can be coerced further into utf8 data.  If
+    # not, mongo won't store it, so don't accept it here.
+    try:
+        value.decode()
+        return value
+    except UnicodeDecodeError:
+        raise ValueError("Binary data that cannot be stored as utf-8") from None
+
+
+# Coercion by VR: text VRs are usually a plain str already, binary VRs always
+# go through the utf-8 check. Anything unexpected (e.g. a MultiValue) falls
+# back to the general ``_coerceValue``.
+_VR_COERCERS = {
+    **dict.fromkeys(
+        (
+            "AE", "AS", "CS", "DA", "DT", "LO", "LT", "SH", "ST", "TM", "UC", "UI",
+            "UR", "UT",
+        ),
+        _coerceText,
+    ),
+    **dict.fromkeys(("OB", "OD", "OF", "OL", "OV", "OW", "UN"), _coerceBytes),
+}  # fmt: skip
+
+# tag -> (keyword, metadata key, dictionary VR); bounded, since private tags
+# are open-ended.
+_tagInfos = {}
+_TAG_INFO_CACHE_SIZE = 16384
+
+
+def _tagInfo(tag):
+    info = _tagInfos.get(tag)
+    if info is None:
+        keyword = pydicom.datadict.keyword_for_tag(tag)
+        try:
+            vr = pydicom.datadict.dictionary_VR(tag)
+        except KeyError:
+            vr = None
+        # Use "keyword" instead of "name", as the keyword is a simpler and
+        # more uniform string
+        # See: http://dicom.nema.org/medical/dicom/current/output/html/part06.html#table_6-1
+        # For unknown / private tags, allow pydicom to create a string
+        # representation like "(0013, 1010)"
+        tagKey = keyword if keyword and not tag.is_private else str(tag)
+        info = (keyword, tagKey, vr)
+        if len(_tagInfos) < _TAG_INFO_CACHE_SIZE:
+            _tagInfos[tag] = info
+    return info
+
+
+def _rawValue(raw, encodings):
+    """``(VR, value)`` converted straight from a raw element, or ``(None, None)``.
+
+    ``dataset[tag]`` would convert the same way, then wrap the value in a
+    ``DataElement`` and store it back into the dataset -- which costs more
+    than the conversion, for a dataset that is discarded once coerced. Only
+    explicit-VR, already-read values take this path; implicit VR (which needs
+    the dictionary), UN (which pydicom re-interprets) and deferred values go
+    through ``dataset[tag]``.
+    """
+    if (
+        not isinstance(raw, pydicom.dataelem.RawDataElement)
+        or raw.VR in (None, "UN")
+        or raw.value is None
+    ):
+        return None, None
+    if raw.length == 0:
+        return raw.VR, ""
+    return raw.VR, pydicom.values.convert_value(raw.VR, raw, encodings)
+
+
+def _coerceMetadata(dataset, projection=None, report=True):
+    metadata, projected = _coerceProjected(dataset, projection)
+    if report:
+        recordProjection(*projected)
+    return metadata
+
+
+def _coerceProjected(dataset, projection=None):
+    """``(metadata, (bytesBefore, bytesAfter, tagsDropped))`` of a dataset."""
+    if projection is None:
+        projection = tagProjection()
     metadata = {}
+    sizes = {}
+    droppedBytes = 0
+    dropped = 0
+    encodings = None
 
     # Use simple iteration instead of "dataset.iterall", to prevent recursing
     # into Sequences, which are too complicated to flatten now
@@ -100,82 +312,229 @@ def _coerceMetadata(dataset):
     # but we want to ignore certain exceptions of delayed data loading, so
     # we iterate through the dataset ourselves.
     for tag in dataset.keys():
-        try:
-            dataElement = dataset[tag]
-        except OSError:
-            continue
-        if dataElement.tag.element == 0:
+        if tag.element == 0:
             # Skip Group Length tags, which are always element 0x0000
             continue
-
-        # Use "keyword" instead of "name", as the keyword is a simpler and
-        # more uniform string
-        # See: http://dicom.nema.org/medical/dicom/current/output/html/part06.html#table_6-1
-        # For unknown / private tags, allow pydicom to create a string
-        # representation like "(0013, 1010)"
-        tagKey = (
-            dataElement.keyword
-            if dataElement.keyword and not dataElement.tag.is_private
-            else str(dataElement.tag)
-        )
+        keyword, tagKey, dictionaryVR = _tagInfo(tag)
+        # Decided before the value is converted, so a projected-out element
+        # (possibly deferred) is never read.
+        if not projection.keeps(tag, keyword):
+            dropped += 1
+            droppedBytes += _rawLength(dataset, tag)
+            continue
+        raw = dataset.get_item(tag)
+        # Sequences are never stored: skip them before pydicom converts their
+        # nested datasets.
+        if (getattr(raw, "VR", None) or dictionaryVR) == "SQ":
+            continue
+        if encodings is None:
+            encodings = dataset._character_set
+        vr, value = _rawValue(raw, encodings)
+        if vr is None:
+            try:
+                dataElement = dataset[tag]
+            except OSError:
+                continue
+            vr, value = dataElement.VR, dataElement.value
 
         try:
-            tagValue = _coerceValue(dataElement.value)
+            tagValue = _VR_COERCERS.get(vr, _coerceValue)(value)
         except ValueError:
             # Omit tags where the value cannot be coerced to JSON-encodable types
             continue
 
         if tagValue == "" or tagValue == b"":
             continue
-        if sys.getsizeof(tagValue) > MAX_TAG_SIZE:
+        size = estimateSize(tagValue)
+        if size > MAX_TAG_SIZE:
             continue
 
         metadata[tagKey] = tagValue
-
-    return metadata
-
-
-def _parseFile(f):
+        sizes[tagKey] = len(tagKey) + size
+
+    kept = len(metadata)
+    droppedBytes += projection.applyBudget(metadata, sizes)
+    dropped += kept - len(metadata)
+    after = sum(sizes[key] for key in metadata)
+    return metadata, (after + droppedBytes, after, dropped)
+
+
+def _rawLength(dataset, tag):
+    # The still-encoded length, known without converting (or reading) the value.
+    length = getattr(dataset.get_item(tag), "length", 0) or 0
+    return 0 if length == 0xFFFFFFFF else length
+
+
+class _PrefixExhaustedError(OSError):
+    """A read ran past the fetched prefix of a file that has more bytes.
+
+    An ``OSError`` so ``_coerceMetadata``'s existing skip of unreadable
+    deferred values also covers a deferred value that lies beyond the prefix.
+    """
+
+    def __init__(self, needed):
+        super().__init__("DICOM header extends past the fetched prefix")
+        self.needed = needed
+
+    def __reduce__(self):
+        # Raised in a parse worker process and re-raised in the parent.
+        return type(self), (self.needed,)
+
+
+class _PrefixReader(io.BytesIO):
+    """An in-memory view of a file prefix that refuses short reads.
+
+    pydicom treats a short read as the end of the dataset, so a truncated
+    header would otherwise parse "successfully" with tags missing. Unless the
+    prefix is the whole file, a read past its end raises ``_PrefixExhaustedError``
+    carrying the offset the parse needs.
+    """
+
+    def __init__(self, data, complete):
+        super().__init__(data)
+        self._length = len(data)
+        self._complete = complete
+
+    def read(self, size=-1):
+        if not self._complete:
+            position = self.tell()
+            if size is None or size < 0:
+                raise _PrefixExhaustedError(None)
+            if position + size > self._length:
+                raise _PrefixExhaustedError(position + size)
+        return super().read(size)
+
+
+def parseDicomBytes(data, complete=True, projection=None):
+    """Coerced tags from a file's leading bytes.
+
+    ``projection`` (a ``TagProjection``) defaults to the configured one.
+    ``complete`` says ``data`` is the whole file. Otherwise a parse that needs
+    more than ``data`` raises ``_PrefixExhaustedError`` (its ``needed`` is the byte
+    offset the read wanted, or ``None`` when unknown). Raises what
+    ``pydicom.dcmread`` raises for non-DICOM input.
+    """
+    tags, timings, projected = parseDicomBytesTimed(data, complete, projection)
+    parse_metrics.observeAll(timings)
+    recordProjection(*projected)
+    return tags
+
+
+def parseDicomBytesTimed(data, complete=True, projection=None):
+    """``parseDicomBytes`` that returns what it would record, with the tags.
+
+    For worker processes, whose ``parse_metrics`` and projection stats the
+    server never reads. Returns ``(tags, timings, projected)``: ``timings`` are
+    ``(stage, seconds)`` pairs for ``parse_metrics.observeAll``, ``projected``
+    the arguments of ``projection.recordProjection``.
+    """
+    started = time.perf_counter()
+    dataset = pydicom.dcmread(
+        _PrefixReader(data, complete),
+        # don't read huge fields, esp. if this isn't even really dicom
+        defer_size=1024,
+        # don't read image data, just metadata
+        stop_before_pixels=True,
+    )
+    read = time.perf_counter()
+    tags, projected = _coerceProjected(dataset, projection)
+    timings = [("dcmread", read - started), ("coerce", time.perf_counter() - read)]
+    return tags, timings, projected
+
+
+def _readRange(f, offset, endByte):
+    """One ranged read of ``[offset, endByte)`` through the file's assetstore.
+
+    ``headers=False`` makes an S3 assetstore stream the range with a single
+    GET instead of redirecting.
+    """
+    started = time.perf_counter()
+    stream = File().download(f, offset=offset, endByte=endByte, headers=False)
+    # An S3 assetstore yields "" rather than b"" for an empty file.
+    data = b"".join(
+        chunk.encode("utf8") if isinstance(chunk, str) else chunk for chunk in stream()
+    )
+    parse_metrics.observe("download", time.perf_counter() - started)
+    parse_metrics.readRange(len(data))
+    return data
+
+
+def _nextPrefixEnd(fetched, needed):
+    grown = fetched + min(max(fetched, PREFETCH_INITIAL_BYTES), PREFETCH_MAX_STEP_BYTES)
+    return max(grown, needed or 0)
+
+
+# If pydicom.errors.InvalidDicomError occurs, probably not a dicom file.
+# If GirderException, the file may have been deleted between scanning
+# for import and handling the event
+# OSError can occur on files that are partly written and unclosed
+# ValueError can occur with corrupted DICOM tags or deferred read issues
+_PARSE_ERRORS = (
+    pydicom.errors.InvalidDicomError,
+    GirderException,
+    OSError,
+    ValueError,
+)
+
+
+def _skipReason(f):
+    # A link file's File().download() will error. DICOMDIR files are
+    # directory/index files; parsing large ones with pydicom while streaming
+    # from S3 is very slow.
     if "linkUrl" in f:
-        # link file, File().open() will error
-        return None
-
-    # Skip DICOMDIR files - they are directory/index files.
-    # Parsing large DICOMDIR files over the BUFFER_SIZE_CUTOFF with pydicom
-    # while streaming from S3 is very slow
+        return "linkUrl"
     if f.get("name", "").upper() == "DICOMDIR":
-        return None
+        return "DICOMDIR"
+    # Nothing to parse.
+    if f.get("size", 1) == 0:
+        return "empty"
+    return None
+
+
+def _isSkipped(f):
+    return _skipReason(f) is not None
+
+
+def _recordSkip(exc):
+    for errorType in _PARSE_ERRORS:
+        if isinstance(exc, errorType):
+            parse_metrics.skipped(errorType.__name__)
+            return
+
+
+def _fetchAndParse(f, parse=parseDicomBytes):
+    """Fetch only the header and parse it; raises one of ``_PARSE_ERRORS``.
+
+    A small leading range is grown geometrically until pydicom reaches the
+    pixel data. Each growth step fetches only the new bytes, so a multi-MB
+    slice typically costs one or two small ranged GETs instead of a full
+    transfer or a stream of small seeks.
+    """
+    size = f.get("size") or 0
+    data = b""
+    end = PREFETCH_INITIAL_BYTES
+    while True:
+        if size:
+            end = min(end, size)
+        data += _readRange(f, len(data), end)
+        # A short read means the file ended before the requested range.
+        complete = len(data) < end or bool(size and len(data) >= size)
+        try:
+            tags = parse(data, complete)
+        except _PrefixExhaustedError as exc:
+            end = _nextPrefixEnd(len(data), exc.needed or size)
+            continue
+        parse_metrics.parsed()
+        return tags
+
 
+def _parseFile(f, parse=parseDicomBytes):
+    reason = _skipReason(f)
+    if reason is not None:
+        parse_metrics.skipped(reason)
+        return None
     try:
-        # download file and try to parse dicom
-        with File().open(f) as fp:
-            # For small files, buffer in memory for better dcmread performance from S3
-            # This provides ~5x speedup for S3 files (0.15s vs 0.8s for 500KB files)
-            file_size = f.get("size", 0)
-            file_handle = (
-                io.BytesIO(fp.read())
-                if (file_size > 0 and file_size < BUFFER_SIZE_CUTOFF)
-                else fp
-            )
-
-            dataset = pydicom.dcmread(
-                file_handle,
-                # don't read huge fields, esp. if this isn't even really dicom
-                defer_size=1024,
-                # don't read image data, just metadata
-                stop_before_pixels=True,
-            )
-
-            return _coerceMetadata(dataset)
-    except (
-        pydicom.errors.InvalidDicomError,
-        GirderException,
-        OSError,
-        ValueError,
-    ):
-        # If pydicom.errors.InvalidDicomError occurs, probably not a dicom file.
-        # If GirderException, the file may have been deleted between scanning
-        # for import and handling the event
-        # OSError can occur on files that are partly written and unclosed
-        # ValueError can occur with corrupted DICOM tags or deferred read issues
+        return _fetchAndParse(f, parse)
+    except _PARSE_ERRORS as exc:
+        _recordSkip(exc)
         return None
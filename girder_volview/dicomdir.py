@@ -0,0 +1,365 @@
+"""Tag a folder's instances from its DICOMDIR instead of parsing every slice.
+
+A DICOMDIR already carries the Patient / Study / Series / Image records of
+every file it references, so one full read of it can stand in for one ranged
+read + ``dcmread`` per slice. Opt-in, since a directory's image records carry
+only what its creator chose to include (often no image position), so
+DICOMDIR-derived ``meta.dicom`` can be sparser than a slice's own header::
+
+    [volview]
+    dicom_dicomdir_ingest = true
+    dicom_dicomdir_min_resolved = 0.95  # trust threshold, see below
+    dicom_dicomdir_settle_ms = 2000
+    dicom_dicomdir_max_bytes = 536870912
+
+How it plays with the ingest queue:
+
+* a saved DICOMDIR registers its folder as *pending*;
+* while pending, a queued file under that folder is deferred rather than
+  parsed;
+* once the queue has been idle for ``dicom_dicomdir_settle_ms`` (an import's
+  files have all been saved), the DICOMDIR is read in one ranged GET, its
+  records are walked, and each ``ReferencedFileID`` is resolved against the
+  folder's subtree by name;
+* if at least ``dicom_dicomdir_min_resolved`` of the references resolve, the
+  directory is trusted: the resolved items without ``meta.dicom`` are tagged
+  with bulk writes (and marked with ``volviewDicomDirId``);
+* deferred files the directory did not tag are handed back for the usual
+  per-slice parse, so nothing is lost to an untrusted or partial directory.
+
+Pending state is per process: a restart drops it, and the deferred files are
+left untagged for a backfill to pick up.
+"""
+
+import datetime
+import io
+import threading
+import time
+
+import pydicom
+from girder import logger
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.utility import config
+from pymongo import UpdateOne
+
+from . import dicom
+from .utils import configFlag, subtreeFolderIds
+
+DEFAULT_MIN_RESOLVED = 0.95
+DEFAULT_SETTLE_MS = 2000
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+# Directory bookkeeping, not tags of the referenced instance.
+_STRUCTURAL_KEYWORDS = frozenset(
+    {
+        "OffsetOfTheNextDirectoryRecord",
+        "RecordInUseFlag",
+        "OffsetOfReferencedLowerLevelDirectoryEntity",
+        "DirectoryRecordType",
+        "PrivateRecordUID",
+        "ReferencedFileID",
+        "MRDRDirectoryRecordOffset",
+        "ReferencedSOPClassUIDInFile",
+        "ReferencedSOPInstanceUIDInFile",
+        "ReferencedTransferSyntaxUIDInFile",
+        "ReferencedRelatedGeneralSOPClassUIDInFile",
+    }
+)
+_INSTANCE_UIDS = {
+    "ReferencedSOPClassUIDInFile": "SOPClassUID",
+    "ReferencedSOPInstanceUIDInFile": "SOPInstanceUID",
+}
+
+
+def _settings():
+    return config.getConfig().get("volview", {})
+
+
+def isEnabled():
+    return configFlag(_settings(), "dicom_dicomdir_ingest", False)
+
+
+def isDicomDir(file):
+    return file.get("name", "").upper() == "DICOMDIR" and "linkUrl" not in file
+
+
+def _recordTags(record, projection):
+    elements = pydicom.dataset.Dataset()
+    for element in record:
+        if element.keyword not in _STRUCTURAL_KEYWORDS and element.VR != "SQ":
+            elements.add(element)
+    tags = dicom._coerceMetadata(elements, projection, report=False)
+    for referenced, keyword in _INSTANCE_UIDS.items():
+        if referenced in record:
+            tags[keyword] = str(record[referenced].value)
+    return tags
+
+
+def parseDicomDir(data, projection=None):
+    """``[(relativePath, tags)]`` for every file a DICOMDIR references.
+
+    Each file's tags are its own record's merged over those of the records
+    above it (patient, study, series). Paths use ``/`` and are upper-cased,
+    as DICOMDIR file ids are.
+    """
+    dataset = pydicom.dcmread(io.BytesIO(data))
+    records = {
+        record.seq_item_tell: record for record in dataset.DirectoryRecordSequence
+    }
+    references = []
+    visited = set()
+    stack = [(dataset.OffsetOfTheFirstDirectoryRecordOfTheRootDirectoryEntity, {})]
+    while stack:
+        offset, inherited = stack.pop()
+        while offset and offset not in visited:
+            visited.add(offset)
+            record = records.get(offset)
+            if record is None:
+                raise ValueError("DICOMDIR record offset %d is dangling" % offset)
+            offset = record.get("OffsetOfTheNextDirectoryRecord", 0)
+            if record.get("RecordInUseFlag", 0xFFFF) == 0:
+                continue
+            tags = dict(inherited)
+            tags.update(_recordTags(record, projection))
+            if "ReferencedFileID" in record:
+                fileId = record.ReferencedFileID
+                parts = [fileId] if isinstance(fileId, str) else list(fileId)
+                references.append(("/".join(parts).upper(), tags))
+            lower = record.get("OffsetOfReferencedLowerLevelDirectoryEntity", 0)
+            if lower:
+                stack.append((lower, tags))
+    return references
+
+
+def subtreeFiles(folder):
+    """Files under ``folder`` keyed by upper-cased path relative to it.
+
+    An item is reachable both as ``folder/item`` (a file imported as its own
+    item) and as ``folder/item/file`` (a leaf folder imported as one item).
+    """
+    folderIds = subtreeFolderIds("folder", folder["_id"])
+    parents = {
+        doc["_id"]: doc
+        for doc in Folder().find(
+            {"_id": {"$in": folderIds}}, fields=["name", "parentId"]
+        )
+    }
+    paths = {folder["_id"]: ""}
+
+    def pathOf(folderId):
+        if folderId not in paths:
+            doc = parents[folderId]
+            paths[folderId] = pathOf(doc["parentId"]) + doc["name"].upper() + "/"
+        return paths[folderId]
+
+    items = {
+        item["_id"]: pathOf(item["folderId"]) + item["name"].upper()
+        for item in Item().find(
+            {"folderId": {"$in": folderIds}}, fields=["name", "folderId"]
+        )
+    }
+    byPath = {}
+    for file in File().find(
+        {"itemId": {"$in": list(items)}},
+        fields=["itemId", "name", "size", "mimeType"],
+    ):
+        itemPath = items[file["itemId"]]
+        byPath.setdefault(itemPath, file)
+        byPath["%s/%s" % (itemPath, file["name"].upper())] = file
+    return byPath
+
+
+class DicomDirRegistry:
+    """The pending DICOMDIRs of one ingest queue and the files they deferred."""
+
+    def __init__(self, minResolved=DEFAULT_MIN_RESOLVED, settle=DEFAULT_SETTLE_MS):
+        self.minResolved = minResolved
+        self.settle = settle / 1000.0
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._parents = {}
+        self._lastActivity = time.monotonic()
+        self.lastResult = None
+
+    @classmethod
+    def fromConfig(cls):
+        settings = _settings()
+        return cls(
+            minResolved=float(
+                settings.get("dicom_dicomdir_min_resolved", DEFAULT_MIN_RESOLVED)
+            ),
+            settle=float(settings.get("dicom_dicomdir_settle_ms", DEFAULT_SETTLE_MS)),
+        )
+
+    def add(self, file):
+        item = Item().load(file["itemId"], force=True, fields=["folderId"])
+        if item is None:
+            return
+        with self._lock:
+            entry = self._pending.setdefault(
+                item["folderId"], {"fileId": file["_id"], "deferred": []}
+            )
+            entry["fileId"] = file["_id"]
+            self._lastActivity = time.monotonic()
+
+    def touch(self):
+        self._lastActivity = time.monotonic()
+
+    def defer(self, file):
+        """Hold ``file`` for a pending DICOMDIR above it; ``False`` if none."""
+        if not self._pending:
+            return False
+        item = Item().load(file["itemId"], force=True, fields=["folderId"], exc=False)
+        if item is None:
+            return False
+        folderId = item["folderId"]
+        visited = set()
+        while folderId is not None and folderId not in visited:
+            visited.add(folderId)
+            with self._lock:
+                entry = self._pending.get(folderId)
+                if entry is not None:
+                    entry["deferred"].append(file["_id"])
+                    return True
+            folderId = self._parentOf(folderId)
+        return False
+
+    def _parentOf(self, folderId):
+        if folderId not in self._parents:
+            folder = Folder().load(
+                folderId, force=True, fields=["parentId", "parentCollection"]
+            )
+            self._parents[folderId] = (
+                folder["parentId"]
+                if folder and folder.get("parentCollection") == "folder"
+                else None
+            )
+        return self._parents[folderId]
+
+    def due(self):
+        return bool(self._pending) and (
+            time.monotonic() - self._lastActivity >= self.settle
+        )
+
+    def processDue(self, writer, resubmit):
+        """Ingest every pending DICOMDIR; ``resubmit`` gets each leftover file id."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._parents = {}
+        for folderId, entry in pending.items():
+            tagged = set()
+            try:
+                tagged = self.ingest(folderId, entry["fileId"], writer)
+            except Exception:
+                logger.exception("Failed to ingest DICOMDIR %s", entry["fileId"])
+            for fileId in entry["deferred"]:
+                if fileId not in tagged:
+                    resubmit(fileId)
+
+    def ingest(self, folderId, dicomDirId, writer):
+        """Tag the instances a DICOMDIR references; returns the tagged file ids."""
+        file = File().load(dicomDirId, force=True, exc=False)
+        folder = Folder().load(folderId, force=True, exc=False)
+        if file is None or folder is None:
+            return set()
+        maxBytes = int(_settings().get("dicom_dicomdir_max_bytes", DEFAULT_MAX_BYTES))
+        if (file.get("size") or 0) > maxBytes:
+            logger.info("DICOMDIR %s exceeds %d bytes; skipped", dicomDirId, maxBytes)
+            return set()
+        started = time.monotonic()
+        references = parseDicomDir(dicom._readRange(file, 0, file.get("size")))
+        byPath = subtreeFiles(folder)
+        resolved = [(byPath[path], tags) for path, tags in references if path in byPath]
+        fraction = len(resolved) / len(references) if references else 0.0
+        trusted = bool(references) and fraction >= self.minResolved
+        self.lastResult = {
+            "dicomDirId": dicomDirId,
+            "references": len(references),
+            "resolved": len(resolved),
+            "trusted": trusted,
+        }
+        if not trusted:
+            logger.info(
+                "DICOMDIR %s not trusted: %d of %d references resolved",
+                dicomDirId,
+                len(resolved),
+                len(references),
+            )
+            return set()
+        written = self._write(dicomDirId, resolved, writer.batchSize)
+        self.lastResult["tagged"] = written
+        self.lastResult["seconds"] = time.monotonic() - started
+        logger.info(
+            "DICOMDIR %s: tagged %d items from %d references in %.1fs",
+            dicomDirId,
+            written,
+            len(references),
+            self.lastResult["seconds"],
+        )
+        return {file["_id"] for file, _ in resolved}
+
+    def _write(self, dicomDirId, resolved, batchSize):
+        # Never overwrite tags a slice's own header already provided: they are
+        # at least as complete as the directory record.
+        now = datetime.datetime.utcnow()
+        itemTags = {}
+        for file, tags in resolved:
+            itemTags[file["itemId"]] = (tags, file.get("size"))
+        itemIds = list(itemTags)
+        written = 0
+        batches = []
+        for start in range(0, len(itemIds), batchSize):
+            batch = [
+                item["_id"]
+                for item in Item().find(
+                    {
+                        "_id": {"$in": itemIds[start : start + batchSize]},
+                        "meta.dicom": {"$exists": False},
+                    },
+                    fields=["_id"],
+                )
+            ]
+            if not batch:
+                continue
+            result = Item().collection.bulk_write(
+                [
+                    UpdateOne(
+                        {"_id": itemId, "meta.dicom": {"$exists": False}},
+                        {
+                            "$set": {
+                                "meta.dicom": itemTags[itemId][0],
+                                "volviewDicomDirId": dicomDirId,
+                                "updated": now,
+                            }
+                        },
+                    )
+                    for itemId in batch
+                ],
+                ordered=False,
+            )
+            written += result.modified_count
+            batches.append(batch)
+        fileIds = [file["_id"] for file, _ in resolved]
+        for start in range(0, len(fileIds), batchSize):
+            File().collection.update_many(
+                {
+                    "_id": {"$in": fileIds[start : start + batchSize]},
+                    "mimeType": {"$in": list(dicom.UPGRADABLE_MIME_TYPES)},
+                },
+                {"$set": {"mimeType": "application/dicom"}},
+            )
+        # Announced once the mimeTypes are written too: extensionless slices
+        # become loadable once typed application/dicom.
+        for batch in batches:
+            dicom.announceTagged({itemId: itemTags[itemId] for itemId in batch})
+        return written
+
+    def status(self):
+        with self._lock:
+            return {
+                "pending": len(self._pending),
+                "deferred": sum(len(e["deferred"]) for e in self._pending.values()),
+                "lastResult": self.lastResult,
+            }
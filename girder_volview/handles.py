@@ -44,6 +44,16 @@ def mintFileHandle(fileId, name):
     )
 
 
+def fileHandleTemplate():
+    """:func:`mintFileHandle` with ``{id}`` and ``{name}`` placeholders.
+
+    Substituting a file id and its percent-encoded name gives a handle
+    :func:`parseFileHandle` reads back to that file; the compact manifest
+    ships this once instead of a full handle per file.
+    """
+    return "/" + "/".join((getApiRoot(), "file", "{id}", "proxiable", "{name}"))
+
+
 def parseFileHandle(uri):
     """``(fileId, name)`` for a backend-minted load handle, or ``None``.
 
@@ -0,0 +1,430 @@
+"""Background DICOM tag extraction, off the ``model.file.save.after`` hot path.
+
+Every file save fires the event -- an assetstore import fires it once per slice,
+on the request thread that is running the import. Parsing inline there makes an
+import of 100k slices wait on 100k downloads + ``dcmread`` calls. The handler
+instead admits the file id to a bounded queue drained by a small pool of daemon
+worker threads, so the save returns at storage speed and ``meta.dicom`` lands
+shortly after.
+
+The queue is bounded so a runaway import cannot grow memory without limit. A
+full queue is backpressure, not loss: the handler parses that one file inline,
+exactly as it did before the queue existed.
+
+With ``dicomdir.isEnabled()``, a folder's saved DICOMDIR can stand in for the
+per-slice parse of the files under it; see ``dicomdir``.
+
+Workers hand their results to a shared ``DicomMetadataWriter``, which coalesces
+the per-file item-metadata and mimeType writes into ``bulk_write`` calls, and
+announces each batch with one ``volview.dicom.tagged`` event
+(``dicom.TAGGED_EVENT``). The per-series summaries of ``series``, the manifest
+cache and the loadable counts are kept current from that event.
+
+With ``dicom_parse_processes`` set, the parse itself -- queued or inline --
+runs on the ``parse_pool`` worker processes, and the worker thread count is
+raised to at least that many so every process can be kept busy.
+
+Tuned from the ``[volview]`` section of the Girder config::
+
+    dicom_ingest_workers = 2        # 0 parses inline on the request thread
+    dicom_parse_processes = 0       # >0 parses on that many processes
+    dicom_ingest_queue_size = 10000
+    dicom_write_batch_size = 100    # flush after this many items ...
+    dicom_write_interval_ms = 500   # ... or once the oldest write is this old
+"""
+
+import datetime
+import queue
+import threading
+import time
+
+from girder import events, logger
+from girder.models.file import File
+from girder.models.item import Item
+from girder.utility import config
+from pymongo import UpdateOne
+
+from . import (
+    dicom,
+    dicomdir,
+    parse_metrics,
+    parse_pool,
+    series,
+)
+
+DEFAULT_INGEST_WORKERS = 2
+DEFAULT_INGEST_QUEUE_SIZE = 10000
+DEFAULT_WRITE_BATCH_SIZE = 100
+DEFAULT_WRITE_INTERVAL_MS = 500
+
+
+class DicomMetadataWriter:
+    """Coalesce per-file DICOM metadata writes into bulk writes.
+
+    Written one file at a time, each slice costs an ``Item().load``, an
+    ``Item().setMetadata`` and, for a freshly imported file, a ``File().save``
+    -- three round trips per slice. The writer instead accumulates the parsed
+    tags per item (the newest slice's tags win, as they would have inline) and
+    the ids of files awaiting the ``application/dicom`` mimeType, then flushes
+    them as one ``Item`` ``bulk_write`` plus one ``File`` ``update_many`` every
+    ``batchSize`` items or once the oldest pending write is ``interval``
+    seconds old.
+
+    Like ``dicom.maybeUpgradeMimeType``'s ``triggerEvents=False`` save, the
+    bulk writes fire no model save events; each flush that writes tags
+    triggers one ``volview.dicom.tagged`` event for its items instead.
+
+    A summary of the writes saved is kept per burst of work: ``closeBurst``
+    (called by the ingest queue when it drains) logs it and starts a new one.
+    """
+
+    def __init__(
+        self,
+        batchSize=DEFAULT_WRITE_BATCH_SIZE,
+        interval=DEFAULT_WRITE_INTERVAL_MS / 1000.0,
+    ):
+        self.batchSize = max(1, batchSize)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._itemTags = {}
+        self._mimeFileIds = set()
+        self._oldest = None
+        self._burst = self._newBurst()
+        self.lastBurst = None
+
+    @staticmethod
+    def _newBurst():
+        return {"files": 0, "itemWrites": 0, "fileWrites": 0, "bulkWrites": 0}
+
+    def add(self, file, tags):
+        with self._lock:
+            self._itemTags[file["itemId"]] = (tags, file.get("size"))
+            if dicom.needsMimeTypeUpgrade(file):
+                self._mimeFileIds.add(file["_id"])
+            self._burst["files"] += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            due = len(self._itemTags) >= self.batchSize
+        if due:
+            self.flush()
+
+    def flushIfDue(self):
+        with self._lock:
+            due = (
+                self._oldest is not None
+                and time.monotonic() - self._oldest >= self.interval
+            )
+        if due:
+            self.flush()
+
+    def flush(self):
+        # Serialized so two workers crossing the batch threshold together
+        # cannot interleave their writes for the same item out of order.
+        with self._flushLock:
+            with self._lock:
+                itemTags, self._itemTags = self._itemTags, {}
+                fileIds, self._mimeFileIds = self._mimeFileIds, set()
+                self._oldest = None
+            bulkWrites = 0
+            started = time.perf_counter()
+            if itemTags:
+                now = datetime.datetime.utcnow()
+                Item().collection.bulk_write(
+                    [
+                        UpdateOne(
+                            {"_id": itemId},
+                            {"$set": {"meta.dicom": tags, "updated": now}},
+                        )
+                        for itemId, (tags, _) in itemTags.items()
+                    ],
+                    ordered=False,
+                )
+                bulkWrites += 1
+            if fileIds:
+                File().collection.update_many(
+                    {
+                        "_id": {"$in": list(fileIds)},
+                        "mimeType": {"$in": list(dicom.UPGRADABLE_MIME_TYPES)},
+                    },
+                    {"$set": {"mimeType": "application/dicom"}},
+                )
+                bulkWrites += 1
+            if bulkWrites:
+                parse_metrics.observe("write", time.perf_counter() - started)
+            if itemTags:
+                try:
+                    dicom.announceTagged(itemTags)
+                except Exception:
+                    # The writes have landed; never lose the burst accounting
+                    # over a listener.
+                    logger.exception("Failed to announce written DICOM tags")
+            with self._lock:
+                self._burst["itemWrites"] += len(itemTags)
+                self._burst["fileWrites"] += len(fileIds)
+                self._burst["bulkWrites"] += bulkWrites
+
+    def closeBurst(self):
+        """Flush, then log and retire the current burst's write summary."""
+        self.flush()
+        with self._lock:
+            burst, self._burst = self._burst, self._newBurst()
+        if not burst["files"]:
+            return None
+        # What the per-file path would have cost: a load + a setMetadata per
+        # file, plus a File().save per mimeType upgrade.
+        burst["singleWrites"] = 2 * burst["files"] + burst["fileWrites"]
+        burst["writesSaved"] = burst["singleWrites"] - burst["bulkWrites"]
+        self.lastBurst = burst
+        logger.info(
+            "DICOM ingest: %d files tagged with %d bulk writes (%d single writes "
+            "saved)",
+            burst["files"],
+            burst["bulkWrites"],
+            burst["writesSaved"],
+        )
+        return burst
+
+    def status(self):
+        with self._lock:
+            return {
+                "pending": len(self._itemTags) + len(self._mimeFileIds),
+                "currentBurst": dict(self._burst),
+                "lastBurst": self.lastBurst,
+            }
+
+
+class DicomIngestQueue:
+    """A bounded file-id queue drained by ``workers`` daemon threads.
+
+    Threads start lazily on the first submission, so a server that never saves
+    a file never spawns them. Counters are cumulative since process start and
+    are read by the admin status route.
+    """
+
+    def __init__(
+        self,
+        workers=DEFAULT_INGEST_WORKERS,
+        maxsize=DEFAULT_INGEST_QUEUE_SIZE,
+        writer=None,
+        dicomDirs=None,
+        parsePool=None,
+    ):
+        self.workers = workers
+        self.maxsize = maxsize
+        self.writer = writer if writer is not None else DicomMetadataWriter()
+        # A ``dicomdir.DicomDirRegistry`` when DICOMDIR ingest is enabled.
+        self.dicomDirs = dicomDirs
+        # A ``parse_pool.ParsePool`` to parse on, instead of in this process.
+        self.parsePool = parsePool
+        self.parse = parsePool.parse if parsePool is not None else None
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._inFlight = 0
+        self._processed = 0
+        self._failed = 0
+        self._overflowed = 0
+
+    def submit(self, fileId):
+        """Admit ``fileId``; ``False`` when the queue is full or disabled.
+
+        A ``False`` return tells the caller to parse inline.
+        """
+        if self.workers <= 0:
+            return False
+        self._ensureWorkers()
+        if self.dicomDirs is not None:
+            self.dicomDirs.touch()
+        try:
+            self._queue.put_nowait(fileId)
+        except queue.Full:
+            with self._lock:
+                self._overflowed += 1
+            return False
+        return True
+
+    def addDicomDir(self, file):
+        """Register a saved DICOMDIR; ``False`` when the queue is disabled."""
+        if self.workers <= 0 or self.dicomDirs is None:
+            return False
+        self._ensureWorkers()
+        self.dicomDirs.add(file)
+        return True
+
+    def join(self):
+        """Block until every admitted file id has been processed and written."""
+        self._queue.join()
+        self.writer.flush()
+
+    def status(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "parseProcesses": (
+                    self.parsePool.processes if self.parsePool is not None else 0
+                ),
+                "capacity": self.maxsize,
+                "queued": self._queue.qsize(),
+                "inFlight": self._inFlight,
+                "processed": self._processed,
+                "failed": self._failed,
+                "overflowed": self._overflowed,
+                "writes": self.writer.status(),
+                "dicomdir": (
+                    self.dicomDirs.status() if self.dicomDirs is not None else None
+                ),
+            }
+
+    def _ensureWorkers(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name="volview-dicom-ingest-%d" % len(self._threads),
+                    daemon=True,
+                )
+                self._threads.append(thread)
+                thread.start()
+
+    def _work(self):
+        while True:
+            try:
+                fileId = self._queue.get(timeout=self.writer.interval)
+            except queue.Empty:
+                self._landWrites(idle=True)
+                continue
+            with self._lock:
+                self._inFlight += 1
+            try:
+                self._process(fileId)
+                succeeded = True
+            except Exception:
+                logger.exception("Failed to extract DICOM tags for file %s", fileId)
+                succeeded = False
+            finally:
+                with self._lock:
+                    self._inFlight -= 1
+                    if succeeded:
+                        self._processed += 1
+                    else:
+                        self._failed += 1
+                self._queue.task_done()
+            self._landWrites(idle=False)
+
+    def _landWrites(self, idle):
+        # An idle worker lands whatever is pending; a drained queue also ends
+        # the burst, which logs the import's write summary.
+        try:
+            if idle and self._queue.unfinished_tasks == 0:
+                if self.dicomDirs is not None and self.dicomDirs.due():
+                    self.dicomDirs.processDue(self.writer, self._resubmit)
+                self.writer.closeBurst()
+            else:
+                self.writer.flushIfDue()
+        except Exception:
+            logger.exception("Failed to write batched DICOM metadata")
+
+    def _process(self, fileId):
+        # Reloaded rather than carried on the queue: the saved document can be
+        # updated (size, mimeType) between the event and the parse. A file
+        # deleted in that window is simply skipped.
+        file = File().load(fileId, force=True, exc=False)
+        if file is None:
+            return
+        if self.dicomDirs is not None and self.dicomDirs.defer(file):
+            return
+        dicom.addDicomTagsToItemMetadata(file, writer=self.writer, parse=self.parse)
+
+    def _resubmit(self, fileId):
+        # A file a DICOMDIR deferred but did not tag gets the per-slice parse.
+        if not self.submit(fileId):
+            file = File().load(fileId, force=True, exc=False)
+            if file is not None:
+                dicom.addDicomTagsToItemMetadata(
+                    file, writer=self.writer, parse=self.parse
+                )
+
+
+_ingestQueue = None
+_ingestQueueLock = threading.Lock()
+
+
+def ingestQueue():
+    """The process-wide ingest queue, sized from the ``[volview]`` config."""
+    global _ingestQueue
+    if _ingestQueue is None:
+        with _ingestQueueLock:
+            if _ingestQueue is None:
+                settings = config.getConfig().get("volview", {})
+                writer = DicomMetadataWriter(
+                    batchSize=int(
+                        settings.get("dicom_write_batch_size", DEFAULT_WRITE_BATCH_SIZE)
+                    ),
+                    interval=float(
+                        settings.get(
+                            "dicom_write_interval_ms", DEFAULT_WRITE_INTERVAL_MS
+                        )
+                    )
+                    / 1000.0,
+                )
+                workers = int(
+                    settings.get("dicom_ingest_workers", DEFAULT_INGEST_WORKERS)
+                )
+                parsePool = parse_pool.sharedPool()
+                if parsePool is not None and workers > 0:
+                    workers = max(workers, parsePool.processes)
+                _ingestQueue = DicomIngestQueue(
+                    workers=workers,
+                    maxsize=int(
+                        settings.get(
+                            "dicom_ingest_queue_size", DEFAULT_INGEST_QUEUE_SIZE
+                        )
+                    ),
+                    writer=writer,
+                    dicomDirs=(
+                        dicomdir.DicomDirRegistry.fromConfig()
+                        if dicomdir.isEnabled()
+                        else None
+                    ),
+                    parsePool=parsePool,
+                )
+    return _ingestQueue
+
+
+def isIngestCandidate(file):
+    """Cheap admission check: could this saved file carry DICOM tags at all?
+
+    Mirrors the early returns of ``dicom.addDicomTagsToItemMetadata`` /
+    ``dicom._parseFile`` so link files, item-less attachments and DICOMDIR
+    indexes never occupy a queue slot.
+    """
+    if file.get("itemId") is None or "linkUrl" in file:
+        return False
+    return file.get("name", "").upper() != "DICOMDIR"
+
+
+def handleFileSave(event):
+    file = event.info
+    if (
+        dicomdir.isDicomDir(file)
+        and file.get("itemId") is not None
+        and dicomdir.isEnabled()
+    ):
+        ingestQueue().addDicomDir(file)
+        return
+    if not isIngestCandidate(file):
+        return
+    ingest = ingestQueue()
+    if not ingest.submit(file["_id"]):
+        dicom.addDicomTagsToItemMetadata(file, parse=ingest.parse)
+
+
+def setupEventHandlers():
+    events.bind("model.file.save.after", "girder_volview", handleFileSave)
+    events.bind(dicom.TAGGED_EVENT, "girder_volview", series.handleDicomTagged)
+    events.bind("model.item.save.after", "girder_volview", series.handleItemSaved)
+    events.bind("model.item.remove", "girder_volview", series.handleItemRemove)
+    events.bind("model.folder.remove", "girder_volview", series.handleFolderRemove)
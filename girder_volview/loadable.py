@@ -0,0 +1,685 @@
+"""Denormalized counts of the files VolView opens, per item and folder.
+
+Answering "does anything under this folder open in VolView?" from the files
+themselves means scanning the subtree, and the scan is longest exactly when
+the answer is no. ``volview_loadable`` keeps one document per item and per
+counted folder instead::
+
+    {_id: <item or folder id>, kind: "item" | "folder", count: <files>,
+     folderId / parentId: <the parent folder the count was added to>}
+
+An item's count is the number of its files ``utils.loadableFileMatch`` accepts,
+recomputed whenever one of its files is saved or removed, the item is saved
+(moves, the transient marker, ``largeImage``) or its DICOM tags are written.
+Those events only queue the item, in ``volview_loadable_pending``:
+``RecountQueue`` recounts the queued items together shortly after, so an upload
+or a folder delete costs one aggregation per batch rather than one per file.
+Queued recounts are stored rather than held in memory, so one queued by a
+process that exits before its batch runs is not lost, and every reader drains
+the whole collection -- whichever process queued them -- before it reads a
+count. The change in an item's count is added to every counted folder above
+it. A folder's count is its subtree's total. It is taken the first time it is
+asked for, and moves with the folder; a folder moved before it was ever counted
+has its subtree's count carried from its old ancestors to its new ones by the
+queue, not on the request thread.
+
+The counts live in their own collection, not on the item and folder documents,
+because Girder saves whole documents: a save of a stale copy would otherwise
+write back an old count over newer increments.
+
+Counts are not access-controlled, like a folder's ``size``: a positive folder
+count says some file opens for somebody, so callers still check what the
+requesting user can read. A folder's document is stored, marked ``counting``,
+before its first count is taken, so changes made during the scan are added to
+it; a scan that overlapped any change is retaken. Deleting a folder's document
+has it counted again.
+"""
+
+import threading
+import time
+
+from bson.objectid import ObjectId
+from girder import events, logger
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.model_base import Model
+from girder.utility import config
+from pymongo import ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError
+
+from .dicom import TAGGED_EVENT
+from .utils import (
+    JOB_OUTPUT_FOLDER_META_KEY,
+    folderHasLoadableFile,
+    loadableFileMatch,
+    loadableFolderIds,
+    loadableItemIds,
+)
+
+# Ids per ``$in`` when counting a large subtree.
+_CHUNK = 1000
+
+# How long queued recounts wait to be batched together.
+DEFAULT_RECOUNT_INTERVAL_MS = 250
+
+# Scans of a folder's first count before one that overlapped changes is kept
+# out of the collection.
+_COUNT_ATTEMPTS = 3
+
+
+class LoadableCount(Model):
+    def initialize(self):
+        self.name = "volview_loadable"
+
+    def validate(self, doc):
+        return doc
+
+
+class PendingRecount(Model):
+    """Queued recounts: an item to recount, or a folder move to carry over.
+
+    ``{_id: <item id>, kind: "item", queued: <token>, excludeFileIds: [...]}``
+    or ``{_id: <folder id>, kind: "move", token, fromId, toId}``.
+    """
+
+    def initialize(self):
+        self.name = "volview_loadable_pending"
+
+    def validate(self, doc):
+        return doc
+
+
+def _countFiles(itemIds, excludeFileIds=()):
+    """item id -> number of its files VolView opens, for items that have any."""
+    pipeline = [
+        {"$match": {"_id": {"$in": list(itemIds)}}},
+        {
+            "$lookup": {
+                "from": "folder",
+                "localField": "folderId",
+                "foreignField": "_id",
+                "as": "folder",
+            }
+        },
+        {"$unwind": {"path": "$folder", "preserveNullAndEmptyArrays": True}},
+        {
+            "$lookup": {
+                "from": "file",
+                "localField": "_id",
+                "foreignField": "itemId",
+                "as": "file",
+            }
+        },
+        {"$unwind": "$file"},
+    ]
+    if excludeFileIds:
+        # A file being removed is still stored when its event fires.
+        pipeline.append({"$match": {"file._id": {"$nin": list(excludeFileIds)}}})
+    pipeline += [
+        {"$match": loadableFileMatch(folderPrefix="folder.", itemPrefix="")},
+        {"$group": {"_id": "$_id", "count": {"$sum": 1}}},
+    ]
+    return {doc["_id"]: doc["count"] for doc in Item().collection.aggregate(pipeline)}
+
+
+def _ancestorIds(folderId):
+    """``folderId`` and the ids of the folders above it, in one query."""
+    if folderId is None:
+        return []
+    pipeline = [
+        {"$match": {"_id": folderId}},
+        {
+            "$graphLookup": {
+                "from": "folder",
+                "startWith": "$parentId",
+                "connectFromField": "parentId",
+                "connectToField": "_id",
+                "as": "ancestors",
+            }
+        },
+        {"$project": {"ancestors._id": True}},
+    ]
+    ids = []
+    for doc in Folder().collection.aggregate(pipeline):
+        ids.append(doc["_id"])
+        ids.extend(ancestor["_id"] for ancestor in doc["ancestors"])
+    return ids
+
+
+def _addToFolders(deltas):
+    """Apply ``{folderId: delta}`` to each folder and the counted folders above."""
+    collection = LoadableCount().collection
+    for folderId, delta in deltas.items():
+        if delta:
+            # ``changes`` tells a first count in progress that it overlapped one.
+            collection.update_many(
+                {"_id": {"$in": _ancestorIds(folderId)}, "kind": "folder"},
+                {"$inc": {"count": delta, "changes": 1}},
+            )
+
+
+def recountItems(itemIds, excludeFileIds=()):
+    """Recompute the items' counts and pass the changes up their folders."""
+    itemIds = list(itemIds)
+    if not itemIds:
+        return
+    counts = _countFiles(itemIds, excludeFileIds)
+    collection = LoadableCount().collection
+    deltas = {}
+    for item in Item().find({"_id": {"$in": itemIds}}, fields=["folderId"]):
+        count = counts.get(item["_id"], 0)
+        previous = collection.find_one_and_update(
+            {"_id": item["_id"]},
+            {"$set": {"kind": "item", "count": count, "folderId": item["folderId"]}},
+            upsert=True,
+            return_document=ReturnDocument.BEFORE,
+        )
+        if previous is not None and previous["folderId"] != item["folderId"]:
+            # Moved: the old folders lose what they had counted.
+            deltas[previous["folderId"]] = (
+                deltas.get(previous["folderId"], 0) - previous["count"]
+            )
+            previous = None
+        change = count - (previous["count"] if previous else 0)
+        deltas[item["folderId"]] = deltas.get(item["folderId"], 0) + change
+    _addToFolders(deltas)
+
+
+class RecountQueue:
+    """Coalesce the item recounts that model events ask for.
+
+    A recount is an aggregation over the item's files, then a ``$graphLookup``
+    and an ``update_many`` per folder whose count changed; run inline, every
+    file and item save would pay for them on the request thread. The queue
+    instead stores the item ids, with the ids of any of their files being
+    removed, in ``PendingRecount``, and a background thread recounts them in
+    batches once the oldest is ``interval`` seconds old. An ``interval`` of 0
+    recounts inline.
+
+    Readers of the counts ``flush`` first, draining every stored recount, so a
+    request sees the changes any process has queued.
+    """
+
+    def __init__(self, interval=DEFAULT_RECOUNT_INTERVAL_MS / 1000.0):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._flushLock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def add(self, itemIds, excludeFileIds=()):
+        itemIds = list(itemIds)
+        if self.interval <= 0:
+            recountItems(itemIds, excludeFileIds)
+            return
+        if not itemIds:
+            return
+        # A recount queued again before its batch lands stays for the next one.
+        token = ObjectId()
+        PendingRecount().collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": itemId},
+                    {
+                        "$set": {"kind": "item", "queued": token},
+                        "$addToSet": {
+                            "excludeFileIds": {"$each": list(excludeFileIds)}
+                        },
+                    },
+                    upsert=True,
+                )
+                for itemId in itemIds
+            ],
+            ordered=False,
+        )
+        self._start()
+
+    def addMove(self, entry):
+        """Queue a ``_queueMove`` entry, carrying a folder's count over."""
+        if self.interval <= 0:
+            _settleMove(entry)
+            return
+        PendingRecount().collection.replace_one(
+            {"_id": entry["_id"]}, entry, upsert=True
+        )
+        self._start()
+
+    def flush(self):
+        with self._flushLock:
+            collection = PendingRecount().collection
+            for chunk in _chunks(collection.find({"kind": "item"})):
+                excluded = set().union(
+                    *(doc.get("excludeFileIds", ()) for doc in chunk)
+                )
+                recountItems([doc["_id"] for doc in chunk], excluded)
+                collection.delete_many(
+                    {
+                        "$or": [
+                            {"_id": doc["_id"], "queued": doc["queued"]}
+                            for doc in chunk
+                        ]
+                    }
+                )
+            for entry in list(collection.find({"kind": "move"})):
+                _settleMove(entry)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._work, name="volview-loadable-recount", daemon=True
+                )
+                self._thread.start()
+        self._wake.set()
+
+    def _work(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Failed to update volview loadable counts")
+
+
+_recountQueue = None
+_recountQueueLock = threading.Lock()
+
+
+def recountQueue():
+    """The process-wide recount queue, timed from the ``[volview]`` config."""
+    global _recountQueue
+    if _recountQueue is None:
+        with _recountQueueLock:
+            if _recountQueue is None:
+                settings = config.getConfig().get("volview", {})
+                _recountQueue = RecountQueue(
+                    interval=float(
+                        settings.get(
+                            "loadable_recount_interval_ms",
+                            DEFAULT_RECOUNT_INTERVAL_MS,
+                        )
+                    )
+                    / 1000.0
+                )
+    return _recountQueue
+
+
+def itemLoadableCount(item):
+    """An indexed read of ``item``'s count, counting it the first time."""
+    recountQueue().flush()
+    doc = LoadableCount().collection.find_one({"_id": item["_id"]})
+    if doc is None:
+        recountItems([item["_id"]])
+        doc = LoadableCount().collection.find_one({"_id": item["_id"]}) or {}
+    return doc.get("count", 0)
+
+
+def knownFolderCounts(folderIds):
+    """folder id -> count, for the folders among ``folderIds`` already counted."""
+    recountQueue().flush()
+    return {
+        doc["_id"]: doc["count"]
+        for doc in LoadableCount().collection.find(
+            {
+                "_id": {"$in": list(folderIds)},
+                "kind": "folder",
+                "counting": {"$exists": False},
+            }
+        )
+    }
+
+
+def _subtreeFolderIds(folderId):
+    pipeline = [
+        {"$match": {"_id": folderId}},
+        {
+            "$graphLookup": {
+                "from": "folder",
+                "startWith": "$_id",
+                "connectFromField": "_id",
+                "connectToField": "parentId",
+                "as": "folders",
+                "restrictSearchWithMatch": {"parentCollection": "folder"},
+            }
+        },
+        {"$project": {"folders._id": True}},
+    ]
+    ids = []
+    for doc in Folder().collection.aggregate(pipeline):
+        ids.append(doc["_id"])
+        ids.extend(folder["_id"] for folder in doc["folders"])
+    return ids
+
+
+def folderLoadableCount(folder):
+    """An indexed read of ``folder``'s count, counting its subtree the first time.
+
+    The document is stored at zero, marked ``counting``, before the scan, so a
+    change made during it is added to the document rather than lost. Since the
+    scan may also have seen that change, the count is only kept when no change
+    came in; otherwise it is taken again, and after ``_COUNT_ATTEMPTS`` the
+    scanned total is answered without being kept.
+    """
+    recountQueue().flush()
+    collection = LoadableCount().collection
+    for _ in range(_COUNT_ATTEMPTS):
+        doc = collection.find_one({"_id": folder["_id"]})
+        if doc is not None and "counting" not in doc:
+            return doc["count"]
+        token = ObjectId()
+        try:
+            collection.update_one(
+                # A queued move's document is settled by the queue alone.
+                {
+                    "_id": folder["_id"],
+                    "counting": {"$exists": True},
+                    "moving": {"$exists": False},
+                },
+                {
+                    "$set": {
+                        "kind": "folder",
+                        "count": 0,
+                        "changes": 0,
+                        "parentId": _parentFolderId(folder),
+                        "counting": token,
+                    }
+                },
+                upsert=True,
+            )
+        except DuplicateKeyError:
+            # Counted, or its move settled, meanwhile.
+            continue
+        total = _scanSubtree(folder["_id"])
+        kept = collection.find_one_and_update(
+            {"_id": folder["_id"], "counting": token, "changes": 0},
+            {"$set": {"count": total}, "$unset": {"counting": ""}},
+        )
+        if kept is not None:
+            return total
+    return _scanSubtree(folder["_id"])
+
+
+def _scanSubtree(folderId):
+    """The total of the counts of the items under ``folderId``."""
+    total = 0
+    for folderIds in _chunks(_subtreeFolderIds(folderId)):
+        items = Item().find({"folderId": {"$in": folderIds}}, fields=["folderId"])
+        for chunk in _chunks(items):
+            total += _countChunk(chunk)
+    return total
+
+
+def _queueMove(folder, toId):
+    """Queue carrying ``folder``'s subtree count over to parent ``toId``.
+
+    The folder's document is stored first, at zero and marked ``moving``, so
+    every change made under it until the move is settled is added to it as
+    well as to its new ancestors. ``False`` if the folder already has a
+    document.
+    """
+    token = ObjectId()
+    fromId = _parentFolderId(folder)
+    try:
+        LoadableCount().collection.insert_one(
+            {
+                "_id": folder["_id"],
+                "kind": "folder",
+                "count": 0,
+                "changes": 0,
+                "parentId": fromId,
+                "counting": token,
+                "moving": True,
+            }
+        )
+    except DuplicateKeyError:
+        return False
+    recountQueue().addMove(
+        {
+            "_id": folder["_id"],
+            "kind": "move",
+            "token": token,
+            "fromId": fromId,
+            "toId": toId,
+        }
+    )
+    return True
+
+
+def _settleMove(entry):
+    """Move a queued folder's subtree count from its old ancestors to its new.
+
+    The scanned total less what was added to the folder's document since the
+    move is what the old ancestors counted at the move, and what the new ones
+    still lack. As in ``folderLoadableCount``, a scan that overlapped a change
+    is taken again; after ``_COUNT_ATTEMPTS`` the move stays queued.
+    """
+    collection = LoadableCount().collection
+    for _ in range(_COUNT_ATTEMPTS):
+        doc = collection.find_one({"_id": entry["_id"], "counting": entry["token"]})
+        if doc is None:
+            # Settled by another process, or the folder was removed.
+            break
+        total = _scanSubtree(entry["_id"])
+        kept = collection.find_one_and_update(
+            {
+                "_id": entry["_id"],
+                "counting": entry["token"],
+                "changes": doc["changes"],
+            },
+            {
+                "$set": {"count": total, "parentId": entry["toId"]},
+                "$unset": {"counting": "", "moving": ""},
+            },
+        )
+        if kept is not None:
+            moved = total - doc["count"]
+            _addToFolders({entry["fromId"]: -moved})
+            _addToFolders({entry["toId"]: moved})
+            break
+    else:
+        return
+    PendingRecount().collection.delete_one(
+        {"_id": entry["_id"], "token": entry["token"]}
+    )
+
+
+def _chunks(docs):
+    """``docs`` in lists of up to ``_CHUNK``, so a large subtree streams."""
+    chunk = []
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) == _CHUNK:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _countChunk(items):
+    """Sum the items' counts, counting and storing those not yet counted."""
+    collection = LoadableCount().collection
+    known = {
+        doc["_id"]: doc["count"]
+        for doc in collection.find({"_id": {"$in": [item["_id"] for item in items]}})
+    }
+    missing = [item for item in items if item["_id"] not in known]
+    if missing:
+        counts = _countFiles([item["_id"] for item in missing])
+        collection.bulk_write(
+            [
+                UpdateOne(
+                    {"_id": item["_id"]},
+                    {
+                        "$setOnInsert": {
+                            "kind": "item",
+                            "count": counts.get(item["_id"], 0),
+                            "folderId": item["folderId"],
+                        }
+                    },
+                    upsert=True,
+                )
+                for item in missing
+            ],
+            ordered=False,
+        )
+        known.update(counts)
+    return sum(known.values())
+
+
+def _parentFolderId(folder):
+    if folder.get("parentCollection") == "folder":
+        return folder.get("parentId")
+    return None
+
+
+# Folder changes seen before the write, for the handler after it: the stored
+# document is gone by then.
+_pendingFolders = threading.local()
+
+
+def _jobOutput(folder):
+    return bool((folder.get("meta") or {}).get(JOB_OUTPUT_FOLDER_META_KEY))
+
+
+def _handleFolderSaving(event):
+    folder = event.info
+    if "_id" not in folder:
+        return
+    stored = Folder().load(
+        folder["_id"],
+        force=True,
+        fields=["parentId", "parentCollection", "meta.%s" % JOB_OUTPUT_FOLDER_META_KEY],
+        exc=False,
+    )
+    if stored is None:
+        return
+    moved = _parentFolderId(stored) != _parentFolderId(folder)
+    if moved and not _queueMove(stored, _parentFolderId(folder)):
+        # Counted, or being counted: finish the count under its old parent so
+        # the saved handler can move it.
+        folderLoadableCount(stored)
+    if _jobOutput(stored) != _jobOutput(folder):
+        pending = getattr(_pendingFolders, "remarked", set())
+        pending.add(folder["_id"])
+        _pendingFolders.remarked = pending
+
+
+def _handleFolderSaved(event):
+    folder = event.info
+    pending = getattr(_pendingFolders, "remarked", set())
+    if folder["_id"] in pending:
+        pending.discard(folder["_id"])
+        # The job-output marker decides whether the folder's own items count.
+        items = Item().find({"folderId": folder["_id"]}, fields=["_id"])
+        for chunk in _chunks(items):
+            recountItems([item["_id"] for item in chunk])
+    parentId = _parentFolderId(folder)
+    previous = LoadableCount().collection.find_one_and_update(
+        {"_id": folder["_id"], "kind": "folder", "counting": {"$exists": False}},
+        {"$set": {"parentId": parentId}},
+    )
+    if previous is not None and previous["parentId"] != parentId:
+        _addToFolders({previous["parentId"]: -previous["count"]})
+        _addToFolders({parentId: previous["count"]})
+
+
+def _handleFolderRemove(event):
+    # Its contents were removed (and subtracted) before this fires.
+    LoadableCount().collection.delete_one({"_id": event.info["_id"]})
+    PendingRecount().collection.delete_one({"_id": event.info["_id"]})
+
+
+def _handleItemSaved(event):
+    recountQueue().add([event.info["_id"]])
+
+
+def _handleItemRemove(event):
+    previous = LoadableCount().collection.find_one_and_delete(
+        {"_id": event.info["_id"]}
+    )
+    if previous is not None:
+        _addToFolders({previous["folderId"]: -previous["count"]})
+
+
+def _handleFileSaved(event):
+    if event.info.get("itemId") is not None:
+        recountQueue().add([event.info["itemId"]])
+
+
+def _handleFileRemove(event):
+    if event.info.get("itemId") is not None:
+        recountQueue().add([event.info["itemId"]], excludeFileIds=[event.info["_id"]])
+
+
+def _guarded(handler):
+    def guarded(event):
+        try:
+            handler(event)
+        except Exception:
+            # Derived data: never fail the save or remove over it.
+            logger.exception("Failed to update volview loadable counts")
+
+    return guarded
+
+
+def _handleDicomTagged(event):
+    # A DICOM slide-microscopy Modality makes a slice unloadable, and an
+    # extensionless slice becomes loadable once typed application/dicom.
+    recountQueue().add(event.info["itemIds"])
+
+
+def setupEventHandlers():
+    for name, handler in (
+        ("model.file.save.after", _handleFileSaved),
+        ("model.file.remove", _handleFileRemove),
+        ("model.item.save.after", _handleItemSaved),
+        ("model.item.remove", _handleItemRemove),
+        ("model.folder.save", _handleFolderSaving),
+        ("model.folder.save.after", _handleFolderSaved),
+        ("model.folder.remove", _handleFolderRemove),
+        (TAGGED_EVENT, _handleDicomTagged),
+    ):
+        events.bind(name, "girder_volview.loadable", _guarded(handler))
+
+
+def isLoadableItem(item):
+    """Whether ``item`` holds a file VolView opens: an indexed read."""
+    return itemLoadableCount(item) > 0
+
+
+def isLoadableFolder(folder, user=None):
+    """Whether ``folder`` holds a file ``user`` can read that VolView opens.
+
+    A zero count answers at once; that is the case a subtree scan takes
+    longest to rule out. Otherwise the user's access decides, and the scan
+    stops at its first loadable file.
+    """
+    if folderLoadableCount(folder) == 0:
+        return False
+    if user is not None and user.get("admin"):
+        return True
+    return folderHasLoadableFile(folder, user)
+
+
+def loadableIds(folderIds, itemIds, user=None):
+    """The readable, loadable ids among ``folderIds`` and ``itemIds``.
+
+    Resources already counted at zero are ruled out without a scan; the rest
+    go through one folder and one item aggregation.
+    """
+    recountQueue().flush()
+    counted = {
+        doc["_id"]: doc["count"]
+        for doc in LoadableCount().collection.find(
+            {
+                "_id": {"$in": list(folderIds) + list(itemIds)},
+                "counting": {"$exists": False},
+            }
+        )
+    }
+    return (
+        loadableFolderIds([id for id in folderIds if counted.get(id) != 0], user),
+        loadableItemIds([id for id in itemIds if counted.get(id) != 0], user),
+    )
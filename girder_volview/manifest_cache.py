@@ -0,0 +1,480 @@
+"""In-memory cache of computed launch manifests.
+
+Every open and every F5 of ``GET folder/:id/volview`` / ``GET item/:id/volview``
+re-lists the files under the resource, re-runs the loadability checks and
+re-resolves the session to resume. The result only changes when something
+beneath the resource does, so manifests are cached per (resource, gesture
+parameters, caller's ACL fingerprint) and dropped when Girder model events
+report a change to an item, file or folder at or below any resource an entry
+was built from. An entry is found from a changed document by walking its
+folder ancestry; the walk is skipped while no cached entry lives in the
+document's collection or user tree.
+
+Writes that bypass model events invalidate explicitly: DICOM tag writes
+through their ``volview.dicom.tagged`` event, others through
+``invalidateItems`` and ``invalidateFolders``. Other out-of-band changes --
+direct database edits, descendants' ACLs rewritten by a recursive
+``setAccessList`` -- are bounded by the entry TTL.
+
+Each server process has its own cache, and sees only its own process's
+events. So that a change made through one process reaches the others, every
+change also increments a counter per tree (``baseParentId``) in the
+``volview_manifest_generation`` collection (``SharedGenerations``). An entry
+records its trees' counters from before it was computed, and a hit is only
+served while they are unchanged: one small indexed read, where the manifest
+would cost a listing.
+
+Tuned from the ``[volview]`` section of the Girder config::
+
+    manifest_cache_size = 1000      # entries; 0 disables the cache
+    manifest_cache_ttl = 300        # seconds
+"""
+
+import collections
+import copy
+import json
+import threading
+import time
+
+from girder import events
+from girder.models.folder import Folder
+from girder.models.item import Item
+from girder.models.model_base import Model
+from girder.utility import config
+from pymongo import UpdateOne
+
+from .dicom import TAGGED_EVENT
+
+DEFAULT_CACHE_SIZE = 1000
+DEFAULT_CACHE_TTL = 300
+# Folder nesting deeper than this is not walked for invalidation.
+_MAX_DEPTH = 256
+_MAX_PARENTS = 65536
+# Shared counters of changes in any tree, and of changes whose tree is unknown.
+_ANY_ROOT = "*"
+_UNKNOWN_ROOT = "?"
+
+
+class ManifestGeneration(Model):
+    def initialize(self):
+        self.name = "volview_manifest_generation"
+
+    def validate(self, doc):
+        return doc
+
+
+def _rootSet(roots):
+    return frozenset(roots) if roots is not None else frozenset([None])
+
+
+class SharedGenerations:
+    """Change counters per tree, shared by every server process through Mongo.
+
+    ``bump`` counts a change under each of ``roots`` (``None`` for a change
+    whose tree is unknown), and under ``_ANY_ROOT``. ``read`` answers the
+    counters an entry built from ``roots`` depends on (``None`` there for an
+    entry that may span any tree).
+    """
+
+    def read(self, roots):
+        ids = sorted(
+            {_UNKNOWN_ROOT}
+            | {_ANY_ROOT if root is None else str(root) for root in roots}
+        )
+        counts = {
+            doc["_id"]: doc["generation"]
+            for doc in ManifestGeneration().collection.find({"_id": {"$in": ids}})
+        }
+        return tuple(counts.get(id, 0) for id in ids)
+
+    def bump(self, roots):
+        ids = {_ANY_ROOT} | {
+            _UNKNOWN_ROOT if root is None else str(root) for root in roots
+        }
+        ManifestGeneration().collection.bulk_write(
+            [
+                UpdateOne({"_id": id}, {"$inc": {"generation": 1}}, upsert=True)
+                for id in sorted(ids)
+            ],
+            ordered=False,
+        )
+
+
+class ManifestCache:
+    def __init__(
+        self, maxEntries=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, shared=None
+    ):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        # A ``SharedGenerations``, to see changes made in other processes.
+        self.shared = shared
+        self._lock = threading.Lock()
+        # key -> (expires, manifest, scopes, roots, shared counters), least
+        # recently used first
+        self._entries = collections.OrderedDict()
+        self._byScope = {}
+        # baseParentId -> entries built under it; a ``None`` root means the
+        # entry may span any tree.
+        self._roots = collections.Counter()
+        # folder id -> (parentId or None), for ancestry walks
+        self._parents = {}
+        self._counters = {"hits": 0, "misses": 0, "invalidated": 0, "expired": 0}
+        # Bumped by every invalidation. A manifest computed across one may be
+        # stale, so ``put`` refuses it.
+        self.generation = 0
+        self._computing = 0
+
+    def idle(self):
+        """No entries and none being computed: no change can matter."""
+        return not self._entries and not self._computing
+
+    def begin(self):
+        """Mark a manifest computation started; returns the ``generation``."""
+        with self._lock:
+            self._computing += 1
+            return self.generation
+
+    def end(self):
+        with self._lock:
+            self._computing -= 1
+
+    def get(self, key):
+        """A copy of the cached manifest for ``key``, or ``None``."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                self._counters["expired"] += 1
+                entry = None
+        if entry is not None and self.shared is not None:
+            if self.shared.read(entry[3]) != entry[4]:
+                # Changed through another process.
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        self._drop(key)
+                        self._counters["invalidated"] += 1
+                entry = None
+        with self._lock:
+            if entry is None or self._entries.get(key) is not entry:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._counters["hits"] += 1
+            return copy.deepcopy(entry[1])
+
+    def sharedGeneration(self, roots):
+        """The shared counters an entry built from ``roots`` depends on, read
+        before it is computed; ``None`` without shared counters."""
+        if self.shared is None or self.maxEntries <= 0:
+            return None
+        return self.shared.read(_rootSet(roots))
+
+    def changed(self, roots):
+        """Count a change under ``roots`` for every process's cache."""
+        if self.shared is not None and self.maxEntries > 0:
+            self.shared.bump(roots)
+
+    def put(self, key, manifest, scopes, roots, generation, shared=None):
+        """Cache ``manifest``, to be dropped when any id in ``scopes`` changes.
+
+        ``roots`` are the ``baseParentId`` values of the scoped resources, or
+        ``None`` when they are not all known. ``generation`` is the cache's
+        ``generation``, and ``shared`` its ``sharedGeneration``, from before
+        the manifest was computed.
+        """
+        if self.maxEntries <= 0:
+            return
+        scopes = frozenset(str(scope) for scope in scopes)
+        roots = _rootSet(roots)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (
+                time.monotonic() + self.ttl,
+                copy.deepcopy(manifest),
+                scopes,
+                roots,
+                shared,
+            )
+            for scope in scopes:
+                self._byScope.setdefault(scope, set()).add(key)
+            self._roots.update(roots)
+            while len(self._entries) > self.maxEntries:
+                self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        _, _, scopes, roots, _ = self._entries.pop(key)
+        for scope in scopes:
+            keys = self._byScope.get(scope)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._byScope[scope]
+        self._roots.subtract(roots)
+        self._roots += collections.Counter()
+
+    def covers(self, baseParentId):
+        """Whether a change under ``baseParentId`` could affect an entry."""
+        with self._lock:
+            # A computation in flight may span any tree.
+            return bool(
+                self._computing or self._roots[None] or self._roots[baseParentId]
+            )
+
+    def invalidate(self, ids):
+        with self._lock:
+            keys = set()
+            for scope in ids:
+                keys.update(self._byScope.get(str(scope), ()))
+            for key in keys:
+                self._drop(key)
+            self._counters["invalidated"] += len(keys)
+            self.generation += 1
+
+    def forgetFolder(self, folderId):
+        with self._lock:
+            self._parents.pop(folderId, None)
+
+    def ancestors(self, folderId):
+        """``folderId`` and the ids of the folders above it."""
+        ids = []
+        while folderId is not None and len(ids) < _MAX_DEPTH:
+            ids.append(folderId)
+            with self._lock:
+                known = folderId in self._parents
+                parentId = self._parents.get(folderId)
+            if not known:
+                folder = Folder().load(
+                    folderId,
+                    force=True,
+                    fields=["parentId", "parentCollection"],
+                    exc=False,
+                )
+                parentId = None
+                if folder is not None and folder.get("parentCollection") == "folder":
+                    parentId = folder.get("parentId")
+                with self._lock:
+                    if len(self._parents) >= _MAX_PARENTS:
+                        self._parents.clear()
+                    self._parents[folderId] = parentId
+            folderId = parentId
+        return ids
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._byScope.clear()
+            self._roots.clear()
+            self._parents.clear()
+
+    def status(self):
+        with self._lock:
+            counters = dict(self._counters)
+            counters["entries"] = len(self._entries)
+        counters["maxEntries"] = self.maxEntries
+        counters["ttl"] = self.ttl
+        lookups = counters["hits"] + counters["misses"]
+        counters["hitRate"] = counters["hits"] / lookups if lookups else None
+        return counters
+
+
+_manifestCache = None
+_manifestCacheLock = threading.Lock()
+
+
+def manifestCache():
+    """The process-wide manifest cache, sized from the ``[volview]`` config."""
+    global _manifestCache
+    if _manifestCache is None:
+        with _manifestCacheLock:
+            if _manifestCache is None:
+                settings = config.getConfig().get("volview", {})
+                _manifestCache = ManifestCache(
+                    maxEntries=int(
+                        settings.get("manifest_cache_size", DEFAULT_CACHE_SIZE)
+                    ),
+                    ttl=float(settings.get("manifest_cache_ttl", DEFAULT_CACHE_TTL)),
+                    shared=SharedGenerations(),
+                )
+    return _manifestCache
+
+
+def aclFingerprint(user):
+    """What about the caller decides which documents a manifest can include."""
+    if user is None:
+        return "anonymous"
+    groups = ",".join(sorted(str(group) for group in user.get("groups", [])))
+    return "%s:%s:%s" % (user["_id"], int(bool(user.get("admin"))), groups)
+
+
+def manifestKey(kind, resourceId, user, **params):
+    return (
+        kind,
+        str(resourceId),
+        json.dumps(params, sort_keys=True, default=str),
+        aclFingerprint(user),
+    )
+
+
+def cachedManifest(key, compute, scopes, roots):
+    """The manifest for ``key``, from the cache or from ``compute()``."""
+    cache = manifestCache()
+    manifest = cache.get(key)
+    if manifest is not None:
+        return manifest
+    generation = cache.begin()
+    try:
+        shared = cache.sharedGeneration(roots)
+        manifest = compute()
+        # Stored before ``end``: a change landing after the computation must
+        # still find it in flight, or find the entry, to invalidate it.
+        cache.put(key, manifest, scopes, roots, generation, shared)
+    finally:
+        cache.end()
+    return manifest
+
+
+def manifestVersion(key, roots):
+    """What the manifest for ``key`` can only change with, read without
+    computing it; ``None`` without shared counters.
+
+    That is the shared counters of its trees and the current TTL window, so
+    that out-of-band changes, which count nothing, still show within a TTL.
+    """
+    cache = manifestCache()
+    shared = cache.sharedGeneration(roots)
+    if shared is None:
+        return None
+    window = int(time.time() // cache.ttl) if cache.ttl > 0 else 0
+    return (key, shared, window)
+
+
+def _invalidateUnder(folderIds, extraIds=()):
+    cache = manifestCache()
+    ids = set(extraIds)
+    for folderId in folderIds:
+        if folderId is not None:
+            ids.update(cache.ancestors(folderId))
+    cache.invalidate(ids)
+
+
+def invalidateItems(itemIds):
+    """Drop entries affected by changes to items made without model events."""
+    cache = manifestCache()
+    if not itemIds or (cache.idle() and cache.shared is None):
+        return
+    items = list(
+        Item().find(
+            {"_id": {"$in": list(itemIds)}}, fields=["folderId", "baseParentId"]
+        )
+    )
+    cache.changed({item.get("baseParentId") for item in items})
+    if cache.idle():
+        return
+    folderIds = {
+        item["folderId"] for item in items if cache.covers(item.get("baseParentId"))
+    }
+    _invalidateUnder(folderIds, itemIds)
+
+
+def invalidateFolders(folderIds):
+    """Drop entries affected by changes in folders made without model events."""
+    cache = manifestCache()
+    if cache.shared is not None:
+        folders = Folder().find(
+            {"_id": {"$in": list(folderIds)}}, fields=["baseParentId"]
+        )
+        cache.changed({folder.get("baseParentId") for folder in folders})
+    if not cache.idle():
+        _invalidateUnder(folderIds, folderIds)
+
+
+def _itemFolderIds(item, moving):
+    folderIds = {item.get("folderId")}
+    if moving and "_id" in item:
+        # Seen before the write: the stored document still names the folder a
+        # move is taking the item away from.
+        stored = Item().load(item["_id"], force=True, fields=["folderId"], exc=False)
+        if stored is not None:
+            folderIds.add(stored.get("folderId"))
+    return folderIds
+
+
+def _folderParentIds(folder, moving):
+    parentIds = set()
+    if folder.get("parentCollection") == "folder":
+        parentIds.add(folder.get("parentId"))
+    if moving and "_id" in folder:
+        stored = Folder().load(
+            folder["_id"],
+            force=True,
+            fields=["parentId", "parentCollection"],
+            exc=False,
+        )
+        if stored is not None and stored.get("parentCollection") == "folder":
+            parentIds.add(stored.get("parentId"))
+    return parentIds
+
+
+def _handleItemChange(event, moving=False):
+    item = event.info
+    cache = manifestCache()
+    if not moving:
+        cache.changed([item.get("baseParentId")])
+    if cache.idle() or not cache.covers(item.get("baseParentId")):
+        return
+    _invalidateUnder(_itemFolderIds(item, moving), [item.get("_id")])
+
+
+def _handleFileChange(event):
+    file = event.info
+    cache = manifestCache()
+    if file.get("itemId") is None or (cache.idle() and cache.shared is None):
+        return
+    item = Item().load(
+        file["itemId"], force=True, fields=["folderId", "baseParentId"], exc=False
+    )
+    if item is None:
+        return
+    cache.changed([item.get("baseParentId")])
+    if cache.idle() or not cache.covers(item.get("baseParentId")):
+        return
+    _invalidateUnder([item.get("folderId")], [item["_id"]])
+
+
+def _handleFolderChange(event, moving=False):
+    folder = event.info
+    cache = manifestCache()
+    if "_id" in folder:
+        cache.forgetFolder(folder["_id"])
+    if not moving:
+        cache.changed([folder.get("baseParentId")])
+    if cache.idle() or not cache.covers(folder.get("baseParentId")):
+        return
+    _invalidateUnder(_folderParentIds(folder, moving), [folder.get("_id")])
+
+
+def _handleDicomTagged(event):
+    # The tags (filter rows) and mimeTypes (loadability) both shape manifests.
+    invalidateItems(event.info["itemIds"])
+
+
+def setupEventHandlers():
+    # Item and folder saves are handled both before the write (which still
+    # sees the parent a move is leaving) and after it (so a manifest computed
+    # in between is not kept; see ``ManifestCache.generation``). Other
+    # processes learn of a change from the shared counters, bumped after it.
+    for name, handler in (
+        ("model.item.save", lambda event: _handleItemChange(event, moving=True)),
+        ("model.item.save.after", _handleItemChange),
+        ("model.item.remove", _handleItemChange),
+        ("model.file.save.after", _handleFileChange),
+        ("model.file.remove", _handleFileChange),
+        ("model.folder.save", lambda event: _handleFolderChange(event, moving=True)),
+        ("model.folder.save.after", _handleFolderChange),
+        ("model.folder.remove", _handleFolderChange),
+        (TAGGED_EVENT, _handleDicomTagged),
+    ):
+        events.bind(name, "girder_volview.manifest_cache", handler)
@@ -0,0 +1,121 @@
+"""Persistent cache of DICOM parse outcomes, keyed by file content.
+
+Re-imports and assetstore re-scans save every file again, and each save used
+to re-download and re-parse a header whose bytes have not changed. The cache
+records what a parse of a given content produced -- the coerced tags, or that
+the bytes are not DICOM -- under a key derived from the file document alone:
+
+* ``sha512`` (filesystem-assetstore uploads) plus size, when present; the same
+  bytes uploaded twice share one entry;
+* otherwise the assetstore id and the imported ``path`` / ``s3Key``, plus size.
+
+A path key assumes a file replaced in place also changes size; an operator who
+rewrites imported files byte-for-byte at the same length should drop the
+``volview_dicom_parse_cache`` collection after doing so.
+
+Only definitive outcomes are stored: transient download errors and corrupt
+tags are retried on the next save, and "not DICOM" is only remembered for files
+whose name and mimeType leave it open (see ``dicom.mayBeDicom``). Entries
+expire ``ENTRY_TTL_DAYS`` after they were last stored or hit, through a TTL
+index on ``updated``, and removing a file drops its entries; another file with
+the same bytes is parsed again on its next save. Disabled with
+``dicom_parse_cache = false`` in the ``[volview]`` config section.
+"""
+
+import datetime
+import re
+import threading
+
+from girder import events
+from girder.models.model_base import Model
+from girder.utility import config
+
+from .utils import configFlag
+
+ENTRY_TTL_DAYS = 90
+
+
+class DicomParseCache(Model):
+    def initialize(self):
+        self.name = "volview_dicom_parse_cache"
+        self.ensureIndices(
+            [
+                ("key", {"unique": True}),
+                ("updated", {"expireAfterSeconds": ENTRY_TTL_DAYS * 24 * 3600}),
+            ]
+        )
+
+    def validate(self, doc):
+        return doc
+
+    def lookup(self, key):
+        entry = self.findOne({"key": key}, fields=["tags", "updated"])
+        now = datetime.datetime.utcnow()
+        if entry is not None and (
+            entry.get("updated") is None
+            or now - entry["updated"] > datetime.timedelta(days=ENTRY_TTL_DAYS / 2)
+        ):
+            # Kept while hit; refreshed at most twice a lifetime, not per hit.
+            self.collection.update_one(
+                {"_id": entry["_id"]}, {"$set": {"updated": now}}
+            )
+        return entry
+
+    def store(self, key, tags):
+        """Record ``tags`` (``None`` for not-DICOM) as the outcome for ``key``."""
+        self.collection.update_one(
+            {"key": key},
+            {"$set": {"tags": tags, "updated": datetime.datetime.utcnow()}},
+            upsert=True,
+        )
+
+    def removeFile(self, file):
+        """Drop the entries for ``file``'s content, under any projection."""
+        key = cacheKey(file)
+        if key is not None:
+            self.collection.delete_many(
+                {"key": {"$regex": "^%s(\\|.*)?$" % re.escape(key)}}
+            )
+
+
+def cacheKey(file):
+    """The content key for ``file``, or ``None`` when it cannot be derived."""
+    size = file.get("size")
+    if size is None:
+        return None
+    if file.get("sha512"):
+        return "sha512:%s:%d" % (file["sha512"], size)
+    location = file.get("path") or file.get("s3Key")
+    if location and file.get("assetstoreId"):
+        return "path:%s:%s:%d" % (file["assetstoreId"], location, size)
+    return None
+
+
+def _handleFileRemove(event):
+    DicomParseCache().removeFile(event.info)
+
+
+def setupEventHandlers():
+    events.bind("model.file.remove", "girder_volview.parse_cache", _handleFileRemove)
+
+
+def isEnabled():
+    return configFlag(config.getConfig().get("volview", {}), "dicom_parse_cache", True)
+
+
+_counters = {"hits": 0, "misses": 0, "uncacheable": 0, "unchangedItems": 0}
+_countersLock = threading.Lock()
+
+
+def count(counter):
+    with _countersLock:
+        _counters[counter] += 1
+
+
+def status():
+    """Cumulative cache counters since process start."""
+    with _countersLock:
+        counters = dict(_counters)
+    lookups = counters["hits"] + counters["misses"]
+    counters["hitRate"] = counters["hits"] / lookups if lookups else None
+    return counters
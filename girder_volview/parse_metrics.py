@@ -0,0 +1,110 @@
+"""Where DICOM tag extraction spends its time and bytes, and what it skips.
+
+Cumulative since process start, for tuning the header prefetch
+(``dicom.PREFETCH_INITIAL_BYTES``) and pydicom's ``defer_size`` from real
+imports:
+
+* ``skipped``: files not tagged, by reason -- ``linkUrl``, ``DICOMDIR`` and
+  ``empty`` are never fetched, the others are the exception a fetch or parse raised;
+* ``stages``: latency histograms of the ranged ``download`` reads, ``dcmread``,
+  ``coerce`` (building ``meta.dicom`` from the dataset) and the metadata
+  ``write``; bucket counts are per bucket (not cumulative), keyed by upper
+  bound in milliseconds;
+* ``bytesRead`` / ``rangeReads`` per parsed file: a ``rangeReads`` near 1
+  means the initial prefetch usually covers the header.
+
+``dcmread`` and ``coerce`` time only parses that succeed: an attempt on a
+prefix too short for the header, or on a non-DICOM file, is not counted.
+Parses run in worker processes hand their timings back with the tags.
+"""
+
+import bisect
+import threading
+
+SKIP_REASONS = (
+    "linkUrl",
+    "DICOMDIR",
+    "empty",
+    "InvalidDicomError",
+    "GirderException",
+    "OSError",
+    "ValueError",
+)
+STAGES = ("download", "dcmread", "coerce", "write")
+# Upper bounds, in milliseconds; a last, open bucket counts anything slower.
+BUCKET_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+
+def _emptyStage():
+    return {"count": 0, "seconds": 0.0, "buckets": [0] * (len(BUCKET_BOUNDS_MS) + 1)}
+
+
+_lock = threading.Lock()
+_skipped = dict.fromkeys(SKIP_REASONS, 0)
+_stages = {stage: _emptyStage() for stage in STAGES}
+_totals = {"parsed": 0, "bytesRead": 0, "rangeReads": 0}
+
+
+def skipped(reason):
+    with _lock:
+        _skipped[reason] += 1
+
+
+def parsed():
+    with _lock:
+        _totals["parsed"] += 1
+
+
+def readRange(byteCount):
+    with _lock:
+        _totals["rangeReads"] += 1
+        _totals["bytesRead"] += byteCount
+
+
+def _observe(stage, seconds):
+    entry = _stages[stage]
+    entry["count"] += 1
+    entry["seconds"] += seconds
+    entry["buckets"][bisect.bisect_left(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+
+
+def observe(stage, seconds):
+    with _lock:
+        _observe(stage, seconds)
+
+
+def observeAll(timings):
+    """Record ``(stage, seconds)`` pairs, e.g. as returned by a worker."""
+    with _lock:
+        for stage, seconds in timings:
+            _observe(stage, seconds)
+
+
+def status():
+    with _lock:
+        skips = dict(_skipped)
+        totals = dict(_totals)
+        stages = {}
+        for stage, entry in _stages.items():
+            labels = [str(bound) for bound in BUCKET_BOUNDS_MS] + ["+Inf"]
+            stages[stage] = {
+                "count": entry["count"],
+                "meanMs": (
+                    entry["seconds"] * 1000 / entry["count"] if entry["count"] else None
+                ),
+                "buckets": dict(zip(labels, entry["buckets"], strict=True)),
+            }
+    parsedFiles = totals["parsed"]
+    return {
+        "skipped": skips,
+        "stages": stages,
+        "parsed": parsedFiles,
+        "bytesRead": totals["bytesRead"],
+        "rangeReads": totals["rangeReads"],
+        "bytesPerParsedFile": (
+            totals["bytesRead"] / parsedFiles if parsedFiles else None
+        ),
+        "rangeReadsPerParsedFile": (
+            totals["rangeReads"] / parsedFiles if parsedFiles else None
+        ),
+    }
@@ -0,0 +1,88 @@
+"""DICOM header parsing on worker processes, off the server's GIL.
+
+``dcmread`` and tag coercion are CPU-bound Python. Run on the ingest worker
+threads (or inline on a request thread), a large import holds the GIL and
+stalls the server's API threads. A ``ParsePool`` runs the parse + coerce stage
+on a ``spawn`` process pool: bytes go in, the coerced tags come back. Fetching
+stays in the calling thread, which waits on the worker with the GIL released
+and records the parse's stage timings and projection stats it hands back;
+a worker that needs more of the header raises ``_PrefixExhaustedError`` back
+to it, and it fetches the rest.
+
+The live ingest path shares one pool, sized by ``dicom_parse_processes`` in the
+``[volview]`` config section (0, the default, parses in the server process). A
+backfill job starts its own.
+"""
+
+import concurrent.futures
+import concurrent.futures.process
+import multiprocessing
+import threading
+
+from girder import logger
+from girder.utility import config
+
+from . import dicom, parse_metrics
+from .projection import recordProjection, tagProjection
+
+DEFAULT_PARSE_PROCESSES = 0
+
+
+class ParsePool:
+    def __init__(self, processes):
+        self.processes = processes
+        # Workers do not read the server config: hand them the parent's
+        # projection.
+        self.projection = tagProjection()
+        self._lock = threading.Lock()
+        self._executor = self._newExecutor()
+
+    def _newExecutor(self):
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=self.processes,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def parse(self, data, complete):
+        """A drop-in for ``dicom.parseDicomBytes``."""
+        executor = self._executor
+        try:
+            tags, timings, projected = executor.submit(
+                dicom.parseDicomBytesTimed, data, complete, self.projection
+            ).result()
+        except concurrent.futures.process.BrokenProcessPool:
+            # A worker died (e.g. killed for memory): replace the pool for the
+            # next parse, and parse this one here.
+            logger.warning("DICOM parse worker died; restarting the parse pool")
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = self._newExecutor()
+            executor.shutdown(wait=False)
+            return dicom.parseDicomBytes(data, complete, self.projection)
+        parse_metrics.observeAll(timings)
+        recordProjection(*projected)
+        return tags
+
+    def shutdown(self):
+        self._executor.shutdown(cancel_futures=True)
+
+
+_sharedPool = None
+_sharedPoolLock = threading.Lock()
+
+
+def sharedPool():
+    """The live ingest's ``ParsePool``, or ``None`` to parse in-process."""
+    global _sharedPool
+    processes = int(
+        config.getConfig()
+        .get("volview", {})
+        .get("dicom_parse_processes", DEFAULT_PARSE_PROCESSES)
+    )
+    if processes <= 0:
+        return None
+    if _sharedPool is None:
+        with _sharedPoolLock:
+            if _sharedPool is None:
+                _sharedPool = ParsePool(processes)
+    return _sharedPool
@@ -0,0 +1,192 @@
+"""Which DICOM tags are kept in ``meta.dicom``, and how much of them.
+
+Every coercible tag used to be stored, so vendor-heavy series carried large
+private payloads in each item document, and every ``Item().find`` the plugin
+runs paid to load them. A ``TagProjection`` is applied while coercing, before a
+dropped element's value is even read:
+
+* ``dicom_tag_allow``: keywords or 4-hex-digit groups (``"0018"``) to keep; when
+  set, anything else is dropped;
+* ``dicom_tag_deny``: keywords or groups to drop;
+* ``dicom_private_tags = false`` drops every private (odd group) tag;
+* ``dicom_metadata_max_bytes``: a per-item budget; past it the largest tags
+  are dropped first.
+
+``ALWAYS_KEPT_TAGS`` -- the identifiers and geometry the plugin's filters and
+series summaries rely on -- survive every rule and the budget. Sizes are a
+cheap estimate of the stored (BSON) size, not an exact count.
+"""
+
+import datetime
+import threading
+
+from girder.utility import config
+
+from .utils import configFlag
+
+ALWAYS_KEPT_TAGS = frozenset(
+    {
+        "PatientID",
+        "StudyInstanceUID",
+        "SeriesInstanceUID",
+        "SOPInstanceUID",
+        "SOPClassUID",
+        "Modality",
+        "InstanceNumber",
+        "ImagePositionPatient",
+        "ImageOrientationPatient",
+        "PixelSpacing",
+        "SliceThickness",
+        "Rows",
+        "Columns",
+        "NumberOfFrames",
+    }
+)
+
+
+def _entries(value):
+    if not value:
+        return ()
+    if isinstance(value, str):
+        value = value.split(",")
+    return tuple(str(entry).strip() for entry in value if str(entry).strip())
+
+
+def _split(entries):
+    """Partition config entries into (keywords, groups)."""
+    keywords, groups = set(), set()
+    for entry in entries:
+        hexDigits = entry[2:] if entry.lower().startswith("0x") else entry
+        if len(hexDigits) == 4:
+            try:
+                groups.add(int(hexDigits, 16))
+                continue
+            except ValueError:
+                pass
+        keywords.add(entry)
+    return frozenset(keywords), frozenset(groups)
+
+
+def estimateSize(value):
+    """Approximate stored size of a coerced value, in bytes."""
+    if isinstance(value, (str, bytes)):
+        return len(value) + 5
+    if isinstance(value, list):
+        return sum(estimateSize(entry) + 2 for entry in value) + 5
+    if isinstance(value, (int, float, datetime.date, datetime.time)):
+        return 8
+    return 16
+
+
+class TagProjection:
+    def __init__(self, allow=None, deny=None, privateTags=True, maxBytes=0):
+        self.allow = _entries(allow)
+        self.deny = _entries(deny)
+        self.privateTags = bool(privateTags)
+        self.maxBytes = int(maxBytes or 0)
+        self._allowKeywords, self._allowGroups = _split(self.allow)
+        self._denyKeywords, self._denyGroups = _split(self.deny)
+
+    @classmethod
+    def fromConfig(cls, settings):
+        return cls(
+            allow=settings.get("dicom_tag_allow"),
+            deny=settings.get("dicom_tag_deny"),
+            privateTags=configFlag(settings, "dicom_private_tags", True),
+            maxBytes=settings.get("dicom_metadata_max_bytes", 0),
+        )
+
+    @property
+    def isDefault(self):
+        return (
+            not self.allow and not self.deny and self.privateTags and not self.maxBytes
+        )
+
+    @property
+    def fingerprint(self):
+        """Distinguishes parse outcomes produced under different projections."""
+        if self.isDefault:
+            return ""
+        return "allow=%s;deny=%s;private=%d;max=%d" % (
+            ",".join(sorted(self.allow)),
+            ",".join(sorted(self.deny)),
+            self.privateTags,
+            self.maxBytes,
+        )
+
+    def keeps(self, tag, keyword):
+        """Whether an element survives the allow/deny/private rules."""
+        if keyword in ALWAYS_KEPT_TAGS:
+            return True
+        if tag.is_private and not self.privateTags:
+            return False
+        if keyword in self._denyKeywords or tag.group in self._denyGroups:
+            return False
+        if self.allow:
+            return keyword in self._allowKeywords or tag.group in self._allowGroups
+        return True
+
+    def applyBudget(self, metadata, sizes):
+        """Drop the largest tags until ``metadata`` fits ``maxBytes``.
+
+        ``sizes`` maps each key to its estimated size. Returns the estimated
+        bytes dropped.
+        """
+        total = sum(sizes.values())
+        if not self.maxBytes or total <= self.maxBytes:
+            return 0
+        dropped = 0
+        for key in sorted(metadata, key=lambda key: sizes[key], reverse=True):
+            if total - dropped <= self.maxBytes:
+                break
+            if key in ALWAYS_KEPT_TAGS:
+                continue
+            del metadata[key]
+            dropped += sizes[key]
+        return dropped
+
+
+_projection = None
+_projectionLock = threading.Lock()
+
+
+def tagProjection():
+    """The process-wide projection, from the ``[volview]`` config."""
+    global _projection
+    if _projection is None:
+        with _projectionLock:
+            if _projection is None:
+                _projection = TagProjection.fromConfig(
+                    config.getConfig().get("volview", {})
+                )
+    return _projection
+
+
+_stats = {"items": 0, "bytesBefore": 0, "bytesAfter": 0, "tagsDropped": 0}
+_statsLock = threading.Lock()
+
+
+def recordProjection(bytesBefore, bytesAfter, tagsDropped):
+    with _statsLock:
+        _stats["items"] += 1
+        _stats["bytesBefore"] += bytesBefore
+        _stats["bytesAfter"] += bytesAfter
+        _stats["tagsDropped"] += tagsDropped
+
+
+def status():
+    """The active rules and average per-item metadata size before and after."""
+    projection = tagProjection()
+    with _statsLock:
+        stats = dict(_stats)
+    items = stats.pop("items")
+    return {
+        "allow": list(projection.allow),
+        "deny": list(projection.deny),
+        "privateTags": projection.privateTags,
+        "maxBytes": projection.maxBytes,
+        "items": items,
+        "averageBytesBefore": stats["bytesBefore"] / items if items else None,
+        "averageBytesAfter": stats["bytesAfter"] / items if items else None,
+        "tagsDropped": stats["tagsDropped"],
+    }
@@ -0,0 +1,370 @@
+"""Per-series DICOM summaries, maintained as slices are tagged.
+
+Series structure (which items form a series, their slice order, spacing) is
+otherwise rediscovered by scanning every slice item's ``meta.dicom``. Each
+write of tags also records the slice's geometry in ``volview_dicom_instance``,
+one document per (folder, ``SeriesInstanceUID``, item), and re-derives the one
+``volview_dicom_series`` document per (folder, ``SeriesInstanceUID``) from its
+slices. The summary holds only the derived fields, so it stays small however
+many slices the series has --
+
+* ``count`` and ``bytes``: number of slice items and their total file size;
+* ``order``: item ids sorted along the slice normal (``ImagePositionPatient``
+  projected onto the ``ImageOrientationPatient`` normal), falling back to
+  ``InstanceNumber``;
+* ``spacing``: the median distance between consecutive positions, or
+  ``SliceThickness`` for a single slice;
+* ``uniform``: whether every slice sits one ``spacing`` from the next (see
+  ``sliceSpacing``), ``None`` when positions are missing;
+* ``orientation``: the shared ``ImageOrientationPatient``, ``None`` if mixed;
+* ``modality`` and ``studyInstanceUID``.
+
+Removing an item drops its instance; removing a folder drops its summaries
+and instances. An item recorded under another folder or series -- moved, or
+re-tagged with a new ``SeriesInstanceUID`` -- leaves the summary it was in;
+instances are indexed by ``itemId`` to find it.
+
+Each change to a series' instances is written first and then increments its
+summary's ``revision``; the derived fields are read back from the instances
+and stored only while the revision they were computed from is still current.
+Of two writers racing on one series, the one that changed it last stores the
+summary, and it read the instances after every earlier writer wrote them, so
+a summary never reflects an older set of instances.
+"""
+
+import datetime
+import statistics
+
+from girder import logger
+from girder.models.item import Item
+from girder.models.model_base import Model
+from pymongo import ReturnDocument, UpdateOne
+
+# Positions closer than this along the normal are treated as one location.
+_SPACING_PRECISION = 6
+# Gaps further than this fraction of the spacing from it are uneven.
+SPACING_TOLERANCE = 0.01
+
+# What a summary write reads back: enough to find its instances.
+_SUMMARY_KEY = {"folderId": True, "seriesInstanceUID": True, "revision": True}
+
+
+class DicomSeries(Model):
+    def initialize(self):
+        self.name = "volview_dicom_series"
+        self.ensureIndices(
+            [
+                (
+                    [("folderId", 1), ("seriesInstanceUID", 1)],
+                    {"unique": True},
+                ),
+                "members",
+            ]
+        )
+
+    def validate(self, doc):
+        return doc
+
+    def findForFolder(self, folderId):
+        """Summaries of the series directly in a folder."""
+        return self.find({"folderId": folderId}, sort=[("seriesInstanceUID", 1)])
+
+
+class DicomInstance(Model):
+    """One slice's ``instanceEntry``, keyed by its series and item."""
+
+    def initialize(self):
+        self.name = "volview_dicom_instance"
+        self.ensureIndices(
+            [
+                (
+                    [("folderId", 1), ("seriesInstanceUID", 1), ("itemId", 1)],
+                    {"unique": True},
+                ),
+                "itemId",
+            ]
+        )
+
+    def validate(self, doc):
+        return doc
+
+
+def instanceEntry(tags, size):
+    return {
+        "position": tags.get("ImagePositionPatient"),
+        "orientation": tags.get("ImageOrientationPatient"),
+        "instanceNumber": tags.get("InstanceNumber"),
+        "sliceThickness": tags.get("SliceThickness"),
+        "bytes": size or 0,
+    }
+
+
+def _normal(orientation):
+    try:
+        rx, ry, rz, cx, cy, cz = (float(value) for value in orientation)
+    except (TypeError, ValueError):
+        return None
+    return (ry * cz - rz * cy, rz * cx - rx * cz, rx * cy - ry * cx)
+
+
+def _distance(position, normal):
+    try:
+        x, y, z = (float(value) for value in position)
+    except (TypeError, ValueError):
+        return None
+    return x * normal[0] + y * normal[1] + z * normal[2]
+
+
+def sliceSpacing(distances):
+    """``(spacing, uniform)`` of sorted slice positions along the normal.
+
+    ``spacing`` is the median gap between distinct positions, so one missing
+    slice does not skew it. ``uniform`` is whether every gap is within
+    ``SPACING_TOLERANCE`` of it: a repeated position (multi-phase, multi-echo
+    or diffusion series) or a gap (skipped slices) makes a series uneven.
+    """
+    gaps = [
+        round(abs(b - a), _SPACING_PRECISION)
+        for a, b in zip(distances, distances[1:], strict=False)
+    ]
+    distinct = [gap for gap in gaps if gap > 0]
+    if not distinct:
+        return None, False
+    spacing = statistics.median(distinct)
+    uniform = all(abs(gap - spacing) <= SPACING_TOLERANCE * spacing for gap in gaps)
+    return spacing, uniform
+
+
+def summarize(instances):
+    """The derived fields of a series from its ``instances`` map."""
+    orientations = [
+        entry.get("orientation")
+        for entry in instances.values()
+        if entry.get("orientation") is not None
+    ]
+    orientation = orientations[0] if orientations else None
+    if any(other != orientation for other in orientations):
+        orientation = None
+    normal = _normal(orientation) if orientation is not None else None
+
+    distances = {}
+    if normal is not None:
+        for itemId, entry in instances.items():
+            distance = _distance(entry.get("position"), normal)
+            if distance is not None:
+                distances[itemId] = distance
+
+    def sortKey(itemId):
+        entry = instances[itemId]
+        if len(distances) == len(instances):
+            return (0, distances[itemId], itemId)
+        number = entry.get("instanceNumber")
+        if isinstance(number, (int, float)):
+            return (1, number, itemId)
+        return (2, 0, itemId)
+
+    order = sorted(instances, key=sortKey)
+
+    spacing = uniform = None
+    if len(distances) == len(instances) and len(order) > 1:
+        spacing, uniform = sliceSpacing([distances[itemId] for itemId in order])
+    if len(instances) == 1:
+        (entry,) = instances.values()
+        thickness = entry.get("sliceThickness")
+        if isinstance(thickness, (int, float)):
+            spacing = float(thickness)
+        uniform = True
+
+    return {
+        "count": len(instances),
+        "bytes": sum(entry.get("bytes") or 0 for entry in instances.values()),
+        "order": order,
+        "spacing": spacing,
+        "uniform": uniform,
+        "orientation": orientation,
+    }
+
+
+def sliceRanks(itemIds):
+    """item id (str) -> (series id, position in its series' ``order``).
+
+    Only slices recorded in a summary are answered. Costs one item query for
+    the folders, then one indexed read of those folders' summaries.
+    """
+    wanted = {str(itemId) for itemId in itemIds}
+    if not wanted:
+        return {}
+    folderIds = {
+        item["folderId"]
+        for item in Item().find({"_id": {"$in": list(itemIds)}}, fields=["folderId"])
+    }
+    ranks = {}
+    for doc in DicomSeries().collection.find(
+        {"folderId": {"$in": list(folderIds)}}, {"order": True}
+    ):
+        for rank, itemId in enumerate(doc.get("order") or ()):
+            if itemId in wanted:
+                ranks[itemId] = (doc["_id"], rank)
+    return ranks
+
+
+def recordInstances(itemTags):
+    """Fold freshly written tags into their series summaries.
+
+    ``itemTags`` maps item id to ``(tags, bytes)``. Costs one item query and
+    one indexed instance query, then per touched series one bulk write of its
+    instances, one summary write and one read of its instances' geometry,
+    however many slices of it are in the batch. Items recorded under another
+    series are dropped from it.
+    """
+    if not itemTags:
+        return
+    folders = {
+        item["_id"]: item["folderId"]
+        for item in Item().find({"_id": {"$in": list(itemTags)}}, fields=["folderId"])
+    }
+    # item id -> the (folder, series) it belongs in now, if any.
+    targets = {}
+    bySeries = {}
+    for itemId, (tags, size) in itemTags.items():
+        folderId = folders.get(itemId)
+        if folderId is None:
+            continue
+        key = None
+        if tags.get("SeriesInstanceUID"):
+            key = (folderId, str(tags["SeriesInstanceUID"]))
+            series = bySeries.setdefault(key, {"tags": tags, "instances": {}})
+            series["instances"][str(itemId)] = instanceEntry(tags, size)
+        targets[str(itemId)] = key
+
+    instances = DicomInstance().collection
+    now = datetime.datetime.utcnow()
+    leaving = {}
+    for doc in instances.find(
+        {"itemId": {"$in": list(targets)}},
+        {"folderId": True, "seriesInstanceUID": True, "itemId": True},
+    ):
+        key = (doc["folderId"], doc["seriesInstanceUID"])
+        if targets[doc["itemId"]] != key:
+            leaving.setdefault(key, []).append(doc["itemId"])
+    for key, itemIds in leaving.items():
+        _removeInstances(key, itemIds, now)
+
+    for (folderId, seriesUid), series in bySeries.items():
+        instances.bulk_write(
+            [
+                UpdateOne(
+                    {
+                        "folderId": folderId,
+                        "seriesInstanceUID": seriesUid,
+                        "itemId": itemId,
+                    },
+                    {"$set": entry},
+                    upsert=True,
+                )
+                for itemId, entry in series["instances"].items()
+            ],
+            ordered=False,
+        )
+        doc = DicomSeries().collection.find_one_and_update(
+            {"folderId": folderId, "seriesInstanceUID": seriesUid},
+            {
+                "$set": {
+                    "studyInstanceUID": series["tags"].get("StudyInstanceUID"),
+                    "modality": series["tags"].get("Modality"),
+                },
+                "$inc": {"revision": 1},
+            },
+            projection=_SUMMARY_KEY,
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+        _storeSummary(doc, now)
+
+
+def _removeInstances(key, itemIds, now):
+    folderId, seriesUid = key
+    DicomInstance().collection.delete_many(
+        {
+            "folderId": folderId,
+            "seriesInstanceUID": seriesUid,
+            "itemId": {"$in": list(itemIds)},
+        }
+    )
+    doc = DicomSeries().collection.find_one_and_update(
+        {"folderId": folderId, "seriesInstanceUID": seriesUid},
+        {"$inc": {"revision": 1}},
+        projection=_SUMMARY_KEY,
+        return_document=ReturnDocument.AFTER,
+    )
+    if doc is not None:
+        _storeSummary(doc, now)
+
+
+def _storeSummary(doc, now):
+    # Only while no later change to the instances has been made: that change's
+    # writer stores the summary of the newer instances.
+    collection = DicomSeries().collection
+    current = {"_id": doc["_id"], "revision": doc.get("revision")}
+    instances = {
+        entry["itemId"]: entry
+        for entry in DicomInstance().collection.find(
+            {
+                "folderId": doc["folderId"],
+                "seriesInstanceUID": doc["seriesInstanceUID"],
+            },
+            {"_id": False, "folderId": False, "seriesInstanceUID": False},
+        )
+    }
+    if not instances:
+        collection.delete_one(current)
+        return
+    summary = summarize(instances)
+    summary["updated"] = now
+    collection.update_one(current, {"$set": summary})
+
+
+def handleDicomTagged(event):
+    try:
+        recordInstances(event.info["itemTags"])
+    except Exception:
+        # The summary is derived data; never fail the tag writes over it.
+        logger.exception("Failed to update DICOM series summaries")
+
+
+def handleItemSaved(event):
+    """Re-record a tagged item saved outside its summary: moved or re-tagged."""
+    item = event.info
+    tags = item.get("meta", {}).get("dicom")
+    if not isinstance(tags, dict) or "_id" not in item:
+        return
+    recorded = DicomInstance().collection.find_one(
+        {"itemId": str(item["_id"])}, {"folderId": True, "seriesInstanceUID": True}
+    )
+    if tags.get("SeriesInstanceUID"):
+        if (
+            recorded is not None
+            and recorded["folderId"] == item.get("folderId")
+            and recorded["seriesInstanceUID"] == str(tags["SeriesInstanceUID"])
+        ):
+            return
+    elif recorded is None:
+        return
+    recordInstances({item["_id"]: (tags, item.get("size"))})
+
+
+def handleItemRemove(event):
+    item = event.info
+    if "dicom" not in item.get("meta", {}):
+        return
+    itemId = str(item["_id"])
+    now = datetime.datetime.utcnow()
+    for doc in DicomInstance().collection.find(
+        {"itemId": itemId}, {"folderId": True, "seriesInstanceUID": True}
+    ):
+        _removeInstances((doc["folderId"], doc["seriesInstanceUID"]), [itemId], now)
+
+
+def handleFolderRemove(event):
+    DicomSeries().collection.delete_many({"folderId": event.info["_id"]})
+    DicomInstance().collection.delete_many({"folderId": event.info["_id"]})
@@ -1,14 +1,20 @@
 import json
+import posixpath
+import re
+import threading
 
+from bson.objectid import ObjectId
 from datetime import datetime, timezone
 from girder import logger
 from girder.exceptions import RestException
 from girder.utility.server import getApiRoot
 from girder.constants import AccessType
+from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
 
-from .handles import mintFileHandle
+from . import series
+from .handles import fileHandleTemplate, mintFileHandle, parseFileHandle
 
 SESSION_ZIP_EXTENSION = ".volview.zip"
 SESSION_JSON_EXTENSION = ".volview.json"
@@ -55,6 +61,27 @@ PREFERRED_FILTER_SUFFIXES = (
 )
 
 
+# Parent folders per ``$in`` when walking a large tree a level at a time.
+FOLDER_CHUNK_SIZE = 1000
+
+_TRUE_SETTINGS = ("1", "true", "yes", "on")
+_FALSE_SETTINGS = ("0", "false", "no", "off")
+
+
+def configFlag(settings, name, default):
+    """A boolean ``[volview]`` setting; strings read as 1/0, true/false,
+    yes/no or on/off, and anything else as ``default``."""
+    value = settings.get(name, default)
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value in _TRUE_SETTINGS:
+            return True
+        if value in _FALSE_SETTINGS:
+            return False
+        return bool(default)
+    return bool(value)
+
+
 def safeNameComponent(value):
     safe = "".join(ch if ch.isalnum() or ch in ".-_" else "_" for ch in str(value))
     return safe.strip("._")[:SAFE_NAME_MAX]
@@ -367,11 +394,11 @@ def _toIso(value):
     return str(value)
 
 
-def filesToManifest(files, folderId):
-    fileUrls = [
-        {"url": makeFileDownloadUrl(fileEntry[1]), "name": fileEntry[1]["name"]}
-        for fileEntry in files
-    ]
+def _manifestResource(fileEntry):
+    return {"url": makeFileDownloadUrl(fileEntry[1]), "name": fileEntry[1]["name"]}
+
+
+def _configResource(folderId):
     configUrl = "/".join(
         (
             "",
@@ -382,10 +409,151 @@ def filesToManifest(files, folderId):
             ".volview_config.yaml",
         )
     )
-    fileUrls.append({"url": configUrl, "name": "config.json"})
+    return {"url": configUrl, "name": "config.json"}
+
+
+MANIFEST_ORDERS = ("listing", "position", "middle-out")
+
+
+def _middleOut(entries):
+    middle = (len(entries) - 1) // 2
+    return [
+        entries[index]
+        for index in sorted(range(len(entries)), key=lambda i: (abs(i - middle), i))
+    ]
+
+
+def orderSlices(files, middleOut=False):
+    """``files`` with each DICOM series' slices together along the slice normal.
+
+    Uses the order kept in the ``volview_dicom_series`` summaries, so nothing is
+    sorted by position here. A series takes the place of its first listed slice;
+    files of untagged items keep theirs. ``middleOut`` starts each series from
+    its center slice, then alternates outwards, so a viewer loading in manifest
+    order can paint something meaningful first.
+    """
+    files = list(files)
+    ranks = series.sliceRanks(
+        list({file["itemId"] for _, file in files if file.get("itemId") is not None})
+    )
+    groups = []
+    bySeries = {}
+    for index, entry in enumerate(files):
+        rank = ranks.get(str(entry[1].get("itemId")))
+        if rank is None:
+            groups.append([(0, index, entry)])
+            continue
+        if rank[0] not in bySeries:
+            bySeries[rank[0]] = []
+            groups.append(bySeries[rank[0]])
+        bySeries[rank[0]].append((rank[1], index, entry))
+    ordered = []
+    for group in groups:
+        entries = [entry for _, _, entry in sorted(group, key=lambda key: key[:2])]
+        ordered.extend(_middleOut(entries) if middleOut else entries)
+    return ordered
+
+
+def filesToManifest(files, folderId, order="listing"):
+    if order != "listing":
+        files = orderSlices(files, middleOut=order == "middle-out")
+    fileUrls = [_manifestResource(fileEntry) for fileEntry in files]
+    fileUrls.append(_configResource(folderId))
     return {"resources": fileUrls}
 
 
+MANIFEST_STREAM_CHUNK = 64 * 1024
+
+
+def streamManifest(files, folderId):
+    """``filesToManifest`` as a generator function of JSON byte chunks.
+
+    ``files`` may be any iterable of ``(path, file)`` entries; it is consumed
+    as the response is written, so a cursor is never held in memory whole. The
+    chunks join to the document ``filesToManifest`` would return.
+    """
+
+    def stream():
+        chunk = ['{"resources": [']
+        size = 0
+        for fileEntry in files:
+            text = json.dumps(_manifestResource(fileEntry)) + ", "
+            chunk.append(text)
+            size += len(text)
+            if size >= MANIFEST_STREAM_CHUNK:
+                yield "".join(chunk).encode("utf8")
+                chunk = []
+                size = 0
+        chunk.append(json.dumps(_configResource(folderId)) + "]}")
+        yield "".join(chunk).encode("utf8")
+
+    return stream
+
+
+MANIFEST_FORMATS = ("resources", "compact", "bundled")
+
+
+def fileSeries(fileIds):
+    """file id (str) -> (folder id, ``SeriesInstanceUID``) of its item.
+
+    Only files whose item carries a ``SeriesInstanceUID`` are answered.
+    """
+    pipeline = [
+        {"$match": {"_id": {"$in": fileIds}}},
+        {
+            "$lookup": {
+                "from": "item",
+                "localField": "itemId",
+                "foreignField": "_id",
+                "as": "item",
+            }
+        },
+        {
+            "$project": {
+                "folderId": {"$arrayElemAt": ["$item.folderId", 0]},
+                "series": {"$arrayElemAt": ["$item.meta.dicom.SeriesInstanceUID", 0]},
+            }
+        },
+    ]
+    return {
+        str(doc["_id"]): (doc.get("folderId"), str(doc["series"]))
+        for doc in File().collection.aggregate(pipeline)
+        if doc.get("series") is not None
+    }
+
+
+def compactManifest(manifest):
+    """``manifest`` with its file handles folded into per-series id/name arrays.
+
+    Every file resource becomes an entry of a ``series`` group (by its item's
+    DICOM ``SeriesInstanceUID``; ``null`` gathers files without one), in
+    manifest order within and across groups. Its URL is ``urlTemplate`` with
+    ``{id}`` and the percent-encoded ``{name}`` substituted. Resources that
+    are not file handles, such as config.json, stay in ``resources``.
+    """
+    handles = []
+    resources = []
+    for resource in manifest["resources"]:
+        handle = parseFileHandle(resource["url"])
+        if handle is None:
+            resources.append(resource)
+        else:
+            handles.append((handle[0], resource["name"]))
+    seriesOf = fileSeries([ObjectId(fileId) for fileId, _ in handles])
+    series = {}
+    for fileId, name in handles:
+        uid = seriesOf.get(fileId, (None, None))[1]
+        if uid not in series:
+            series[uid] = {"seriesInstanceUID": uid, "ids": [], "names": []}
+        series[uid]["ids"].append(fileId)
+        series[uid]["names"].append(name)
+    return {
+        "urlTemplate": fileHandleTemplate(),
+        "series": list(series.values()),
+        "resources": resources,
+    }
+
+
 def sameLevelSessionFile(fileEntry):
     # if file name matches the item name, then Item.fileList has no / in the path
     # example: itemName == session.volview.zip and fileName == session.volview.zip,
@@ -468,12 +636,18 @@ def idStringToIdList(idString):
     return idString.split(",")
 
 
-def getFiles(model, docs):
+def getFiles(model, docs, user=None, itemCache=None, folderCache=None):
     # Skip docs that did not load (a stale/deleted/inaccessible id makes
     # loadModels yield None); fileList(None) would dereference None["_id"] and
     # 500.
     fileLists = [
-        model().fileList(doc, subpath=False, data=False) for doc in docs if doc
+        (
+            subtreeFileEntries(doc, user, itemCache, folderCache)
+            if model is Folder
+            else model().fileList(doc, subpath=False, data=False)
+        )
+        for doc in docs
+        if doc
     ]
     files = [file for fileList in fileLists for file in fileList]
     return files
@@ -520,33 +694,50 @@ def findNewestSession(items):
     return getNewestDoc([item for item in items if isSessionItem(item)])
 
 
-def getFilteredFiles(folder, filters):
-    """
-    Given a folder and a set of item filter criteria, find all files that are
-    in items in the folder or any of its sub-folders that match the filter.
-    Accepts a single filter dict or a list of dicts (OR-unioned).
+# Compound item indexes backing filter-row opens: every grouped-row filter is an
+# equality on one of these DICOM identifiers, scoped to the folders of a subtree.
+DICOM_FILTER_INDEXES = {
+    "volview_filter_patient": "meta.dicom.PatientID",
+    "volview_filter_study": "meta.dicom.StudyInstanceUID",
+    "volview_filter_series": "meta.dicom.SeriesInstanceUID",
+}
+
+
+def ensureDicomFilterIndexes(itemModel=None):
+    """Install the ``folderId`` + DICOM identifier indexes filter opens use."""
+    if itemModel is None:
+        itemModel = Item()
+    for name, field in DICOM_FILTER_INDEXES.items():
+        itemModel.collection.create_index([("folderId", 1), (field, 1)], name=name)
+
+
+def ensureDicomFilterIndexesInBackground():
+    """Build the filter indexes off a daemon thread so plugin load never blocks.
+
+    Until the first build against a large item collection lands, filter opens
+    fall back to scanning each subtree folder's items.
     """
-    filtersList = _promoteFilterToList(filters)
-    if filtersList is None:
-        # A malformed filter (e.g. a list with a non-dict member) must fail
-        # loudly: degrading to an empty $match would load EVERY item in the
-        # folder tree instead of the filtered selection.
-        raise RestException("filters must be a JSON object or array of objects")
-    if len(filtersList) > 1:
-        itemMatch = {"$or": filtersList}
-    elif filtersList:
-        itemMatch = filtersList[0]
-    else:
-        itemMatch = {}
-    folderId = folder["_id"]
+
+    def build():
+        try:
+            ensureDicomFilterIndexes()
+        except Exception:
+            logger.exception("Failed to ensure volview DICOM filter indexes")
+
+    threading.Thread(
+        target=build, name="volview-dicom-filter-indexes", daemon=True
+    ).start()
+
+
+def subtreeLaunchFolderIds(folder):
+    """Ids of a folder and its descendants, minus jobs' private output folders."""
     pipeline = [
-        {"$match": {"_id": folderId}},
+        {"$match": {"_id": folder["_id"]}},
         {
             "$graphLookup": {
                 "from": "folder",
                 "connectFromField": "_id",
                 "connectToField": "parentId",
-                "depthField": "_depth",
                 "as": "folders",
                 "startWith": "$_id",
             }
@@ -559,16 +750,517 @@ def getFilteredFiles(folder, filters):
         # directly (no nested subfolders), so excluding the marked folder itself
         # excludes all its outputs.
         {"$match": {"meta.%s" % JOB_OUTPUT_FOLDER_META_KEY: {"$ne": True}}},
+        {"$project": {"_id": True}},
+    ]
+    return [doc["_id"] for doc in Folder().collection.aggregate(pipeline)]
+
+
+# What of each item and folder the launch predicates read (see
+# ``isLoadableImage``); ``subtreeFileEntries`` embeds only these.
+SUBTREE_ITEM_FIELDS = (
+    "name",
+    "folderId",
+    "largeImage",
+    "meta.dicom.Modality",
+    "meta.%s" % TRANSIENT_STAGED_META_KEY,
+    "meta.linkedResources",
+)
+SUBTREE_FOLDER_FIELDS = (
+    "name",
+    "parentId",
+    "meta.%s" % JOB_OUTPUT_FOLDER_META_KEY,
+)
+
+
+def _subtreeFilesPipeline(folder, user):
+    return [{"$match": {"_id": folder["_id"]}}] + _subtreeFilesStages(user)
+
+
+def _subtreeFolderStages(user):
+    """Stages expanding matched root folders into their readable subtree."""
+    readable = Folder().permissionClauses(user, level=AccessType.READ)
+    return [
+        {
+            "$graphLookup": {
+                "from": "folder",
+                "connectFromField": "_id",
+                "connectToField": "parentId",
+                "as": "folders",
+                "startWith": "$_id",
+                # Like ``Folder().fileList``, never descend through a folder the
+                # user cannot read.
+                "restrictSearchWithMatch": {
+                    "$and": [{"parentCollection": "folder"}, readable]
+                },
+            }
+        },
+        {
+            "$addFields": {
+                "folders": {
+                    "$concatArrays": [
+                        [{"_id": "$_id", "name": "$name", "meta": "$meta"}],
+                        "$folders",
+                    ]
+                }
+            }
+        },
+        {"$unwind": "$folders"},
+        {"$replaceRoot": {"newRoot": "$folders"}},
+        {"$project": {field: True for field in SUBTREE_FOLDER_FIELDS}},
+    ]
+
+
+def _subtreeFilesStages(user):
+    """Stages expanding matched root folders into their subtree's files."""
+    return _subtreeFolderStages(user) + [
+        # Each $lookup is unwound straight away so Mongo coalesces the two, and
+        # a folder with very many items never builds one oversized document.
+        # Empty folders and items are kept: the folder names make the paths.
         {
             "$lookup": {
                 "from": "item",
                 "localField": "_id",
                 "foreignField": "folderId",
-                "as": "items",
+                "as": "item",
+            }
+        },
+        {"$unwind": {"path": "$item", "preserveNullAndEmptyArrays": True}},
+        {
+            "$lookup": {
+                "from": "file",
+                "localField": "item._id",
+                "foreignField": "itemId",
+                "as": "file",
+            }
+        },
+        {"$unwind": {"path": "$file", "preserveNullAndEmptyArrays": True}},
+        {
+            "$project": {
+                **{field: True for field in SUBTREE_FOLDER_FIELDS},
+                **{"item.%s" % field: True for field in SUBTREE_ITEM_FIELDS},
+                "item._id": True,
+                "file": True,
             }
         },
-        {"$unwind": "$items"},
-        {"$replaceRoot": {"newRoot": "$items"}},
+    ]
+
+
+def subtreeFileEntries(folder, user=None, itemCache=None, folderCache=None):
+    """``Folder().fileList(folder, subpath=False, data=False)`` in one aggregation.
+
+    ``fileList`` costs a query per folder and per item; this walks the subtree
+    with ``$graphLookup`` and joins items and files in a single round trip,
+    returning the same ``(path, file)`` entries in the same order. Folders are
+    filtered by ``user``'s read access, as ``fileList`` does when given one.
+
+    The items and folders it passes through are stored in ``itemCache`` and
+    ``folderCache`` (as ``primeLoadableImageCaches`` would fill them), so the
+    launch predicates that follow make no further queries. Cached documents
+    carry only ``SUBTREE_ITEM_FIELDS`` and ``SUBTREE_FOLDER_FIELDS``.
+    """
+    itemCache = {} if itemCache is None else itemCache
+    folderCache = {} if folderCache is None else folderCache
+    folders = {}
+    childFolders = {}
+    folderItems = {}
+    itemFiles = {}
+    for doc in Folder().collection.aggregate(_subtreeFilesPipeline(folder, user)):
+        folderId = doc["_id"]
+        if folderId not in folders:
+            folderDoc = {
+                key: value for key, value in doc.items() if key not in ("item", "file")
+            }
+            folders[folderId] = folderDoc
+            folderCache[str(folderId)] = folderDoc
+            if folderId != folder["_id"]:
+                childFolders.setdefault(doc.get("parentId"), []).append(folderId)
+        item = doc.get("item")
+        if item is None:
+            continue
+        if item["_id"] not in itemFiles:
+            itemFiles[item["_id"]] = []
+            folderItems.setdefault(folderId, []).append(item)
+            itemCache[item["_id"]] = item
+        if doc.get("file") is not None:
+            itemFiles[item["_id"]].append(doc["file"])
+
+    # Rebuild fileList's depth-first order and paths: a folder's subfolders
+    # first, then its items, each in creation (ObjectId) order.
+    entries = []
+
+    def walk(folderId, path):
+        for childId in sorted(childFolders.get(folderId, ())):
+            walk(childId, posixpath.join(path, folders[childId]["name"]))
+        for item in sorted(folderItems.get(folderId, ()), key=lambda doc: doc["_id"]):
+            files = sorted(itemFiles[item["_id"]], key=lambda doc: doc["_id"])
+            itemPath = path
+            if len(files) != 1 or files[0]["name"] != item["name"]:
+                itemPath = posixpath.join(path, item["name"])
+            entries.extend(
+                (posixpath.join(itemPath, file["name"]), file) for file in files
+            )
+
+    walk(folder["_id"], "")
+    return entries
+
+
+def subtreeFolderIds(resourceType, resourceId, chunkSize=FOLDER_CHUNK_SIZE):
+    """Ids of every folder under a folder (inclusive) or a collection, sorted.
+
+    Walked a level at a time, ``chunkSize`` parents per query, so neither a
+    query nor a result grows with the size of the tree.
+    """
+    if resourceType == "folder":
+        level = [resourceId]
+    else:
+        level = [
+            folder["_id"]
+            for folder in Folder().find(
+                {"parentId": resourceId, "parentCollection": "collection"},
+                fields=["_id"],
+            )
+        ]
+    folderIds = list(level)
+    while level:
+        children = []
+        for start in range(0, len(level), chunkSize):
+            children.extend(
+                folder["_id"]
+                for folder in Folder().find(
+                    {
+                        "parentId": {"$in": level[start : start + chunkSize]},
+                        "parentCollection": "folder",
+                    },
+                    fields=["_id"],
+                )
+            )
+        folderIds.extend(children)
+        level = children
+    return sorted(folderIds)
+
+
+def _readableSubfolder(parentId, user, after=None):
+    """The first readable subfolder of ``parentId`` by id, after id ``after``."""
+    query = {"parentId": parentId, "parentCollection": "folder"}
+    if after is not None:
+        query["_id"] = {"$gt": after}
+    readable = Folder().permissionClauses(user, level=AccessType.READ)
+    docs = (
+        Folder()
+        .collection.find(
+            {"$and": [query, readable]},
+            {field: True for field in SUBTREE_FOLDER_FIELDS},
+        )
+        .sort("_id", 1)
+        .limit(1)
+    )
+    return next(iter(docs), None)
+
+
+def nextSubtreeFolder(root, folder, user=None):
+    """The folder after ``folder`` in a depth-first walk of ``root``'s subtree.
+
+    A folder's subfolders come before its later siblings, each in id order, and
+    folders ``user`` cannot read are not descended into. The walk resumes from
+    any folder with a query per level climbed, rather than a ``$graphLookup``
+    of the whole subtree; None once it is done. Documents carry only
+    ``SUBTREE_FOLDER_FIELDS``.
+    """
+    child = _readableSubfolder(folder["_id"], user)
+    if child is not None:
+        return child
+    while folder["_id"] != root["_id"]:
+        sibling = _readableSubfolder(folder["parentId"], user, after=folder["_id"])
+        if sibling is not None:
+            return sibling
+        folder = Folder().collection.find_one(
+            {"_id": folder["parentId"]},
+            {field: True for field in SUBTREE_FOLDER_FIELDS},
+        )
+        if folder is None:
+            return None
+    return None
+
+
+def subtreeFolder(root, folderId, user=None):
+    """``folderId``'s document if ``user`` reaches it from ``root``, else None.
+
+    Every folder from it up to ``root`` must be readable, as
+    ``nextSubtreeFolder`` walks them. Documents carry only
+    ``SUBTREE_FOLDER_FIELDS``.
+    """
+    if folderId == root["_id"]:
+        return root
+    readable = Folder().permissionClauses(user, level=AccessType.READ)
+    found = None
+    while folderId != root["_id"]:
+        doc = Folder().collection.find_one(
+            {"$and": [{"_id": folderId, "parentCollection": "folder"}, readable]},
+            {field: True for field in SUBTREE_FOLDER_FIELDS},
+        )
+        if doc is None:
+            return None
+        found = found or doc
+        folderId = doc["parentId"]
+    return found
+
+
+def subtreeItemPage(folderIds, after=None, limit=500):
+    """Up to ``limit`` items of ``folderIds`` after item id ``after``, by id.
+
+    Each item carries ``SUBTREE_ITEM_FIELDS`` and its ``files``, by id.
+    """
+    match = {"folderId": {"$in": list(folderIds)}}
+    if after is not None:
+        match["_id"] = {"$gt": after}
+    pipeline = [
+        {"$match": match},
+        {"$sort": {"_id": 1}},
+        {"$limit": limit},
+        {
+            "$lookup": {
+                "from": "file",
+                "localField": "_id",
+                "foreignField": "itemId",
+                "as": "files",
+            }
+        },
+        {
+            "$project": {
+                "files": True,
+                **{field: True for field in SUBTREE_ITEM_FIELDS},
+            }
+        },
+    ]
+    items = list(Item().collection.aggregate(pipeline))
+    for item in items:
+        item["files"].sort(key=lambda doc: doc["_id"])
+    return items
+
+
+def subtreeFileRows(folder, user=None):
+    """Yield the subtree's ``(file, item, folder)`` rows as the cursor returns them.
+
+    The streaming counterpart of ``subtreeFileEntries``: only the current row
+    is held, so rows come in Mongo's order rather than ``fileList``'s and carry
+    no path. Documents carry only ``SUBTREE_ITEM_FIELDS`` and
+    ``SUBTREE_FOLDER_FIELDS``.
+    """
+    for doc in Folder().collection.aggregate(_subtreeFilesPipeline(folder, user)):
+        item = doc.pop("item", None)
+        file = doc.pop("file", None)
+        if file is not None:
+            yield file, item, doc
+
+
+def folderSessionFile(folder):
+    """The newest session saved directly in ``folder``, as a ``fileList`` entry.
+
+    What a bare folder-open resumes, found from the folder's session items alone
+    rather than a listing of its whole subtree. Filter-linked sessions are
+    excluded.
+    """
+    sessionItems = Item().find(
+        {
+            "folderId": folder["_id"],
+            "name": {"$regex": "|".join(re.escape(ext) for ext in SESSION_EXTENSIONS)},
+        }
+    )
+    entries = [
+        entry
+        for item in sessionItems
+        for entry in Item().fileList(item, subpath=True, data=False)
+    ]
+    return newestSessionFile(entries, includeFilterLinkedSessions=False)
+
+
+# ``$match`` spellings of the launch predicates, for pipelines that only need to
+# know whether a loadable file exists.
+
+
+def _falsy(field):
+    """``field`` is missing or falsy, as Python's ``not value`` has it."""
+    return {
+        "$or": [
+            # Not an array: ``$in`` also matches arrays holding a falsy value.
+            {
+                "$and": [
+                    {field: {"$in": [None, False, 0, "", {}]}},
+                    {field: {"$not": {"$type": "array"}}},
+                ]
+            },
+            {field: {"$size": 0}},
+        ]
+    }
+
+
+def _suffixPattern(suffixes):
+    return re.compile("(?:%s)$" % "|".join(re.escape(suffix) for suffix in suffixes))
+
+
+_SESSION_PATTERN = _suffixPattern(SESSION_EXTENSIONS)
+_TIFF_PATTERN = _suffixPattern((".tif", ".tiff"))
+_DICOM_PATTERN = _suffixPattern((".dcm",))
+_LOADABLE_PATTERN = _suffixPattern(LOADABLE_EXTENSIONS)
+
+
+def loadableFileMatch(folderPrefix="", itemPrefix="item.", filePrefix="file."):
+    """A ``$match`` for joined folder/item/file documents holding a file VolView
+    opens: a session file, or a file ``isLoadableImage`` accepts.
+
+    The prefixes locate the parent folder's, the item's and the file's fields in
+    the matched documents.
+    """
+    name = filePrefix + "name"
+    mimeType = filePrefix + "mimeType"
+    tiff = {"$or": [{name: _TIFF_PATTERN}, {mimeType: "image/tiff"}]}
+    dicom = {"$or": [{name: _DICOM_PATTERN}, {mimeType: "application/dicom"}]}
+    return {
+        "$or": [
+            {name: _SESSION_PATTERN},
+            {
+                "$and": [
+                    _falsy("%smeta.%s" % (folderPrefix, JOB_OUTPUT_FOLDER_META_KEY)),
+                    _falsy("%smeta.%s" % (itemPrefix, TRANSIENT_STAGED_META_KEY)),
+                    {
+                        "$or": [
+                            # A large_image TIFF opens in the slide viewer.
+                            {"$and": [tiff, _falsy(itemPrefix + "largeImage")]},
+                            {
+                                "$and": [
+                                    {"$nor": [tiff]},
+                                    dicom,
+                                    {itemPrefix + "meta.dicom.Modality": {"$ne": "SM"}},
+                                ]
+                            },
+                            {
+                                "$and": [
+                                    {"$nor": [tiff, dicom]},
+                                    {
+                                        "$or": [
+                                            {name: _LOADABLE_PATTERN},
+                                            {mimeType: {"$in": list(LOADABLE_MIMES)}},
+                                        ]
+                                    },
+                                ]
+                            },
+                        ]
+                    },
+                ]
+            },
+        ]
+    }
+
+
+def _loadableCheck():
+    return [
+        {"$match": loadableFileMatch()},
+        {"$limit": 1},
+        {"$project": {"_id": True}},
+    ]
+
+
+def folderHasLoadableFile(folder, user=None):
+    """Whether any file ``user`` can read under ``folder`` opens in VolView.
+
+    The subtree listing with the loadability predicates as a ``$match`` and a
+    ``$limit`` of one: Mongo stops at the first loadable file instead of
+    returning every file in the subtree.
+    """
+    pipeline = _subtreeFilesPipeline(folder, user) + _loadableCheck()
+    return any(True for _ in Folder().collection.aggregate(pipeline))
+
+
+def loadableFolderIds(folderIds, user=None):
+    """The ids among ``folderIds`` that ``user`` can read and that hold a file
+    VolView opens, in one aggregation; each subtree stops at its first hit."""
+    if not folderIds:
+        return set()
+    pipeline = [
+        {
+            "$match": {
+                "$and": [
+                    {"_id": {"$in": list(folderIds)}},
+                    Folder().permissionClauses(user, level=AccessType.READ),
+                ]
+            }
+        },
+        {
+            "$lookup": {
+                "from": "folder",
+                "let": {"root": "$_id"},
+                "pipeline": [{"$match": {"$expr": {"$eq": ["$_id", "$$root"]}}}]
+                + _subtreeFilesStages(user)
+                + _loadableCheck(),
+                "as": "loadable",
+            }
+        },
+        {"$match": {"loadable": {"$ne": []}}},
+        {"$project": {"_id": True}},
+    ]
+    return {doc["_id"] for doc in Folder().collection.aggregate(pipeline)}
+
+
+def loadableItemIds(itemIds, user=None, level=AccessType.READ):
+    """The ids among ``itemIds`` that ``user`` can read and that hold a file
+    VolView opens; see ``loadableFileMatch``. ``level=None`` skips the access
+    check, for items already loaded with it."""
+    if not itemIds:
+        return set()
+    pipeline = [
+        {"$match": {"_id": {"$in": list(itemIds)}}},
+        {
+            "$lookup": {
+                "from": "folder",
+                "localField": "folderId",
+                "foreignField": "_id",
+                "as": "folder",
+            }
+        },
+        {"$unwind": {"path": "$folder", "preserveNullAndEmptyArrays": True}},
+        # Items carry no ACL of their own: they are as readable as their folder.
+        {"$match": Folder().permissionClauses(user, level=level, prefix="folder.")},
+        {
+            "$lookup": {
+                "from": "file",
+                "localField": "_id",
+                "foreignField": "itemId",
+                "as": "file",
+            }
+        },
+        {"$unwind": "$file"},
+        {"$match": loadableFileMatch(folderPrefix="folder.", itemPrefix="")},
+        {"$group": {"_id": "$_id"}},
+    ]
+    return {doc["_id"] for doc in Item().collection.aggregate(pipeline)}
+
+
+def getFilteredFiles(folder, filters):
+    """
+    Given a folder and a set of item filter criteria, find all files that are
+    in items in the folder or any of its sub-folders that match the filter.
+    Accepts a single filter dict or a list of dicts (OR-unioned).
+
+    The subtree's folder ids are resolved first so the item query opens with a
+    ``$match`` on ``folderId`` and the filter together, which the
+    ``DICOM_FILTER_INDEXES`` serve, instead of matching items unindexed after a
+    per-folder ``$lookup``.
+    """
+    filtersList = _promoteFilterToList(filters)
+    if filtersList is None:
+        # A malformed filter (e.g. a list with a non-dict member) must fail
+        # loudly: degrading to an empty $match would load EVERY item in the
+        # folder tree instead of the filtered selection.
+        raise RestException("filters must be a JSON object or array of objects")
+    folderIds = subtreeLaunchFolderIds(folder)
+    if not folderIds:
+        return []
+    itemMatch = {"folderId": {"$in": folderIds}}
+    if len(filtersList) > 1:
+        itemMatch = {"$and": [itemMatch, {"$or": filtersList}]}
+    elif filtersList and filtersList[0]:
+        itemMatch = {"$and": [itemMatch, filtersList[0]]}
+    pipeline = [
         {"$match": itemMatch},
         {
             "$lookup": {
@@ -582,7 +1274,7 @@ def getFilteredFiles(folder, filters):
         {"$replaceRoot": {"newRoot": "$files"}},
     ]
     logger.debug("Filtering pipeline: %s", pipeline)
-    filesInFolder = list(Folder().collection.aggregate(pipeline))
+    filesInFolder = list(Item().collection.aggregate(pipeline))
     return filesInFolder
 
 
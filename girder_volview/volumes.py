@@ -0,0 +1,769 @@
+"""Server-side volumes: a DICOM series assembled once into a single NRRD.
+
+Every viewer session otherwise downloads, parses and stacks the same slices.
+With ``volume_conversion = true`` in the ``[volview]`` config, a launch manifest
+that lists a whole series (see ``bundle.wholeSeries``) queues a conversion of
+that series as a local Girder job, if the caller may write to the series'
+folder; once converted, later manifests list the volume in place of its
+slices. The first open is never delayed: it gets the slices. Jobs run on a
+``ConversionQueue`` of this process, ``volume_conversion_workers`` at a time;
+a full queue leaves the series for a later manifest to queue.
+
+A conversion reads the slices one at a time into one preallocated array,
+orders them along the slice normal, applies each slice's rescale slope and
+intercept, and uploads one NRRD in patient (LPS) space a chunk at a time. The
+NRRD is a file attached to the series' folder rather than stored in
+an item, so no listing, loadable count or manifest ever picks it up as data.
+It is served by ``GET folder/:id/volview_volume``.
+
+Each volume is recorded in ``volview_volume`` per (folder, series) with the key
+of the slice contents it was built from (``parse_cache.cacheKey`` of every
+file). Changed slices change the key, and the next manifest lists the slices and
+converts again. Series that cannot be converted -- compressed or multi-frame
+pixel data, mixed geometry, repeated or unevenly spaced positions, over
+``volume_conversion_max_bytes`` -- are recorded too, as is any other failure
+(a storage error, running out of memory), so they are not retried until their
+contents change.
+
+With ``volume_preview_size`` above 0, a conversion first writes a preview: the
+series read at a stride, so that it is at most that many voxels along each
+axis. A long series' preview is cut from every n-th slice before the rest are
+read. The preview is recorded (as ``previewKey``) as soon as it is uploaded,
+and until the full volume is, manifests list it marked ``preview`` just ahead
+of the series' slices. Once the full volume is recorded, manifests list it
+alone; the preview file stays, for clients still fetching it. Stock VolView
+shows a listed preview as a dataset of its own, so previews are off by default.
+"""
+
+import datetime
+import hashlib
+import io
+import queue
+import threading
+from urllib.parse import quote
+
+import numpy as np
+import pydicom
+from girder import events, logger
+from girder.constants import AccessType
+from girder.models.file import File
+from girder.models.folder import Folder
+from girder.models.model_base import Model
+from girder.models.upload import Upload
+from girder.utility import config
+from girder.utility.server import getApiRoot
+from girder_jobs.constants import JobStatus
+from girder_jobs.models.job import Job
+from pymongo.errors import DuplicateKeyError
+
+from . import manifest_cache
+from .bundle import replaceResources, seriesFiles, wholeSeries
+from .parse_cache import cacheKey
+from .series import sliceSpacing
+from .utils import configFlag, safeNameComponent
+
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+DEFAULT_PREVIEW_SIZE = 0
+DEFAULT_CONVERSION_WORKERS = 1
+DEFAULT_CONVERSION_QUEUE_SIZE = 16
+JOB_TYPE = "volview_volume_conversion"
+# A queued conversion not recorded within this long is queued again.
+CLAIM_SECONDS = 3600
+_STATE_FIELD = "volviewVolume"
+
+_NRRD_TYPES = {
+    "int8": "int8",
+    "uint8": "uint8",
+    "int16": "int16",
+    "uint16": "uint16",
+    "int32": "int32",
+    "uint32": "uint32",
+    "int64": "int64",
+    "uint64": "uint64",
+    "float32": "float",
+    "float64": "double",
+}
+
+
+class VolumeConversionError(ValueError):
+    """A series the converter cannot assemble into one volume."""
+
+
+class VolumeCache(Model):
+    def initialize(self):
+        self.name = "volview_volume"
+        self.ensureIndices(
+            [([("folderId", 1), ("seriesInstanceUID", 1)], {"unique": True})]
+        )
+
+    def validate(self, doc):
+        return doc
+
+    def record(self, folderId, seriesInstanceUid):
+        return self.findOne(
+            {"folderId": folderId, "seriesInstanceUID": seriesInstanceUid}
+        )
+
+    def current(self, folderId, seriesInstanceUid, key, preview=False):
+        """The record for the series, if its volume -- or with ``preview``, its
+        preview -- was built from contents ``key``."""
+        doc = self.record(folderId, seriesInstanceUid)
+        if doc is None or doc.get("previewKey" if preview else "key") != key:
+            return None
+        return doc
+
+
+def _settings():
+    return config.getConfig().get("volview", {})
+
+
+def isEnabled():
+    return configFlag(_settings(), "volume_conversion", False)
+
+
+def volumeKey(files):
+    """The key of the slices' contents, or ``None`` if one has no content key."""
+    keys = [cacheKey(file) for file in files]
+    if not keys or None in keys:
+        return None
+    return hashlib.sha256("\n".join(sorted(keys)).encode("utf8")).hexdigest()
+
+
+def previewSize():
+    """Most voxels along each axis of a preview; 0 writes no previews."""
+    return int(_settings().get("volume_preview_size", DEFAULT_PREVIEW_SIZE))
+
+
+def volumeName(seriesInstanceUid, preview=False):
+    suffix = ".preview.nrrd" if preview else ".nrrd"
+    return safeNameComponent(seriesInstanceUid) + suffix
+
+
+def volumeUrl(folderId, seriesInstanceUid, preview=False):
+    url = "/%s/folder/%s/volview_volume/%s?series=%s" % (
+        getApiRoot(),
+        folderId,
+        quote(volumeName(seriesInstanceUid, preview), safe=""),
+        quote(seriesInstanceUid, safe=""),
+    )
+    return url + "&preview=true" if preview else url
+
+
+def _float(value, default):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def assembleVolume(datasets):
+    """``(voxels, origin, directions)`` of single-frame slices of one series.
+
+    ``voxels`` is indexed (slice, row, column) in slice-normal order; ``origin``
+    and the three ``directions`` (column, row and slice steps) are in LPS mm.
+
+    ``datasets`` is read once, in order, and each slice's pixels go straight
+    into one preallocated array, so a sequence that reads its slices as they
+    are asked for (see ``_SeriesDatasets``) never holds more than one.
+    """
+    count = len(datasets)
+    raw = None
+    positions = np.empty((count, 3))
+    slopes = np.empty(count)
+    intercepts = np.empty(count)
+    for index in range(count):
+        dataset = datasets[index]
+        if index == 0:
+            shape = (dataset.get("Rows"), dataset.get("Columns"))
+            orientation = dataset.get("ImageOrientationPatient")
+            pixelSpacing = dataset.get("PixelSpacing")
+            thickness = dataset.get("SliceThickness")
+        if "PixelData" not in dataset or "ImagePositionPatient" not in dataset:
+            raise VolumeConversionError("slice without pixels or position")
+        if int(dataset.get("NumberOfFrames") or 1) != 1:
+            raise VolumeConversionError("multi-frame slice")
+        if int(dataset.get("SamplesPerPixel") or 1) != 1:
+            raise VolumeConversionError("color slice")
+        if (dataset.get("Rows"), dataset.get("Columns")) != shape:
+            raise VolumeConversionError("slices differ in size")
+        if dataset.get("ImageOrientationPatient") != orientation:
+            raise VolumeConversionError("slices differ in orientation")
+        try:
+            pixels = dataset.pixel_array
+        except Exception as exc:
+            # Compressed transfer syntaxes without a decoder, truncated pixel data.
+            raise VolumeConversionError("pixel data: %s" % exc) from None
+        if raw is None:
+            raw = np.empty((count,) + pixels.shape, pixels.dtype)
+        elif pixels.dtype != raw.dtype or pixels.shape != raw.shape[1:]:
+            raise VolumeConversionError("slices differ in pixel type")
+        raw[index] = pixels
+        positions[index] = [float(value) for value in dataset.ImagePositionPatient]
+        slopes[index] = _float(dataset.get("RescaleSlope"), 1.0)
+        intercepts[index] = _float(dataset.get("RescaleIntercept"), 0.0)
+        del dataset, pixels
+    if orientation is None:
+        raise VolumeConversionError("no orientation")
+
+    axes = np.array([float(value) for value in orientation]).reshape(2, 3)
+    normal = np.cross(axes[0], axes[1])
+    distances = positions @ normal
+    order = np.argsort(distances, kind="stable")
+    positions = positions[order]
+    if len(positions) > 1:
+        # One step has to reach every slice: stacking repeated or gapped
+        # positions would scale the volume along the normal.
+        _, uniform = sliceSpacing(distances[order].tolist())
+        if not uniform:
+            raise VolumeConversionError("slice positions repeat or are uneven")
+
+    # Rescaled value range per slice, to pick the narrowest exact output type.
+    low = raw.min(axis=(1, 2)) * slopes + intercepts
+    high = raw.max(axis=(1, 2)) * slopes + intercepts
+    lowest = float(min(low.min(), high.min()))
+    highest = float(max(low.max(), high.max()))
+    if np.all(slopes == 1) and np.all(intercepts == 0):
+        voxels = raw if np.all(order == np.arange(count)) else raw[order]
+    elif (
+        raw.dtype.kind in "iu"
+        and np.all(slopes == np.round(slopes))
+        and np.all(intercepts == np.round(intercepts))
+    ):
+        dtype = next(
+            dtype
+            for dtype in (np.int16, np.int32, np.float32)
+            if dtype is np.float32
+            or np.iinfo(dtype).min <= lowest <= highest <= np.iinfo(dtype).max
+        )
+        voxels = np.empty(raw.shape, dtype)
+        for index, source in enumerate(order):
+            # Widened first: a negative intercept would wrap unsigned pixels.
+            voxels[index] = raw[source].astype(np.int64) * int(slopes[source]) + int(
+                intercepts[source]
+            )
+    else:
+        voxels = np.empty(raw.shape, np.result_type(raw.dtype, np.float32))
+        for index, source in enumerate(order):
+            voxels[index] = raw[source] * slopes[source] + intercepts[source]
+
+    rowSpacing, columnSpacing = (_float(value, 1.0) for value in pixelSpacing or (1, 1))
+    if len(positions) > 1:
+        step = (positions[-1] - positions[0]) / (len(positions) - 1)
+    else:
+        step = normal * _float(thickness, 1.0)
+    directions = (axes[0] * columnSpacing, axes[1] * rowSpacing, step)
+    return voxels, positions[0], directions
+
+
+def previewVolume(voxels, origin, directions, size):
+    """``assembleVolume``'s result read at a stride, at most ``size`` per axis.
+
+    Strided reads keep every ``stride``-th voxel, so the preview's first voxel
+    is the volume's and its origin is unchanged. ``None`` where the volume is
+    already small enough, or ``size`` is 0.
+    """
+    if size <= 0:
+        return None
+    strides = [-(-extent // size) for extent in voxels.shape]
+    if strides == [1, 1, 1]:
+        return None
+    sliceStride, rowStride, columnStride = strides
+    preview = np.ascontiguousarray(voxels[::sliceStride, ::rowStride, ::columnStride])
+    directions = tuple(
+        np.asarray(direction) * stride
+        for direction, stride in zip(
+            directions, (columnStride, rowStride, sliceStride), strict=True
+        )
+    )
+    return preview, origin, directions
+
+
+def _vector(values):
+    return "(%s)" % ",".join(repr(float(value)) for value in values)
+
+
+def nrrdHeader(voxels, origin, directions):
+    """The header of a raw, little-endian NRRD of ``assembleVolume``'s result,
+    through the blank line that ends it."""
+    if voxels.dtype.name not in _NRRD_TYPES:
+        raise VolumeConversionError("no NRRD type for %s voxels" % voxels.dtype)
+    slices, rows, columns = voxels.shape
+    header = "\n".join(
+        (
+            "NRRD0004",
+            "type: %s" % _NRRD_TYPES[voxels.dtype.name],
+            "dimension: 3",
+            "space: left-posterior-superior",
+            "sizes: %d %d %d" % (columns, rows, slices),
+            "space directions: %s" % " ".join(_vector(d) for d in directions),
+            "kinds: domain domain domain",
+            "endian: little",
+            "encoding: raw",
+            "space origin: %s" % _vector(origin),
+        )
+    )
+    return header.encode("ascii") + b"\n\n"
+
+
+def _rawVoxels(voxels):
+    """``voxels``' bytes, little-endian, as a view where the host allows it."""
+    voxels = np.ascontiguousarray(
+        voxels.astype(voxels.dtype.newbyteorder("<"), copy=False)
+    )
+    return memoryview(voxels.reshape(-1).view(np.uint8))
+
+
+def nrrdBytes(voxels, origin, directions):
+    """A raw, little-endian NRRD of ``assembleVolume``'s result."""
+    return nrrdHeader(voxels, origin, directions) + _rawVoxels(voxels).tobytes()
+
+
+class _NrrdReader:
+    """A file-like NRRD of ``assembleVolume``'s result, read in chunks.
+
+    ``Upload().uploadFromFile`` reads an upload a chunk at a time; this hands
+    it the header, then slices of the voxels' own memory, so the NRRD is
+    never built whole.
+    """
+
+    def __init__(self, voxels, origin, directions):
+        self._parts = [
+            memoryview(nrrdHeader(voxels, origin, directions)),
+            _rawVoxels(voxels),
+        ]
+        self.size = sum(len(part) for part in self._parts)
+
+    def read(self, size=-1):
+        chunks = []
+        while self._parts and size != 0:
+            part = self._parts[0]
+            take = len(part) if size < 0 else min(size, len(part))
+            chunks.append(part[:take].tobytes())
+            if take == len(part):
+                self._parts.pop(0)
+            else:
+                self._parts[0] = part[take:]
+            if size > 0:
+                size -= take
+        return b"".join(chunks)
+
+
+def _readDataset(file):
+    data = b"".join(File().download(file, headers=False)())
+    try:
+        return pydicom.dcmread(io.BytesIO(data))
+    except pydicom.errors.InvalidDicomError:
+        raise VolumeConversionError("slice is not DICOM") from None
+
+
+class _SeriesDatasets:
+    """The slices of a series as a sequence, each read when it is asked for."""
+
+    def __init__(self, files):
+        self.files = files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        return _readDataset(self.files[index])
+
+
+def _record(
+    folderId, seriesInstanceUid, key, fileId=None, previewFileId=None, error=None
+):
+    doc = {
+        "folderId": folderId,
+        "seriesInstanceUID": seriesInstanceUid,
+        "key": key,
+        "fileId": fileId,
+        "previewKey": key if previewFileId is not None else None,
+        "previewFileId": previewFileId,
+        "error": error,
+    }
+    previous = VolumeCache().collection.find_one_and_replace(
+        {"folderId": folderId, "seriesInstanceUID": seriesInstanceUid},
+        doc,
+        upsert=True,
+    )
+    _removeVolumeFile(previous, keep=previewFileId)
+
+
+def _recordPreview(folderId, seriesInstanceUid, key, fileId):
+    """Record a preview of contents ``key`` ahead of their volume.
+
+    ``False`` if the conversion no longer holds its claim on the series.
+    """
+    previous = VolumeCache().collection.find_one_and_update(
+        {
+            "folderId": folderId,
+            "seriesInstanceUID": seriesInstanceUid,
+            "pendingKey": key,
+        },
+        {"$set": {"previewKey": key, "previewFileId": fileId}},
+    )
+    if previous is None:
+        return False
+    _removeVolumeFile({"previewFileId": previous.get("previewFileId")}, keep=fileId)
+    return True
+
+
+def _removeVolumeFile(doc, keep=None):
+    for field in ("fileId", "previewFileId"):
+        if doc is not None and doc.get(field) not in (None, keep):
+            file = File().load(doc[field], force=True, exc=False)
+            if file is not None:
+                File().remove(file)
+
+
+def _upload(folder, name, volume):
+    reader = _NrrdReader(*volume)
+    return Upload().uploadFromFile(
+        reader,
+        size=reader.size,
+        name=name,
+        parentType="folder",
+        parent=folder,
+        mimeType="application/octet-stream",
+        attachParent=True,
+    )
+
+
+def _writePreview(folder, seriesInstanceUid, key, volume):
+    """Upload and record ``volume`` as the series' preview; its file, or
+    ``None`` if the conversion lost its claim."""
+    file = _upload(folder, volumeName(seriesInstanceUid, True), volume)
+    try:
+        recorded = _recordPreview(folder["_id"], seriesInstanceUid, key, file["_id"])
+    except Exception:
+        File().remove(file)
+        raise
+    if not recorded:
+        File().remove(file)
+        return None
+    # Cached manifests do not list the preview yet.
+    manifest_cache.invalidateFolders([folder["_id"]])
+    return file
+
+
+def _strideSlices(files, size):
+    """Every n-th of ``files``, at most ``size`` of them; ``None`` if that is
+    all of them."""
+    stride = -(-len(files) // size)
+    return files[::stride] if stride > 1 else None
+
+
+def convertSeries(folderId, seriesInstanceUid, key):
+    """Build and record the volume of a series, if its contents are still ``key``.
+
+    The preview, if previews are on, is written and recorded first. Every
+    failure is recorded against ``key``, so the series is not tried again until
+    its slices change.
+    """
+    files = seriesFiles(folderId, seriesInstanceUid)
+    folder = Folder().load(folderId, force=True, exc=False)
+    if folder is None or volumeKey(files) != key:
+        _release(folderId, seriesInstanceUid, key)
+        return
+    maxBytes = int(_settings().get("volume_conversion_max_bytes", DEFAULT_MAX_BYTES))
+    size = previewSize()
+    preview = None
+    uploaded = []
+    try:
+        if sum(file.get("size") or 0 for file in files) > maxBytes:
+            raise VolumeConversionError("series larger than the conversion limit")
+        strided = _strideSlices(files, size) if size > 0 else None
+        if strided is not None:
+            try:
+                sparse = assembleVolume(_SeriesDatasets(strided))
+            except VolumeConversionError:
+                # Slices not yet in order along the normal; cut the preview
+                # from the full volume instead.
+                pass
+            else:
+                preview = _writePreview(
+                    folder,
+                    seriesInstanceUid,
+                    key,
+                    previewVolume(*sparse, size) or sparse,
+                )
+                del sparse
+        volume = assembleVolume(_SeriesDatasets(files))
+        if size > 0 and strided is None:
+            small = previewVolume(*volume, size)
+            if small is not None:
+                preview = _writePreview(folder, seriesInstanceUid, key, small)
+                del small
+        uploaded.append(_upload(folder, volumeName(seriesInstanceUid), volume))
+    except Exception as exc:
+        if isinstance(exc, VolumeConversionError):
+            error = str(exc)
+        else:
+            # Storage errors, running out of memory, decoder bugs: all as final
+            # for these contents as an unsupported series.
+            logger.exception("Failed to convert DICOM series %s", seriesInstanceUid)
+            error = "%s: %s" % (type(exc).__name__, exc)
+        for file in uploaded:
+            File().remove(file)
+        _record(folderId, seriesInstanceUid, key, error=error)
+        return
+    _record(
+        folderId,
+        seriesInstanceUid,
+        key,
+        fileId=uploaded[0]["_id"],
+        previewFileId=preview["_id"] if preview is not None else None,
+    )
+    # Cached manifests still list the slices.
+    manifest_cache.invalidateFolders([folderId])
+
+
+def _claimConversion(folderId, seriesInstanceUid, key):
+    """Mark contents ``key`` of a series as queued, unless they already are.
+
+    The claim is on the series' record, so only one request -- in any server
+    process -- schedules a conversion. ``_record`` replaces the record, ending
+    it; a claim older than ``CLAIM_SECONDS`` (its job died) lapses.
+    """
+    now = datetime.datetime.utcnow()
+    try:
+        VolumeCache().collection.update_one(
+            {
+                "folderId": folderId,
+                "seriesInstanceUID": seriesInstanceUid,
+                "$or": [
+                    {"pendingKey": {"$ne": key}},
+                    {
+                        "pendingSince": {
+                            "$lt": now - datetime.timedelta(seconds=CLAIM_SECONDS)
+                        }
+                    },
+                ],
+            },
+            {"$set": {"pendingKey": key, "pendingSince": now}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        return False
+    return True
+
+
+def _release(folderId, seriesInstanceUid, key):
+    VolumeCache().collection.update_one(
+        {
+            "folderId": folderId,
+            "seriesInstanceUID": seriesInstanceUid,
+            "pendingKey": key,
+        },
+        {"$unset": {"pendingKey": "", "pendingSince": ""}},
+    )
+
+
+def requestConversion(folderId, seriesInstanceUid, key):
+    """Queue a series' conversion as a local Girder job, once."""
+    conversions = conversionQueue()
+    if conversions.full():
+        # A later manifest asks again.
+        return
+    if not _claimConversion(folderId, seriesInstanceUid, key):
+        return
+    jobModel = Job()
+    job = jobModel.createLocalJob(
+        module=__name__,
+        function="run",
+        title="VolView volume conversion: %s" % seriesInstanceUid,
+        type=JOB_TYPE,
+        public=False,
+        asynchronous=True,
+        otherFields={
+            _STATE_FIELD: {
+                "folderId": folderId,
+                "seriesInstanceUID": seriesInstanceUid,
+                "key": key,
+            }
+        },
+    )
+    job = jobModel.updateJob(job, status=JobStatus.QUEUED)
+    if not conversions.submit(job):
+        jobModel.updateJob(job, status=JobStatus.CANCELED)
+        _release(folderId, seriesInstanceUid, key)
+
+
+class ConversionQueue:
+    """A bounded queue of conversion jobs drained by ``workers`` daemon threads.
+
+    Conversions run here rather than on Girder's local job handler, which runs
+    asynchronous jobs on ``events.daemon``: one thread per process, shared by
+    every other asynchronous event. Threads start lazily on the first
+    submission.
+    """
+
+    def __init__(
+        self,
+        workers=DEFAULT_CONVERSION_WORKERS,
+        maxsize=DEFAULT_CONVERSION_QUEUE_SIZE,
+    ):
+        self.workers = max(1, workers)
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def full(self):
+        return self._queue.full()
+
+    def submit(self, job):
+        """Queue ``job``; ``False`` when the queue is full."""
+        self._ensureWorkers()
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            return False
+        return True
+
+    def join(self):
+        """Block until every queued job has run."""
+        self._queue.join()
+
+    def _ensureWorkers(self):
+        if len(self._threads) >= self.workers:
+            return
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(
+                    target=self._work,
+                    name="volview-volume-%d" % len(self._threads),
+                    daemon=True,
+                )
+                self._threads.append(thread)
+                thread.start()
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                run(job)
+            except Exception:
+                logger.exception("VolView volume conversion job failed")
+            finally:
+                self._queue.task_done()
+
+
+_conversionQueue = None
+_conversionQueueLock = threading.Lock()
+
+
+def conversionQueue():
+    """The process-wide conversion queue, sized from the ``[volview]`` config."""
+    global _conversionQueue
+    if _conversionQueue is None:
+        with _conversionQueueLock:
+            if _conversionQueue is None:
+                settings = _settings()
+                _conversionQueue = ConversionQueue(
+                    workers=int(
+                        settings.get(
+                            "volume_conversion_workers", DEFAULT_CONVERSION_WORKERS
+                        )
+                    ),
+                    maxsize=int(
+                        settings.get(
+                            "volume_conversion_queue_size",
+                            DEFAULT_CONVERSION_QUEUE_SIZE,
+                        )
+                    ),
+                )
+    return _conversionQueue
+
+
+def run(job):
+    """The conversion job: convert the series named on the job document."""
+    jobModel = Job()
+    state = job[_STATE_FIELD]
+    job = jobModel.updateJob(job, status=JobStatus.RUNNING)
+    try:
+        convertSeries(state["folderId"], state["seriesInstanceUID"], state["key"])
+    except Exception:
+        # Only recording the outcome can fail here; its claim lapses.
+        logger.exception(
+            "Failed to convert DICOM series %s", state["seriesInstanceUID"]
+        )
+        jobModel.updateJob(job, status=JobStatus.ERROR)
+        return
+    jobModel.updateJob(job, status=JobStatus.SUCCESS)
+
+
+def _mayConvert(folderId, user):
+    """Whether ``user`` may have a volume written into the folder."""
+    folder = Folder().load(folderId, force=True, exc=False)
+    return folder is not None and Folder().hasAccess(folder, user, AccessType.WRITE)
+
+
+def withVolumes(manifest, user):
+    """``manifest`` with each converted whole series listed as its volume.
+
+    Whole series not converted yet stay listed as slices, and are queued for
+    conversion if ``user`` may write to their folder: the volume is stored
+    there. Once such a series' preview is recorded, it is listed just ahead of
+    the slices, marked ``preview`` for the client to drop once they have loaded.
+    """
+    if not isEnabled():
+        return manifest
+    resources = manifest["resources"]
+    cache = VolumeCache()
+    replacements = {}
+    writable = {}
+    for (folderId, seriesInstanceUid), indexes, files in wholeSeries(resources):
+        key = volumeKey(files)
+        if key is None:
+            continue
+        doc = cache.record(folderId, seriesInstanceUid) or {}
+        if doc.get("key") == key:
+            if doc.get("fileId") is not None:
+                replacements[tuple(indexes)] = [
+                    {
+                        "url": volumeUrl(folderId, seriesInstanceUid),
+                        "name": volumeName(seriesInstanceUid),
+                    }
+                ]
+            continue
+        if folderId not in writable:
+            writable[folderId] = _mayConvert(folderId, user)
+        if writable[folderId]:
+            requestConversion(folderId, seriesInstanceUid, key)
+        if doc.get("previewKey") == key:
+            replacements[(indexes[0],)] = [
+                {
+                    "url": volumeUrl(folderId, seriesInstanceUid, True),
+                    "name": volumeName(seriesInstanceUid, True),
+                    "preview": True,
+                },
+                resources[indexes[0]],
+            ]
+    if not replacements:
+        return manifest
+    return dict(manifest, resources=replaceResources(resources, replacements))
+
+
+def currentVolumeFile(folderId, seriesInstanceUid, preview=False):
+    """The volume file of a series, if it matches the series' current slices."""
+    field = "previewFileId" if preview else "fileId"
+    key = volumeKey(seriesFiles(folderId, seriesInstanceUid))
+    doc = (
+        VolumeCache().current(folderId, seriesInstanceUid, key, preview)
+        if key
+        else None
+    )
+    if doc is None or doc.get(field) is None:
+        return None
+    return File().load(doc[field], force=True, exc=False)
+
+
+def _handleFolderRemove(event):
+    collection = VolumeCache().collection
+    for doc in collection.find({"folderId": event.info["_id"]}):
+        _removeVolumeFile(doc)
+    collection.delete_many({"folderId": event.info["_id"]})
+
+
+def setupEventHandlers():
+    events.bind("model.folder.remove", "girder_volview.volumes", _handleFolderRemove)
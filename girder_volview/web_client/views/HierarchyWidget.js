@@ -1,6 +1,5 @@
 import HierarchyWidget from "@girder/core/views/widgets/HierarchyWidget";
 import ItemListWidget from "@girder/large_image/views/itemList";
-import { restRequest } from "@girder/core/rest";
 import { confirm } from "@girder/core/dialog";
 import { wrap } from "@girder/core/utilities/PluginUtils";
 
@@ -14,6 +13,7 @@ import {
     openResources,
     openResourcesURL,
 } from "./open";
+import { isLoadable } from "./loadable";
 
 const openFolder = '<i class="icon-link-ext"></i>Open Folder in VolView</a>';
 const openChecked = '<i class="icon-link-ext"></i>Open Checked in VolView</a>';
@@ -30,14 +30,7 @@ function setButtonVisibility(button, visible = true) {
 }
 
 function updateButtonVisibility(el, folderId) {
-    restRequest({
-        url: `folder/${folderId}/volview_loadable`,
-        method: "GET",
-        error: function () {
-            setButtonVisibility(el, false);
-        },
-    }).done((loadableJSON) => {
-        const loadable = loadableJSON.loadable;
+    isLoadable("folder", folderId).done((loadable) => {
         setButtonVisibility(el, loadable);
     });
 }
@@ -1,8 +1,7 @@
 import { wrap } from "@girder/core/utilities/PluginUtils";
 import ItemView from "@girder/core/views/body/ItemView";
-import { restRequest } from "@girder/core/rest";
-
 import { openItem, addButton } from "./open";
+import { isLoadable } from "./loadable";
 
 function setupButton(el, model) {
     const button = addButton(el, ".g-item-header .btn-group");
@@ -14,13 +13,8 @@ function setupButton(el, model) {
 
 wrap(ItemView, "render", function (render) {
     this.once("g:rendered", function () {
-        const id = this.model.id;
-        restRequest({
-            url: `item/${id}/volview_loadable`,
-            method: "GET",
-            error: null,
-        }).done((loadableJSON) => {
-            if (loadableJSON.loadable) {
+        isLoadable("item", this.model.id).done((loadable) => {
+            if (loadable) {
                 setupButton(this.$el, this.model);
             }
         });
@@ -0,0 +1,48 @@
+import { restRequest } from "@girder/core/rest";
+
+// Loadability checks asked for in the same tick share one volview/loadable
+// request. Today that is the parent folder's check, which a listing render
+// makes from both HierarchyWidget and ItemListWidget. Rows are not checked
+// here: ItemListWidget's application `check` must answer synchronously.
+let pending = null;
+
+function settle(waiting, answers) {
+    Object.keys(waiting).forEach((id) => {
+        waiting[id].resolve(!!(answers && answers[id]));
+    });
+}
+
+function flush() {
+    const batch = pending;
+    pending = null;
+    restRequest({
+        url: "volview/loadable",
+        method: "GET",
+        data: {
+            folders: Object.keys(batch.folder).join(","),
+            items: Object.keys(batch.item).join(","),
+        },
+        error: null,
+    })
+        .done((loadable) => {
+            settle(batch.folder, loadable.folders);
+            settle(batch.item, loadable.items);
+        })
+        .fail(() => {
+            settle(batch.folder, null);
+            settle(batch.item, null);
+        });
+}
+
+// Resolves with whether the folder or item holds anything VolView opens.
+export function isLoadable(modelType, id) {
+    if (!pending) {
+        pending = { folder: {}, item: {} };
+        window.setTimeout(flush, 0);
+    }
+    const waiting = pending[modelType];
+    if (!waiting[id]) {
+        waiting[id] = $.Deferred();
+    }
+    return waiting[id].promise();
+}
@@ -11,6 +11,8 @@ requirements = [
     "girder-large-image>=1.30.1",
     "pyyaml",
     "pydicom>=2",
+    # Assembles DICOM series into volumes (volumes.py), when enabled.
+    "numpy",
 ]
 
 setup(
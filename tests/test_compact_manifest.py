@@ -0,0 +1,101 @@
+"""The opt-in compact manifest: one URL template, file ids and names by series."""
+
+import json
+from urllib.parse import quote
+
+import pytest
+from bson.objectid import ObjectId
+
+from conftest import _folderManifest, _uploadFile, mongo_reachable
+from girder_volview import utils
+
+FOLDER_ID = "0" * 24
+
+
+def _expand(compact):
+    """The standard ``resources`` list a compact manifest stands for."""
+    resources = []
+    for series in compact["series"]:
+        for fileId, name in zip(series["ids"], series["names"], strict=True):
+            url = compact["urlTemplate"].format(id=fileId, name=quote(name, safe=""))
+            resources.append({"url": url, "name": name})
+    return resources + compact["resources"]
+
+
+@pytest.fixture
+def slices(monkeypatch, _fixed_api_root):
+    """Two interleaved 1000-slice series plus an untagged file."""
+    files = {}
+    for index in range(2000):
+        files[ObjectId()] = ("1.2.840.%d" % (index % 2), "IM%06d.dcm" % index)
+    untagged = ObjectId()
+    files[untagged] = (None, "notes #1?.nrrd")
+
+    class FileCollection:
+        def aggregate(self, pipeline):
+            fileIds = pipeline[0]["$match"]["_id"]["$in"]
+            return iter(
+                [
+                    {"_id": fileId, "series": files[fileId][0]}
+                    for fileId in fileIds
+                    if files[fileId][0] is not None
+                ]
+            )
+
+    monkeypatch.setattr(
+        utils, "File", lambda: type("M", (), {"collection": FileCollection()})()
+    )
+    entries = [
+        (None, {"_id": fileId, "name": name}) for fileId, (_, name) in files.items()
+    ]
+    return utils.filesToManifest(entries, FOLDER_ID)
+
+
+def test_compact_manifest_expands_to_the_same_resources(slices):
+    compact = utils.compactManifest(slices)
+    assert [series["seriesInstanceUID"] for series in compact["series"]] == [
+        "1.2.840.0",
+        "1.2.840.1",
+        None,
+    ]
+    assert [len(series["ids"]) for series in compact["series"]] == [1000, 1000, 1]
+    assert compact["resources"] == slices["resources"][-1:]
+    # Grouping by series is the only reordering.
+    expanded = _expand(compact)
+    standard = slices["resources"]
+    assert sorted(expanded, key=json.dumps) == sorted(standard, key=json.dumps)
+    assert expanded[:2] == [standard[0], standard[2]]
+
+
+def test_compact_manifest_is_a_fraction_of_the_size(slices):
+    standard = len(json.dumps(slices))
+    compact = len(json.dumps(utils.compactManifest(slices)))
+    # 88 KB against 194 KB with these names and an api/v1 mount.
+    assert compact < standard * 0.5
+
+
+@pytest.mark.skipif(
+    not mongo_reachable(),
+    reason="needs a live pytest-girder Mongo; unavailable offline",
+)
+@pytest.mark.plugin("volview")
+def test_folder_route_negotiates_the_compact_format(server, owner, ownerFolder):
+    item, fileDoc = _uploadFile(
+        ownerFolder, owner, "scan.nrrd", meta={"dicom": {"SeriesInstanceUID": "1.2.3"}}
+    )
+
+    standard = _folderManifest(server, ownerFolder, owner)
+    assert standard.status == 200
+    compact = _folderManifest(server, ownerFolder, owner, {"format": "compact"})
+    assert compact.status == 200
+    assert compact.json["series"] == [
+        {
+            "seriesInstanceUID": "1.2.3",
+            "ids": [str(fileDoc["_id"])],
+            "names": ["scan.nrrd"],
+        }
+    ]
+    assert _expand(compact.json) == standard.json["resources"]
+
+    rejected = _folderManifest(server, ownerFolder, owner, {"format": "zip"})
+    assert rejected.status == 400
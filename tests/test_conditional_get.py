@@ -0,0 +1,87 @@
+"""Server-fixture coverage for ETag / If-None-Match on the launch routes.
+
+The manifest and config routes tag every response; a reload carrying the tag
+gets an empty 304 until something the response was built from changes.
+
+Needs a live pytest-girder Mongo; self-skips offline like the other route tests.
+"""
+
+import io
+from conftest import mongo_reachable
+
+import pytest
+
+
+pytestmark = pytest.mark.skipif(
+    not mongo_reachable(),
+    reason="needs a live pytest-girder Mongo (like test_input_resolution_routes); "
+    "unavailable offline",
+)
+
+
+FOLDER_MANIFEST_PATH = "/folder/%s/volview"
+CONFIG_PATH = "/folder/%s/volview_config/.volview_config.yaml"
+
+
+def _upload(user, folder, name, content=b"pixel-bytes"):
+    from girder.models.upload import Upload
+
+    return Upload().uploadFromFile(
+        io.BytesIO(content),
+        size=len(content),
+        name=name,
+        parentType="folder",
+        parent=folder,
+        user=user,
+    )
+
+
+def _get(server, path, user, etag=None):
+    return server.request(
+        path=path,
+        method="GET",
+        user=user,
+        isJson=False,
+        additionalHeaders=[("If-None-Match", etag)] if etag else None,
+    )
+
+
+@pytest.mark.plugin("volview")
+def test_unchanged_manifest_revalidates_with_304(server, owner, ownerFolder):
+    _upload(owner, ownerFolder, "scan.nrrd")
+    path = FOLDER_MANIFEST_PATH % ownerFolder["_id"]
+
+    first = _get(server, path, owner)
+    assert first.output_status.startswith(b"200")
+    etag = first.headers["ETag"]
+    assert "private" in first.headers["Cache-Control"]
+
+    again = _get(server, path, owner, etag)
+    assert again.output_status.startswith(b"304")
+    assert b"".join(again.body) == b""
+
+
+@pytest.mark.plugin("volview")
+def test_new_file_changes_the_manifest_etag(server, owner, ownerFolder):
+    _upload(owner, ownerFolder, "scan.nrrd")
+    path = FOLDER_MANIFEST_PATH % ownerFolder["_id"]
+    etag = _get(server, path, owner).headers["ETag"]
+
+    _upload(owner, ownerFolder, "second.nrrd")
+
+    resp = _get(server, path, owner, etag)
+    assert resp.output_status.startswith(b"200")
+    assert resp.headers["ETag"] != etag
+
+
+@pytest.mark.plugin("volview")
+def test_config_etag_follows_the_config_file(server, owner, ownerFolder):
+    path = CONFIG_PATH % ownerFolder["_id"]
+    etag = _get(server, path, owner).headers["ETag"]
+    assert _get(server, path, owner, etag).output_status.startswith(b"304")
+
+    _upload(owner, ownerFolder, ".volview_config.yaml", b"layouts: {}\n")
+
+    resp = _get(server, path, owner, etag)
+    assert resp.output_status.startswith(b"200")
+    assert resp.headers["ETag"] != etag
@@ -0,0 +1,182 @@
+"""Offline coverage for the DICOM metadata backfill's batch and parse plumbing.
+
+The job loop itself needs Mongo; these cover the pieces it is built from.
+"""
+
+import concurrent.futures
+import pickle
+
+from girder_volview import backfill, dicom, parse_pool, projection, utils
+from test_dicom_parse import _dicomBytes
+
+
+class _Writer:
+    def __init__(self):
+        self.added = []
+        self.flushes = 0
+
+    def add(self, file, tags):
+        self.added.append(file["_id"])
+
+    def flush(self):
+        self.flushes += 1
+
+
+def test_prefix_exhaustion_survives_the_process_boundary():
+    error = pickle.loads(pickle.dumps(dicom._PrefixExhaustedError(4096)))
+    assert isinstance(error, dicom._PrefixExhaustedError)
+    assert error.needed == 4096
+
+
+def test_process_pool_parse_grows_the_prefix_in_the_parent(monkeypatch):
+    body = _dicomBytes(pixelBytes=1024 * 1024, privateBytes=40 * 1024)
+    reads = []
+
+    def readRange(f, offset, endByte):
+        reads.append((offset, endByte))
+        return body[offset:endByte]
+
+    monkeypatch.setattr(dicom, "_readRange", readRange)
+    items = projection.status()["items"]
+    pool = parse_pool.ParsePool(1)
+    try:
+        tags = dicom._fetchAndParse({"_id": "f", "size": len(body)}, pool.parse)
+    finally:
+        pool.shutdown()
+    assert tags["PatientID"] == "P-1"
+    assert len(reads) > 1
+    # Projection stats of a worker's parse are recorded in this process.
+    assert projection.status()["items"] == items + 1
+
+
+def test_batch_tags_each_item_from_its_first_dicom_file(monkeypatch):
+    dicomFiles = {"a2", "b1"}
+
+    def addTags(file, writer=None, parse=None):
+        if file["_id"] in dicomFiles:
+            writer.add(file, {"Modality": "CT"})
+            return {"Modality": "CT"}
+        return None
+
+    monkeypatch.setattr(dicom, "addDicomTagsToItemMetadata", addTags)
+    byItem = {
+        "a": [{"_id": "a1"}, {"_id": "a2"}, {"_id": "a3"}],
+        "b": [{"_id": "b1"}, {"_id": "b2"}],
+        "c": [{"_id": "c1"}],
+        "d": [],
+    }
+    writer = _Writer()
+    with concurrent.futures.ThreadPoolExecutor(2) as fetchers:
+        counts = backfill.backfillBatch(byItem, writer, None, fetchers)
+    assert sorted(writer.added) == ["a2", "b1"]
+    assert counts == {"items": 4, "files": 4, "tagged": 2}
+    # The batch's writes land before the caller checkpoints past it.
+    assert writer.flushes == 1
+
+
+def test_pending_items_resume_after_the_checkpoint():
+    query = backfill.pendingItemsQuery(["f1", "f2"], None)
+    assert query == {
+        "folderId": {"$in": ["f1", "f2"]},
+        "meta.dicom": {"$exists": False},
+    }
+    assert backfill.pendingItemsQuery(["f1"], "item-9")["_id"] == {"$gt": "item-9"}
+
+
+def test_folder_walk_queries_a_bounded_number_of_parents(monkeypatch):
+    import mongomock
+
+    db = mongomock.MongoClient().db
+    # root > 5 children > 2 grandchildren each.
+    folders = [{"_id": "root", "parentId": "coll", "parentCollection": "collection"}]
+    for child in range(5):
+        folders.append(
+            {"_id": "c%d" % child, "parentId": "root", "parentCollection": "folder"}
+        )
+        for grandchild in range(2):
+            folders.append(
+                {
+                    "_id": "c%d-%d" % (child, grandchild),
+                    "parentId": "c%d" % child,
+                    "parentCollection": "folder",
+                }
+            )
+    db.folder.insert_many(folders)
+    queries = []
+
+    class Folders:
+        def find(self, query, **kwargs):
+            queries.append(query)
+            return db.folder.find(query)
+
+    monkeypatch.setattr(utils, "Folder", Folders)
+    folderIds = utils.subtreeFolderIds("collection", "coll", chunkSize=2)
+    assert folderIds == sorted(folder["_id"] for folder in folders)
+    parents = [query["parentId"] for query in queries[1:]]
+    assert all(len(parent["$in"]) <= 2 for parent in parents)
+    assert utils.subtreeFolderIds("folder", "c1", chunkSize=2) == [
+        "c1",
+        "c1-0",
+        "c1-1",
+    ]
+
+
+def test_folder_chunks_resume_after_the_checkpointed_folder():
+    folderIds = ["a", "b", "c", "d", "e"]
+    assert list(backfill.folderChunks(folderIds, None, 2)) == [
+        ["a", "b"],
+        ["c", "d"],
+        ["e"],
+    ]
+    assert list(backfill.folderChunks(folderIds, "b", 2)) == [["c", "d"], ["e"]]
+
+
+def test_a_job_is_claimed_by_one_run_until_its_claim_lapses(monkeypatch):
+    import datetime
+
+    import mongomock
+
+    collection = mongomock.MongoClient().db.job
+    collection.insert_one({"_id": "job", backfill._STATE_FIELD: {"claimed": None}})
+    monkeypatch.setattr(
+        backfill, "Job", lambda: type("M", (), {"collection": collection})()
+    )
+    assert backfill.claimJob({"_id": "job"})
+    assert not backfill.claimJob({"_id": "job"})
+
+    lapsed = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=backfill.CLAIM_SECONDS + 1
+    )
+    collection.update_one({"_id": "job"}, {"$set": {backfill._CLAIM_FIELD: lapsed}})
+    assert backfill.claimJob({"_id": "job"})
+
+
+def test_a_claimed_backfill_runs_on_its_own_thread(monkeypatch):
+    import threading
+
+    ran = threading.Event()
+    threads = []
+
+    class FakeJob:
+        def updateJob(self, job, status=None):
+            job["status"] = status
+            return job
+
+        def scheduleJob(self, job):
+            raise AssertionError("backfills stay off the shared event daemon")
+
+    def fakeRun(job):
+        threads.append(threading.current_thread().name)
+        ran.set()
+
+    job = {"_id": "job", backfill._STATE_FIELD: {"processes": None}}
+    monkeypatch.setattr(backfill, "Job", FakeJob)
+    monkeypatch.setattr(backfill, "findResumableJob", lambda *args: job)
+    monkeypatch.setattr(backfill, "claimJob", lambda job: True)
+    monkeypatch.setattr(backfill, "run", fakeRun)
+
+    started = backfill.startBackfill(None, "folder", {"_id": "f", "name": "f"}, 2)
+    assert ran.wait(5)
+    assert threads == ["volview-backfill"]
+    assert started["status"] == backfill.JobStatus.QUEUED
+    assert started[backfill._STATE_FIELD]["processes"] == 2
@@ -0,0 +1,71 @@
+"""Coercion must stay byte-for-byte compatible with the original implementation.
+
+The baseline and the synthetic slices come from ``script/bench-dicom-coercion``,
+so the benchmark's speedup is measured on output these tests hold equal.
+"""
+
+import datetime
+import importlib.machinery
+import importlib.util
+import io
+import pathlib
+
+import pydicom
+import pytest
+
+from girder_volview import dicom
+from girder_volview.projection import TagProjection
+
+
+def _loadBench():
+    path = pathlib.Path(__file__).parent.parent / "script" / "bench-dicom-coercion"
+    loader = importlib.machinery.SourceFileLoader("bench_dicom_coercion", str(path))
+    spec = importlib.util.spec_from_loader(loader.name, loader)
+    module = importlib.util.module_from_spec(spec)
+    loader.exec_module(module)
+    return module
+
+
+bench = _loadBench()
+
+
+@pytest.mark.parametrize("deferSize", [None, 16])
+def test_metadata_matches_the_original_coercion(deferSize):
+    body = bench.syntheticSlice(index=7)
+
+    def read():
+        return pydicom.dcmread(
+            io.BytesIO(body), defer_size=deferSize, stop_before_pixels=True
+        )
+
+    expected = bench.legacyCoerceMetadata(read())
+    actual = dicom._coerceMetadata(read(), TagProjection(), report=False)
+    assert actual == expected
+    assert list(actual) == list(expected)
+    # Sequences, null-bearing binary and empty values are still dropped.
+    assert "ReferencedImageSequence" not in actual
+    assert "AccessionNumber" not in actual
+
+
+def test_implicit_vr_takes_the_dataset_path():
+    from pydicom.uid import ImplicitVRLittleEndian
+
+    dataset = pydicom.dcmread(io.BytesIO(bench.syntheticSlice()))
+    dataset.file_meta.TransferSyntaxUID = ImplicitVRLittleEndian
+    buffer = io.BytesIO()
+    pydicom.dcmwrite(buffer, dataset, enforce_file_format=True)
+
+    def read():
+        return pydicom.dcmread(io.BytesIO(buffer.getvalue()), stop_before_pixels=True)
+
+    assert dicom._coerceMetadata(
+        read(), TagProjection(), report=False
+    ) == bench.legacyCoerceMetadata(read())
+
+
+def test_value_subclasses_are_cast_to_their_base_type():
+    assert dicom._baseType(pydicom.valuerep.DT) is datetime.datetime
+    assert type(dicom._coerceValue(pydicom.valuerep.IS("5"))) is int
+    assert type(dicom._coerceValue(pydicom.valuerep.DSfloat("1.5"))) is float
+    with pytest.raises(ValueError):
+        dicom._coerceValue(None)
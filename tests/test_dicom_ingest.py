@@ -0,0 +1,297 @@
+"""Offline coverage for the background DICOM ingest queue.
+
+The queue only moves file ids; the parse itself is stubbed, so these run
+without Mongo or real DICOM bytes.
+"""
+
+import threading
+
+import pytest
+
+from conftest import _Event
+from girder import events
+from girder_volview import dicom, ingest, loadable, manifest_cache, series
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    """Record every file the (stubbed) tag extraction sees."""
+    seen = []
+
+    class Files:
+        def load(self, fileId, **kwargs):
+            return {"_id": fileId, "itemId": "item-%s" % fileId, "name": "x.dcm"}
+
+    monkeypatch.setattr(ingest, "File", Files)
+    monkeypatch.setattr(
+        dicom,
+        "addDicomTagsToItemMetadata",
+        lambda file, writer=None, parse=None: seen.append(file["_id"]),
+    )
+    return seen
+
+
+def test_submitted_files_are_parsed_off_the_calling_thread(parsed):
+    queue = ingest.DicomIngestQueue(workers=2, maxsize=10)
+    for fileId in ("a", "b", "c"):
+        assert queue.submit(fileId) is True
+    queue.join()
+    assert sorted(parsed) == ["a", "b", "c"]
+    status = queue.status()
+    assert status["processed"] == 3
+    assert status["queued"] == 0
+    assert status["inFlight"] == 0
+
+
+def test_full_queue_refuses_instead_of_growing(monkeypatch, parsed):
+    release = threading.Event()
+    started = threading.Event()
+
+    def blockingProcess(self, fileId):
+        started.set()
+        release.wait(5)
+
+    monkeypatch.setattr(ingest.DicomIngestQueue, "_process", blockingProcess)
+    queue = ingest.DicomIngestQueue(workers=1, maxsize=1)
+    assert queue.submit("busy") is True
+    assert started.wait(5)
+    assert queue.submit("backlog") is True
+    # The worker is busy and the one slot is taken: backpressure, not loss.
+    assert queue.submit("overflow") is False
+    assert queue.status()["overflowed"] == 1
+    release.set()
+    queue.join()
+
+
+def test_worker_failure_is_counted_and_does_not_kill_the_worker(monkeypatch):
+    calls = []
+
+    def flakyProcess(self, fileId):
+        calls.append(fileId)
+        if fileId == "bad":
+            raise RuntimeError("boom")
+
+    monkeypatch.setattr(ingest.DicomIngestQueue, "_process", flakyProcess)
+    queue = ingest.DicomIngestQueue(workers=1, maxsize=10)
+    queue.submit("bad")
+    queue.submit("good")
+    queue.join()
+    assert calls == ["bad", "good"]
+    assert queue.status()["failed"] == 1
+    assert queue.status()["processed"] == 1
+
+
+def test_handler_parses_inline_when_queue_disabled(monkeypatch):
+    inline = []
+    monkeypatch.setattr(
+        ingest, "ingestQueue", lambda: ingest.DicomIngestQueue(workers=0)
+    )
+    monkeypatch.setattr(
+        dicom,
+        "addDicomTagsToItemMetadata",
+        lambda file, parse=None: inline.append(file),
+    )
+    file = {"_id": "f", "itemId": "i", "name": "slice.dcm"}
+    ingest.handleFileSave(_Event(file))
+    assert inline == [file]
+
+
+def test_queued_and_inline_parses_go_through_the_parse_pool(monkeypatch):
+    parses = []
+
+    class Pool:
+        processes = 3
+
+        def parse(self, data, complete):
+            raise AssertionError("not called by the stubbed extraction")
+
+    class Files:
+        def load(self, fileId, **kwargs):
+            return {"_id": fileId, "itemId": "item", "name": "x.dcm"}
+
+    monkeypatch.setattr(ingest, "File", Files)
+    monkeypatch.setattr(
+        dicom,
+        "addDicomTagsToItemMetadata",
+        lambda file, writer=None, parse=None: parses.append(parse),
+    )
+    pool = Pool()
+    queue = ingest.DicomIngestQueue(workers=1, maxsize=10, parsePool=pool)
+    assert queue.submit("a") is True
+    queue.join()
+    assert queue.status()["parseProcesses"] == 3
+
+    monkeypatch.setattr(
+        ingest,
+        "ingestQueue",
+        lambda: ingest.DicomIngestQueue(parsePool=pool, workers=0),
+    )
+    ingest.handleFileSave(_Event({"_id": "f", "itemId": "i", "name": "slice.dcm"}))
+    assert parses == [pool.parse, pool.parse]
+
+
+@pytest.mark.parametrize(
+    "file",
+    [
+        {"_id": "f", "name": "slice.dcm"},
+        {"_id": "f", "itemId": "i", "name": "slice.dcm", "linkUrl": "http://x"},
+        {"_id": "f", "itemId": "i", "name": "DICOMDIR"},
+        {"_id": "f", "itemId": "i", "name": "dicomdir"},
+    ],
+)
+def test_non_candidates_never_occupy_a_queue_slot(monkeypatch, file):
+    submitted = []
+
+    class Recording:
+        def submit(self, fileId):
+            submitted.append(fileId)
+            return True
+
+    monkeypatch.setattr(ingest, "ingestQueue", Recording)
+    ingest.handleFileSave(_Event(file))
+    assert submitted == []
+
+
+@pytest.fixture
+def collections(monkeypatch):
+    """Record the bulk writes the metadata writer issues."""
+    calls = {"items": [], "files": [], "series": [], "recounts": []}
+
+    class ItemCollection:
+        def bulk_write(self, requests, ordered=True):
+            calls["items"].append(list(requests))
+
+    class FileCollection:
+        def update_many(self, query, update):
+            calls["files"].append((query, update))
+
+    monkeypatch.setattr(ingest, "UpdateOne", lambda query, update: (query, update))
+    monkeypatch.setattr(
+        ingest, "Item", lambda: type("M", (), {"collection": ItemCollection()})()
+    )
+    monkeypatch.setattr(
+        ingest, "File", lambda: type("M", (), {"collection": FileCollection()})()
+    )
+    monkeypatch.setattr(series, "recordInstances", calls["series"].append)
+    monkeypatch.setattr(
+        loadable,
+        "recountItems",
+        lambda itemIds, excludeFileIds=(): calls["recounts"].append(itemIds),
+    )
+    monkeypatch.setattr(loadable, "_recountQueue", loadable.RecountQueue(interval=0))
+    monkeypatch.setattr(manifest_cache, "invalidateItems", lambda itemIds: None)
+    # The subscribers ``load`` binds; bulk writes reach them through the event.
+    handlers = (
+        series.handleDicomTagged,
+        loadable._guarded(loadable._handleDicomTagged),
+        manifest_cache._handleDicomTagged,
+        lambda event: calls["events"].append(event.info["itemIds"]),
+    )
+    calls["events"] = []
+    for index, handler in enumerate(handlers):
+        events.bind(dicom.TAGGED_EVENT, "test-%d" % index, handler)
+    yield calls
+    for index in range(len(handlers)):
+        events.unbind(dicom.TAGGED_EVENT, "test-%d" % index)
+
+
+def _slice(index, itemId="series", mimeType=None):
+    return {
+        "_id": "file-%d" % index,
+        "itemId": itemId,
+        "mimeType": mimeType,
+        "size": 1000 + index,
+    }
+
+
+def test_writer_coalesces_a_batch_into_one_bulk_write_per_collection(collections):
+    writer = ingest.DicomMetadataWriter(batchSize=3, interval=60)
+    writer.add(_slice(0, "a"), {"InstanceNumber": 1})
+    writer.add(_slice(1, "b", "application/dicom"), {"InstanceNumber": 2})
+    assert collections["items"] == []
+    writer.add(_slice(2, "c", "application/octet-stream"), {"InstanceNumber": 3})
+
+    (itemWrites,) = collections["items"]
+    assert [query["_id"] for query, _ in itemWrites] == ["a", "b", "c"]
+    assert itemWrites[0][1]["$set"]["meta.dicom"] == {"InstanceNumber": 1}
+    # Only files still carrying an import/upload placeholder mimeType upgrade.
+    ((query, update),) = collections["files"]
+    assert sorted(query["_id"]["$in"]) == ["file-0", "file-2"]
+    assert update == {"$set": {"mimeType": "application/dicom"}}
+
+
+def test_writer_keeps_the_newest_tags_per_item(collections):
+    writer = ingest.DicomMetadataWriter(batchSize=100, interval=60)
+    writer.add(_slice(0), {"InstanceNumber": 1})
+    writer.add(_slice(1), {"InstanceNumber": 2})
+    writer.flush()
+    (itemWrites,) = collections["items"]
+    assert len(itemWrites) == 1
+    assert itemWrites[0][1]["$set"]["meta.dicom"] == {"InstanceNumber": 2}
+
+
+def test_writer_flushes_on_age_not_only_on_size(collections, monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(ingest.time, "monotonic", lambda: now[0])
+    writer = ingest.DicomMetadataWriter(batchSize=100, interval=0.5)
+    writer.add(_slice(0), {"InstanceNumber": 1})
+    writer.flushIfDue()
+    assert collections["items"] == []
+    now[0] += 0.5
+    writer.flushIfDue()
+    assert len(collections["items"]) == 1
+
+
+def test_burst_summary_reports_writes_saved(collections):
+    writer = ingest.DicomMetadataWriter(batchSize=2, interval=60)
+    for index in range(4):
+        writer.add(_slice(index, "item-%d" % index), {"InstanceNumber": index})
+    burst = writer.closeBurst()
+    assert burst["files"] == 4
+    # 2 batches x (items + files) instead of 4 x (load + setMetadata + save).
+    assert burst["bulkWrites"] == 4
+    assert burst["singleWrites"] == 12
+    assert burst["writesSaved"] == 8
+    assert writer.closeBurst() is None
+    assert writer.status()["lastBurst"] == burst
+
+
+def test_writer_folds_each_flush_into_the_series_summaries(collections):
+    writer = ingest.DicomMetadataWriter(batchSize=2, interval=60)
+    writer.add(_slice(0, "a"), {"InstanceNumber": 1})
+    writer.add(_slice(1, "b"), {"InstanceNumber": 2})
+    assert collections["series"] == [
+        {"a": ({"InstanceNumber": 1}, 1000), "b": ({"InstanceNumber": 2}, 1001)}
+    ]
+
+
+def test_writer_recounts_the_loadability_of_written_items(collections):
+    writer = ingest.DicomMetadataWriter(batchSize=2, interval=60)
+    writer.add(_slice(0, "a"), {"Modality": "SM"})
+    writer.add(_slice(1, "b"), {"Modality": "CT"})
+    assert collections["recounts"] == [["a", "b"]]
+
+
+def test_series_summary_failure_does_not_lose_item_writes(collections, monkeypatch):
+    def failing(itemTags):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(series, "recordInstances", failing)
+    writer = ingest.DicomMetadataWriter(batchSize=1, interval=60)
+    writer.add(_slice(0, "a"), {"InstanceNumber": 1})
+    assert len(collections["items"]) == 1
+    # Nor the other listeners' updates.
+    assert collections["recounts"] == [["a"]]
+
+
+def test_writer_announces_each_flush_with_one_event(collections):
+    writer = ingest.DicomMetadataWriter(batchSize=2, interval=60)
+    for index in range(4):
+        writer.add(_slice(index, "item-%d" % index), {"InstanceNumber": index})
+    writer.add(_slice(4, mimeType="application/dicom"), {"InstanceNumber": 4})
+    writer.flush()
+    assert collections["events"] == [
+        ["item-0", "item-1"],
+        ["item-2", "item-3"],
+        ["series"],
+    ]
@@ -0,0 +1,429 @@
+"""Offline coverage for DICOM header parsing and tag coercion.
+
+Synthesizes small Part-10 files with pydicom and serves them through a stub
+``File().download`` that records every ranged read, so the header-only fetch
+behavior is asserted without an assetstore.
+"""
+
+import io
+
+import pytest
+
+from girder_volview import dicom, parse_metrics
+
+
+def _dicomBytes(pixelBytes=4096, privateBytes=0, **tags):
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+    import pydicom
+
+    sopUid = generate_uid()
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = sopUid
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.preamble = b"\0" * 128
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = sopUid
+    ds.StudyInstanceUID = tags.pop("StudyInstanceUID", generate_uid())
+    ds.SeriesInstanceUID = tags.pop("SeriesInstanceUID", generate_uid())
+    ds.Modality = "CT"
+    ds.PatientID = "P-1"
+    ds.PatientName = "Test^Patient"
+    ds.InstanceNumber = 1
+    ds.ImagePositionPatient = [0.0, 0.0, 1.5]
+    ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+    ds.PixelSpacing = [0.5, 0.5]
+    for key, value in tags.items():
+        setattr(ds, key, value)
+    if privateBytes:
+        block = ds.private_block(0x0029, "VENDOR", create=True)
+        block.add_new(0x10, "OB", b"\x01" * privateBytes)
+    ds.Columns = 512
+    ds.Rows = max(1, pixelBytes // 1024)
+    ds.BitsAllocated = 16
+    ds.PixelData = b"\0" * pixelBytes
+    buffer = io.BytesIO()
+    pydicom.dcmwrite(buffer, ds, enforce_file_format=True)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def assetstore(monkeypatch):
+    """Serve in-memory file bodies through a range-recording ``File`` stub."""
+    bodies = {}
+    reads = []
+
+    class Files:
+        def download(self, f, offset=0, endByte=None, headers=True, **kwargs):
+            assert headers is False
+            body = bodies[f["_id"]]
+            reads.append((offset, endByte))
+            return lambda: iter([body[offset:endByte]])
+
+    monkeypatch.setattr(dicom, "File", Files)
+
+    def add(fileId, body, name="slice.dcm", size=True):
+        bodies[fileId] = body
+        doc = {"_id": fileId, "name": name, "itemId": "item"}
+        if size:
+            doc["size"] = len(body)
+        return doc
+
+    add.reads = reads
+    return add
+
+
+def test_parse_whole_file_bytes():
+    tags = dicom.parseDicomBytes(_dicomBytes())
+    assert tags["PatientID"] == "P-1"
+    assert tags["PatientName"] == "Test^Patient"
+    assert tags["ImagePositionPatient"] == [0.0, 0.0, 1.5]
+
+
+def test_truncated_prefix_never_parses_as_a_short_dataset():
+    data = _dicomBytes()
+    with pytest.raises(dicom._PrefixExhaustedError) as raised:
+        dicom.parseDicomBytes(data[:300], complete=False)
+    assert raised.value.needed > 300
+
+
+def test_large_slice_costs_one_small_ranged_read(assetstore):
+    body = _dicomBytes(pixelBytes=5 * 1024 * 1024)
+    tags = dicom._parseFile(assetstore("f", body))
+    assert tags["Modality"] == "CT"
+    assert assetstore.reads == [(0, dicom.PREFETCH_INITIAL_BYTES)]
+
+
+def test_prefix_grows_past_a_large_header_in_contiguous_ranges(assetstore):
+    body = _dicomBytes(pixelBytes=1024 * 1024, privateBytes=40 * 1024)
+    tags = dicom._parseFile(assetstore("f", body))
+    assert tags["SeriesInstanceUID"]
+    reads = assetstore.reads
+    assert 1 < len(reads) <= 3
+    # Each growth step fetches only the bytes not already held.
+    for index in range(1, len(reads)):
+        assert reads[index][0] == reads[index - 1][1]
+    assert reads[-1][1] < len(body)
+
+
+def test_small_file_is_read_once_and_completely(assetstore):
+    body = _dicomBytes(pixelBytes=64)
+    assert len(body) < dicom.PREFETCH_INITIAL_BYTES
+    assert dicom._parseFile(assetstore("f", body))["PatientID"] == "P-1"
+    assert assetstore.reads == [(0, len(body))]
+
+
+def test_unknown_size_reads_until_a_short_read(assetstore):
+    body = _dicomBytes(pixelBytes=64)
+    assert dicom._parseFile(assetstore("f", body, size=False))["PatientID"] == "P-1"
+
+
+def test_non_dicom_file_yields_none(assetstore):
+    assert dicom._parseFile(assetstore("f", b"not a dicom file" * 10)) is None
+
+
+def test_dicomdir_and_link_files_are_not_fetched(assetstore):
+    assert dicom._parseFile(assetstore("d", b"", name="DICOMDIR")) is None
+    link = {"_id": "l", "name": "x.dcm", "linkUrl": "http://x"}
+    assert dicom._parseFile(link) is None
+    assert assetstore.reads == []
+
+
+def test_empty_files_are_not_fetched(assetstore):
+    assert dicom._parseFile(assetstore("e", b"")) is None
+    assert assetstore.reads == []
+
+
+def test_str_chunks_from_an_s3_download_are_read_as_bytes(monkeypatch):
+    class Files:
+        def download(self, f, offset=0, endByte=None, headers=True):
+            # Girder's S3 adapter streams an empty file as one str chunk.
+            return lambda: iter([""])
+
+    monkeypatch.setattr(dicom, "File", Files)
+    assert dicom._readRange({"_id": "s3"}, 0, None) == b""
+    assert dicom._parseFile({"_id": "s3", "name": "x.dcm"}) is None
+
+
+def test_metrics_count_skips_by_reason_and_time_each_stage(assetstore):
+    before = parse_metrics.status()
+    dicom._parseFile(assetstore("d", b"", name="DICOMDIR"))
+    dicom._parseFile(assetstore("n", b"not a dicom file" * 10))
+    body = _dicomBytes(pixelBytes=64)
+    dicom._parseFile(assetstore("f", body))
+    after = parse_metrics.status()
+
+    def delta(*path):
+        old, new = before, after
+        for key in path:
+            old, new = old[key], new[key]
+        return new - old
+
+    assert delta("skipped", "DICOMDIR") == 1
+    assert delta("skipped", "InvalidDicomError") == 1
+    assert delta("parsed") == 1
+    assert delta("rangeReads") == 2
+    assert delta("bytesRead") == len(body) + 160
+    assert delta("stages", "download", "count") == 2
+    assert delta("stages", "dcmread", "count") == 1
+    assert delta("stages", "coerce", "count") == 1
+    histogram = after["stages"]["coerce"]["buckets"]
+    assert list(histogram)[-1] == "+Inf"
+    assert sum(histogram.values()) == after["stages"]["coerce"]["count"]
+
+
+def test_timed_parse_returns_its_timings_instead_of_recording():
+    from girder_volview import projection
+
+    before = parse_metrics.status()["stages"]["dcmread"]["count"]
+    items = projection.status()["items"]
+    tags, timings, projected = dicom.parseDicomBytesTimed(_dicomBytes())
+    assert tags["PatientID"] == "P-1"
+    assert [stage for stage, _ in timings] == ["dcmread", "coerce"]
+    bytesBefore, bytesAfter, tagsDropped = projected
+    assert bytesBefore >= bytesAfter > 0
+    assert parse_metrics.status()["stages"]["dcmread"]["count"] == before
+    assert projection.status()["items"] == items
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """An in-memory parse cache and item store behind the real lookup logic."""
+    from girder_volview import parse_cache
+
+    entries = {}
+    items = {}
+
+    class Cache:
+        def lookup(self, key):
+            return {"tags": entries[key]} if key in entries else None
+
+        def store(self, key, tags):
+            entries[key] = tags
+
+    class Items:
+        def load(self, itemId, **kwargs):
+            return items.get(itemId)
+
+    monkeypatch.setattr(parse_cache, "DicomParseCache", Cache)
+    monkeypatch.setattr(parse_cache, "isEnabled", lambda: True)
+    monkeypatch.setattr(
+        parse_cache, "_counters", dict.fromkeys(parse_cache._counters, 0)
+    )
+    monkeypatch.setattr(dicom, "Item", Items)
+    return {"entries": entries, "items": items}
+
+
+class _Writer:
+    def __init__(self):
+        self.added = []
+
+    def add(self, file, tags):
+        self.added.append((file["_id"], tags))
+
+
+def _imported(assetstore, fileId, body):
+    doc = assetstore(fileId, body)
+    doc.update(assetstoreId="store", path="/data/%s.dcm" % fileId)
+    doc["mimeType"] = "application/dicom"
+    return doc
+
+
+def test_reimported_unchanged_file_is_neither_fetched_nor_written(assetstore, cache):
+    from girder_volview import parse_cache
+
+    file = _imported(assetstore, "f", _dicomBytes())
+    writer = _Writer()
+    dicom.addDicomTagsToItemMetadata(file, writer=writer)
+    ((_, tags),) = writer.added
+    reads = len(assetstore.reads)
+
+    cache["items"]["item"] = {"_id": "item", "meta": {"dicom": tags}}
+    dicom.addDicomTagsToItemMetadata(file, writer=writer)
+    assert len(writer.added) == 1
+    assert len(assetstore.reads) == reads
+    status = parse_cache.status()
+    assert (status["hits"], status["misses"], status["unchangedItems"]) == (1, 1, 1)
+
+
+def test_cache_hit_still_writes_an_item_missing_the_tags(assetstore, cache):
+    file = _imported(assetstore, "f", _dicomBytes())
+    writer = _Writer()
+    dicom.addDicomTagsToItemMetadata(file, writer=writer)
+    reads = len(assetstore.reads)
+    dicom.addDicomTagsToItemMetadata(file, writer=writer)
+    assert len(writer.added) == 2
+    assert writer.added[0][1] == writer.added[1][1]
+    assert len(assetstore.reads) == reads
+
+
+def test_non_dicom_outcome_is_cached(assetstore, cache):
+    file = _imported(assetstore, "f", b"not a dicom file" * 10)
+    writer = _Writer()
+    dicom.addDicomTagsToItemMetadata(file, writer=writer)
+    reads = len(assetstore.reads)
+    dicom.addDicomTagsToItemMetadata(file, writer=writer)
+    assert writer.added == []
+    assert len(assetstore.reads) == reads
+    assert list(cache["entries"].values()) == [None]
+
+
+def test_non_dicom_outcome_is_not_cached_for_files_typed_otherwise(assetstore, cache):
+    png = _imported(assetstore, "f", b"not a dicom file" * 10)
+    png.update(name="thumb.png", mimeType="image/png")
+    dicom.addDicomTagsToItemMetadata(png, writer=_Writer())
+    notes = _imported(assetstore, "g", b"not a dicom file" * 10)
+    notes.update(name="notes.txt", mimeType=None)
+    dicom.addDicomTagsToItemMetadata(notes, writer=_Writer())
+    assert cache["entries"] == {}
+
+
+@pytest.mark.parametrize(
+    "name,mimeType,expected",
+    [
+        ("IM0001", None, True),
+        ("1.2.840.113619.2.55", "application/octet-stream", True),
+        ("slice.DCM", None, True),
+        ("scan.nrrd", "application/dicom", True),
+        ("scan.nrrd", None, False),
+        ("slice", "image/png", False),
+    ],
+)
+def test_a_files_type_can_rule_out_dicom(name, mimeType, expected):
+    assert dicom.mayBeDicom({"name": name, "mimeType": mimeType}) is expected
+
+
+def test_parse_cache_entries_expire_and_go_with_their_file(monkeypatch):
+    import datetime
+
+    from girder_volview import parse_cache
+
+    mongomock = pytest.importorskip("mongomock")
+    cache = parse_cache.DicomParseCache.__new__(parse_cache.DicomParseCache)
+    cache.collection = mongomock.MongoClient().db.volview_dicom_parse_cache
+    cache.findOne = lambda query, fields=None: cache.collection.find_one(query)
+    file = {"sha512": "abc", "size": 10}
+    cache.store("sha512:abc:10", None)
+    cache.store("sha512:abc:10|rules", {"Modality": "CT"})
+    cache.store("sha512:abcd:10", None)
+    assert isinstance(cache.collection.find_one()["updated"], datetime.datetime)
+
+    # A hit on an entry half way to expiring keeps it for another lifetime.
+    old = datetime.datetime.utcnow() - datetime.timedelta(
+        days=parse_cache.ENTRY_TTL_DAYS
+    )
+    cache.collection.update_many({}, {"$set": {"updated": old}})
+    cache.lookup("sha512:abcd:10")
+    assert cache.collection.find_one({"key": "sha512:abcd:10"})["updated"] > old
+
+    from conftest import _Event
+
+    monkeypatch.setattr(parse_cache, "DicomParseCache", lambda: cache)
+    parse_cache._handleFileRemove(_Event(file))
+    assert [entry["key"] for entry in cache.collection.find()] == ["sha512:abcd:10"]
+
+
+def test_transient_failures_are_not_cached(assetstore, cache, monkeypatch):
+    file = _imported(assetstore, "f", _dicomBytes())
+
+    def failing(f, offset, endByte):
+        raise OSError("assetstore unavailable")
+
+    monkeypatch.setattr(dicom, "_readRange", failing)
+    dicom.addDicomTagsToItemMetadata(file, writer=_Writer())
+    assert cache["entries"] == {}
+
+
+def test_cache_key_prefers_content_hash():
+    from girder_volview import parse_cache
+
+    base = {"size": 10, "assetstoreId": "a", "path": "/x.dcm"}
+    assert parse_cache.cacheKey(dict(base, sha512="abc")) == "sha512:abc:10"
+    assert parse_cache.cacheKey(base) == "path:a:/x.dcm:10"
+    assert parse_cache.cacheKey({"size": 10, "assetstoreId": "a"}) is None
+    assert parse_cache.cacheKey({"sha512": "abc"}) is None
+
+
+def _projected(projection, **tags):
+    import pydicom
+
+    data = _dicomBytes(privateBytes=2048, **tags)
+    dataset = pydicom.dcmread(io.BytesIO(data), stop_before_pixels=True)
+    return dicom._coerceMetadata(dataset, projection)
+
+
+def test_default_projection_keeps_private_tags():
+    from girder_volview.projection import TagProjection
+
+    tags = _projected(TagProjection())
+    assert any(key.startswith("(0029") for key in tags)
+
+
+def test_projection_drops_private_and_denied_tags_but_keeps_identifiers():
+    from girder_volview.projection import TagProjection
+
+    projection = TagProjection(deny=["PatientName", "0028", "Modality"])
+    projection.privateTags = False
+    tags = _projected(projection)
+    assert not any(key.startswith("(0029") for key in tags)
+    assert "PatientName" not in tags
+    assert "BitsAllocated" not in tags
+    # Identifiers survive every rule.
+    assert tags["Modality"] == "CT"
+    assert tags["Rows"]
+
+
+@pytest.mark.parametrize(
+    "value,expected",
+    [("off", False), ("No", False), (0, False), ("on", True), ("yes", True)],
+)
+def test_boolean_settings_read_the_same_everywhere(monkeypatch, value, expected):
+    from girder.utility import config
+
+    from girder_volview import parse_cache
+    from girder_volview.projection import TagProjection
+
+    settings = {"dicom_private_tags": value, "dicom_parse_cache": value}
+    monkeypatch.setattr(config, "getConfig", lambda: {"volview": settings})
+    assert TagProjection.fromConfig(settings).privateTags is expected
+    assert parse_cache.isEnabled() is expected
+
+
+def test_allow_list_by_keyword_and_group():
+    from girder_volview.projection import TagProjection
+
+    tags = _projected(TagProjection(allow="PatientName, 0x0018"), SliceThickness=2)
+    assert "PatientName" in tags
+    assert tags["SliceThickness"] == 2
+    assert "BitsAllocated" not in tags
+    assert "SeriesInstanceUID" in tags
+
+
+def test_budget_drops_the_largest_tags_first_and_reports_sizes(monkeypatch):
+    from girder_volview import projection as projectionModule
+    from girder_volview.projection import TagProjection
+
+    monkeypatch.setattr(
+        projectionModule, "_stats", dict.fromkeys(projectionModule._stats, 0)
+    )
+    unlimited = _projected(TagProjection(), ImageComments="x" * 600)
+    budget = TagProjection(maxBytes=800)
+    tags = _projected(budget, ImageComments="x" * 600)
+    assert not any(key.startswith("(0029") and key.endswith("1010)") for key in tags)
+    assert "ImageComments" not in tags
+    assert "PatientName" in tags
+    assert "PatientID" in tags
+    assert len(tags) < len(unlimited)
+    report = projectionModule.status()
+    assert report["items"] == 2
+    assert report["averageBytesAfter"] < report["averageBytesBefore"]
+
+
+def test_projection_rules_partition_the_parse_cache():
+    from girder_volview.projection import TagProjection
+
+    assert TagProjection().fingerprint == ""
+    assert TagProjection(deny=["0029"]).fingerprint != TagProjection().fingerprint
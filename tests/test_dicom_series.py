@@ -0,0 +1,229 @@
+"""Offline coverage for the derived fields of per-series DICOM summaries."""
+
+import pytest
+
+from conftest import _Event
+from girder_volview import series
+
+AXIAL = [1, 0, 0, 0, 1, 0]
+
+
+def _instance(z=None, number=None, orientation=AXIAL, size=100, thickness=None):
+    tags = {"ImageOrientationPatient": orientation}
+    if z is not None:
+        tags["ImagePositionPatient"] = [0.0, 0.0, z]
+    if number is not None:
+        tags["InstanceNumber"] = number
+    if thickness is not None:
+        tags["SliceThickness"] = thickness
+    return series.instanceEntry(tags, size)
+
+
+def test_slices_are_ordered_along_the_normal_not_by_instance_number():
+    summary = series.summarize(
+        {
+            "a": _instance(z=5.0, number=1),
+            "b": _instance(z=-5.0, number=2),
+            "c": _instance(z=0.0, number=3),
+        }
+    )
+    assert summary["order"] == ["b", "c", "a"]
+    assert summary["spacing"] == 5.0
+    assert summary["orientation"] == AXIAL
+    assert summary["count"] == 3
+    assert summary["bytes"] == 300
+
+
+def test_spacing_is_the_median_gap_so_one_missing_slice_does_not_skew_it():
+    instances = {str(z): _instance(z=float(z)) for z in (0, 2, 4, 6, 10)}
+    summary = series.summarize(instances)
+    assert summary["spacing"] == 2.0
+    assert summary["uniform"] is False
+
+
+@pytest.mark.parametrize(
+    "distances,expected",
+    [
+        ([0, 2, 4, 6], (2, True)),
+        ([0, 0, 5, 5], (5, False)),
+        ([0, 1, 10], (5, False)),
+        ([3, 3], (None, False)),
+    ],
+)
+def test_slice_spacing_reports_repeats_and_gaps_as_uneven(distances, expected):
+    assert series.sliceSpacing(distances) == expected
+
+
+def test_oblique_orientation_projects_onto_its_normal():
+    # Rows along x, columns along (0, cos, sin): normal is (0, -sin, cos).
+    oblique = [1, 0, 0, 0, 0.6, 0.8]
+    instances = {
+        "far": series.instanceEntry(
+            {"ImageOrientationPatient": oblique, "ImagePositionPatient": [0, -8, 6]},
+            1,
+        ),
+        "near": series.instanceEntry(
+            {"ImageOrientationPatient": oblique, "ImagePositionPatient": [0, 0, 0]},
+            1,
+        ),
+    }
+    summary = series.summarize(instances)
+    assert summary["order"] == ["near", "far"]
+    assert abs(summary["spacing"] - 10.0) < 1e-9
+
+
+def test_missing_positions_fall_back_to_instance_number():
+    summary = series.summarize(
+        {"a": _instance(number=3), "b": _instance(number=1), "c": _instance(z=1.0)}
+    )
+    assert summary["order"] == ["b", "a", "c"]
+    assert summary["spacing"] is None
+
+
+def test_mixed_orientations_are_reported_as_none():
+    summary = series.summarize(
+        {"a": _instance(z=0.0), "b": _instance(z=1.0, orientation=[0, 1, 0, 0, 0, 1])}
+    )
+    assert summary["orientation"] is None
+
+
+def test_single_slice_spacing_is_its_thickness():
+    assert series.summarize({"a": _instance(z=0.0, thickness=2.5)})["spacing"] == 2.5
+
+
+def _sliceRankStubs(monkeypatch, summaries):
+    class Collection:
+        def find(self, query, fields=None):
+            return iter(summaries)
+
+    monkeypatch.setattr(
+        series, "Item", lambda: type("M", (), {"find": lambda *a, **k: iter([])})()
+    )
+    monkeypatch.setattr(
+        series, "DicomSeries", lambda: type("M", (), {"collection": Collection()})()
+    )
+
+
+def test_manifest_order_follows_the_series_summaries(monkeypatch):
+    from girder_volview import utils
+
+    _sliceRankStubs(
+        monkeypatch,
+        [
+            {"_id": "ct", "order": ["c1", "c2", "c3", "c4", "c5"]},
+            {"_id": "mr", "order": ["m2", "m1"]},
+        ],
+    )
+    listed = ["m1", "c4", "scan", "c1", "c5", "m2", "c3", "c2"]
+    files = [(None, {"_id": "f" + itemId, "itemId": itemId}) for itemId in listed]
+
+    def itemIds(**kwargs):
+        return [file["itemId"] for _, file in utils.orderSlices(files, **kwargs)]
+
+    assert itemIds() == ["m2", "m1", "c1", "c2", "c3", "c4", "c5", "scan"]
+    assert itemIds(middleOut=True) == ["m2", "m1", "c3", "c2", "c4", "c1", "c5", "scan"]
+
+
+class _Collection:
+    """mongomock's ``bulk_write`` does not take this pymongo's ``UpdateOne``."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self._collection.update_one(
+                request._filter, request._doc, upsert=request._upsert
+            )
+
+
+@pytest.fixture
+def summaries(monkeypatch):
+    """``volview_dicom_series`` and ``volview_dicom_instance`` in mongomock,
+    over items in folders a and b."""
+    mongomock = pytest.importorskip("mongomock")
+    db = mongomock.MongoClient().db
+    folders = {"s1": "a", "s2": "a", "s3": "a"}
+    monkeypatch.setattr(
+        series,
+        "Item",
+        lambda: type(
+            "M",
+            (),
+            {
+                "find": lambda self, query, fields=None: [
+                    {"_id": itemId, "folderId": folders[itemId]}
+                    for itemId in query["_id"]["$in"]
+                    if itemId in folders
+                ]
+            },
+        )(),
+    )
+    monkeypatch.setattr(
+        series, "DicomSeries", lambda: type("M", (), {"collection": db.series})()
+    )
+    instances = _Collection(db.instance)
+    monkeypatch.setattr(
+        series, "DicomInstance", lambda: type("M", (), {"collection": instances})()
+    )
+    return db.series, folders
+
+
+def _tags(uid, z):
+    return ({"SeriesInstanceUID": uid, "ImagePositionPatient": [0, 0, z]}, 10)
+
+
+def test_moved_and_retagged_items_leave_their_old_summary(summaries):
+    collection, folders = summaries
+    series.recordInstances({item: _tags("1.1", z) for z, item in enumerate(folders)})
+    folders["s1"] = "b"
+    series.recordInstances({"s1": _tags("1.1", 0), "s2": _tags("2.2", 1)})
+
+    docs = {
+        (doc["folderId"], doc["seriesInstanceUID"]): doc for doc in collection.find()
+    }
+    assert sorted(docs) == [("a", "1.1"), ("a", "2.2"), ("b", "1.1")]
+    assert docs["a", "1.1"]["order"] == ["s3"]
+    assert docs["b", "1.1"]["order"] == ["s1"]
+    # Summaries carry only derived fields; the slices are documents of their own.
+    assert "instances" not in docs["a", "1.1"]
+    assert series.DicomInstance().collection.count_documents({}) == 3
+
+    series.handleItemRemove(
+        _Event({"_id": "s3", "folderId": "a", "meta": {"dicom": {}}})
+    )
+    assert collection.count_documents({"seriesInstanceUID": "1.1"}) == 1
+
+
+def test_a_summary_of_an_older_instance_map_is_not_stored(summaries):
+    collection, _ = summaries
+    series.recordInstances({"s1": _tags("1.1", 0)})
+    stale = collection.find_one()
+    series.recordInstances({"s2": _tags("1.1", 1)})
+
+    # A writer whose revision is no longer current stores nothing, whatever
+    # instances it reads.
+    series.DicomInstance().collection.delete_one({"itemId": "s2"})
+    series._storeSummary(stale, None)
+    assert collection.find_one()["order"] == ["s1", "s2"]
+
+
+def test_a_saved_item_is_re_recorded_only_once_it_moves(summaries):
+    collection, folders = summaries
+    series.recordInstances({"s1": _tags("1.1", 0)})
+    item = {
+        "_id": "s1",
+        "folderId": "a",
+        "size": 10,
+        "meta": {"dicom": _tags("1.1", 0)[0]},
+    }
+    revision = collection.find_one()["revision"]
+    series.handleItemSaved(_Event(item))
+    assert collection.find_one()["revision"] == revision
+
+    folders["s1"] = item["folderId"] = "b"
+    series.handleItemSaved(_Event(item))
+    assert [doc["folderId"] for doc in collection.find()] == ["b"]
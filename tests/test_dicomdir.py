@@ -0,0 +1,161 @@
+"""Offline coverage for DICOMDIR-driven ingest.
+
+DICOMDIRs are written with pydicom's ``FileSet`` from synthetic slices; the
+Girder models are stubbed.
+"""
+
+import io
+
+import pytest
+
+from girder_volview import dicomdir
+from test_dicom_parse import _dicomBytes
+
+
+def _dicomDirBytes(tmp_path, slices=3):
+    import pydicom
+    from pydicom.fileset import FileSet
+    from pydicom.uid import generate_uid
+
+    fileSet = FileSet()
+    study, seriesUid = generate_uid(), generate_uid()
+    for index in range(slices):
+        body = _dicomBytes(
+            StudyInstanceUID=study,
+            SeriesInstanceUID=seriesUid,
+            InstanceNumber=index + 1,
+            StudyDate="20240101",
+            StudyTime="120000",
+            StudyID="1",
+            SeriesNumber=1,
+        )
+        fileSet.add(pydicom.dcmread(io.BytesIO(body)))
+    fileSet.write(tmp_path)
+    return (tmp_path / "DICOMDIR").read_bytes(), seriesUid
+
+
+def test_every_reference_inherits_its_patient_study_and_series(tmp_path):
+    data, seriesUid = _dicomDirBytes(tmp_path)
+    references = dicomdir.parseDicomDir(data)
+    assert [path for path, _ in references] == [
+        "PT000000/ST000000/SE000000/IM%06d" % index for index in range(3)
+    ]
+    tags = references[0][1]
+    assert tags["PatientID"] == "P-1"
+    assert tags["SeriesInstanceUID"] == seriesUid
+    assert tags["Modality"] == "CT"
+    assert tags["InstanceNumber"] == 1
+    assert tags["SOPInstanceUID"]
+    assert "DirectoryRecordType" not in tags
+    assert "ReferencedFileID" not in tags
+
+
+@pytest.fixture
+def hierarchy(monkeypatch):
+    """Items in folders: ``dicomdir`` folder > ``series`` folder."""
+    folders = {"dicomdir": None, "series": "dicomdir", "elsewhere": None}
+    items = {"slice": "series", "other": "elsewhere", "dir": "dicomdir"}
+
+    class Items:
+        def load(self, itemId, **kwargs):
+            return {"_id": itemId, "folderId": items[itemId]}
+
+    class Folders:
+        def load(self, folderId, **kwargs):
+            parent = folders[folderId]
+            return {
+                "_id": folderId,
+                "parentId": parent or "collection",
+                "parentCollection": "folder" if parent else "collection",
+            }
+
+    monkeypatch.setattr(dicomdir, "Item", Items)
+    monkeypatch.setattr(dicomdir, "Folder", Folders)
+
+
+def test_files_under_a_pending_dicomdir_are_deferred(hierarchy):
+    registry = dicomdir.DicomDirRegistry(settle=0)
+    assert registry.defer({"_id": "f", "itemId": "slice"}) is False
+    registry.add({"_id": "DICOMDIR", "itemId": "dir"})
+    assert registry.defer({"_id": "f", "itemId": "slice"}) is True
+    assert registry.defer({"_id": "g", "itemId": "other"}) is False
+    assert registry.status()["deferred"] == 1
+
+
+def test_untagged_deferred_files_are_handed_back(hierarchy, monkeypatch):
+    registry = dicomdir.DicomDirRegistry(settle=0)
+    registry.add({"_id": "DICOMDIR", "itemId": "dir"})
+    for fileId in ("tagged", "missed"):
+        registry.defer({"_id": fileId, "itemId": "slice"})
+    monkeypatch.setattr(
+        registry, "ingest", lambda folderId, dicomDirId, writer: {"tagged"}
+    )
+    resubmitted = []
+    assert registry.due()
+    registry.processDue(writer=None, resubmit=resubmitted.append)
+    assert resubmitted == ["missed"]
+    assert not registry.due()
+    # Nothing is pending any more: later files parse as usual.
+    assert registry.defer({"_id": "late", "itemId": "slice"}) is False
+
+
+def test_failed_dicomdir_hands_back_everything(hierarchy, monkeypatch):
+    registry = dicomdir.DicomDirRegistry(settle=0)
+    registry.add({"_id": "DICOMDIR", "itemId": "dir"})
+    registry.defer({"_id": "f", "itemId": "slice"})
+
+    def failing(folderId, dicomDirId, writer):
+        raise ValueError("corrupt")
+
+    monkeypatch.setattr(registry, "ingest", failing)
+    resubmitted = []
+    registry.processDue(writer=None, resubmit=resubmitted.append)
+    assert resubmitted == ["f"]
+
+
+@pytest.mark.parametrize("imported,trusted", [(3, True), (2, False)])
+def test_directory_is_trusted_only_when_references_resolve(
+    tmp_path, monkeypatch, imported, trusted
+):
+    data, _ = _dicomDirBytes(tmp_path)
+
+    class Loader:
+        def load(self, docId, **kwargs):
+            return {"_id": docId, "size": len(data)}
+
+    monkeypatch.setattr(dicomdir, "File", Loader)
+    monkeypatch.setattr(dicomdir, "Folder", Loader)
+    monkeypatch.setattr(dicomdir.dicom, "_readRange", lambda f, start, end: data)
+    monkeypatch.setattr(
+        dicomdir,
+        "subtreeFiles",
+        lambda folder: {
+            "PT000000/ST000000/SE000000/IM%06d" % index: {
+                "_id": "file-%d" % index,
+                "itemId": "item-%d" % index,
+            }
+            for index in range(imported)
+        },
+    )
+    written = []
+    monkeypatch.setattr(
+        dicomdir.DicomDirRegistry,
+        "_write",
+        lambda self, dicomDirId, resolved, batchSize: (
+            written.extend(resolved) or len(resolved)
+        ),
+    )
+    registry = dicomdir.DicomDirRegistry(minResolved=0.95)
+    writer = type("Writer", (), {"batchSize": 100})()
+    tagged = registry.ingest("folder", "DICOMDIR", writer)
+    assert registry.lastResult["trusted"] is trusted
+    if trusted:
+        assert tagged == {"file-0", "file-1", "file-2"}
+        assert [file["itemId"] for file, _ in written] == [
+            "item-0",
+            "item-1",
+            "item-2",
+        ]
+    else:
+        assert tagged == set()
+        assert written == []
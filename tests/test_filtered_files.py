@@ -0,0 +1,78 @@
+"""Offline coverage for the shape of the filter-row file query."""
+
+import pytest
+from girder.exceptions import RestException
+
+from girder_volview import utils
+
+
+@pytest.fixture
+def aggregates(monkeypatch):
+    """Record the pipelines run against the folder and item collections."""
+    calls = {"folder": [], "item": [], "indexes": []}
+
+    class FolderCollection:
+        def aggregate(self, pipeline):
+            calls["folder"].append(pipeline)
+            return iter([{"_id": "root"}, {"_id": "child"}])
+
+    class ItemCollection:
+        def aggregate(self, pipeline):
+            calls["item"].append(pipeline)
+            return iter([{"_id": "file", "itemId": "item"}])
+
+        def create_index(self, keys, name):
+            calls["indexes"].append((name, keys))
+
+    monkeypatch.setattr(
+        utils, "Folder", lambda: type("M", (), {"collection": FolderCollection()})()
+    )
+    monkeypatch.setattr(
+        utils, "Item", lambda: type("M", (), {"collection": ItemCollection()})()
+    )
+    return calls
+
+
+def test_item_match_leads_the_pipeline_with_the_subtree_folders(aggregates):
+    row = {"meta.dicom.StudyInstanceUID": "1.2.3"}
+    files = utils.getFilteredFiles({"_id": "root"}, row)
+
+    assert files == [{"_id": "file", "itemId": "item"}]
+    (pipeline,) = aggregates["item"]
+    assert pipeline[0] == {
+        "$match": {"$and": [{"folderId": {"$in": ["root", "child"]}}, row]}
+    }
+
+
+def test_filter_lists_are_or_unioned_inside_the_folder_scope(aggregates):
+    rows = [{"meta.dicom.SeriesInstanceUID": "a"}, {"meta.dicom.PatientID": "p"}]
+    utils.getFilteredFiles({"_id": "root"}, rows)
+
+    (pipeline,) = aggregates["item"]
+    assert pipeline[0]["$match"]["$and"][1] == {"$or": rows}
+
+
+def test_job_output_folders_are_excluded_from_the_folder_scope(aggregates):
+    utils.getFilteredFiles({"_id": "root"}, {})
+
+    (folderPipeline,) = aggregates["folder"]
+    assert {
+        "$match": {"meta.%s" % utils.JOB_OUTPUT_FOLDER_META_KEY: {"$ne": True}}
+    } in folderPipeline
+    (pipeline,) = aggregates["item"]
+    assert pipeline[0] == {"$match": {"folderId": {"$in": ["root", "child"]}}}
+
+
+def test_malformed_filters_still_fail_loudly(aggregates):
+    with pytest.raises(RestException):
+        utils.getFilteredFiles({"_id": "root"}, [{"a": 1}, "b"])
+    assert aggregates["folder"] == aggregates["item"] == []
+
+
+def test_filter_indexes_lead_with_folder_id(aggregates):
+    utils.ensureDicomFilterIndexes()
+
+    assert sorted(aggregates["indexes"]) == sorted(
+        (name, [("folderId", 1), (field, 1)])
+        for name, field in utils.DICOM_FILTER_INDEXES.items()
+    )
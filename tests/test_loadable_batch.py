@@ -0,0 +1,86 @@
+"""Server-fixture coverage for the batch ``volview/loadable`` route.
+
+Needs a live pytest-girder Mongo; self-skips offline like the other route tests.
+"""
+
+import io
+from conftest import mongo_reachable
+
+import pytest
+
+
+pytestmark = pytest.mark.skipif(
+    not mongo_reachable(),
+    reason="needs a live pytest-girder Mongo (like test_input_resolution_routes); "
+    "unavailable offline",
+)
+
+
+def _upload(user, folder, name):
+    from girder.models.upload import Upload
+
+    return Upload().uploadFromFile(
+        io.BytesIO(b"pixel-bytes"),
+        size=11,
+        name=name,
+        parentType="folder",
+        parent=folder,
+        user=user,
+    )
+
+
+def _folder(user, parent, name):
+    from girder.models.folder import Folder
+
+    return Folder().createFolder(parent, name, creator=user, public=False)
+
+
+@pytest.mark.plugin("volview")
+def test_one_request_answers_every_folder_and_item(server, owner, ownerFolder):
+    images = _folder(owner, ownerFolder, "images")
+    nested = _folder(owner, _folder(owner, ownerFolder, "study"), "series")
+    empty = _folder(owner, ownerFolder, "notes")
+    scan = _upload(owner, nested, "scan.nrrd")
+    note = _upload(owner, empty, "readme.txt")
+    _upload(owner, images, "slice.nii.gz")
+
+    resp = server.request(
+        path="/volview/loadable",
+        method="GET",
+        user=owner,
+        params={
+            "folders": ",".join(str(f["_id"]) for f in (images, empty, ownerFolder)),
+            "items": "%s,%s" % (scan["itemId"], note["itemId"]),
+        },
+    )
+    assert resp.output_status.startswith(b"200")
+    assert resp.json == {
+        "folders": {
+            str(images["_id"]): True,
+            str(empty["_id"]): False,
+            str(ownerFolder["_id"]): True,
+        },
+        "items": {str(scan["itemId"]): True, str(note["itemId"]): False},
+    }
+
+
+@pytest.mark.plugin("volview")
+def test_unreadable_folders_answer_false(server, owner, ownerFolder):
+    images = _folder(owner, ownerFolder, "images")
+    _upload(owner, images, "scan.nrrd")
+
+    resp = server.request(
+        path="/volview/loadable",
+        method="GET",
+        params={"folders": str(images["_id"])},
+    )
+    assert resp.output_status.startswith(b"200")
+    assert resp.json == {"folders": {str(images["_id"]): False}, "items": {}}
+
+
+@pytest.mark.plugin("volview")
+def test_malformed_ids_are_rejected(server, owner):
+    resp = server.request(
+        path="/volview/loadable", method="GET", user=owner, params={"items": "nope"}
+    )
+    assert resp.output_status.startswith(b"400")
@@ -0,0 +1,259 @@
+"""Offline coverage for the maintained loadable counts, over an in-memory Mongo."""
+
+import pytest
+
+from conftest import _Event
+from girder_volview import loadable, utils
+
+mongomock = pytest.importorskip("mongomock")
+
+
+class _Collection:
+    """mongomock's ``bulk_write`` does not take this pymongo's ``UpdateOne``."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def bulk_write(self, requests, ordered=True):
+        for request in requests:
+            self._collection.update_one(
+                request._filter, request._doc, upsert=request._upsert
+            )
+
+
+class _Model:
+    def __init__(self, collection):
+        self.collection = collection
+
+    def find(self, query, fields=None):
+        return self.collection.find(query, list(fields) if fields else None)
+
+    def load(self, id, force=False, fields=None, exc=True):
+        return self.collection.find_one({"_id": id}, list(fields) if fields else None)
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """root > study > series, plus an unrelated "other" folder, all empty."""
+    db = mongomock.MongoClient().db
+    db.folder.insert_many(
+        [
+            {"_id": "root", "parentId": "user", "parentCollection": "user"},
+            {"_id": "study", "parentId": "root", "parentCollection": "folder"},
+            {"_id": "series", "parentId": "study", "parentCollection": "folder"},
+            {"_id": "other", "parentId": "root", "parentCollection": "folder"},
+        ]
+    )
+    for name, collection in (
+        ("Item", db.item),
+        ("Folder", db.folder),
+        ("LoadableCount", _Collection(db.volview_loadable)),
+        ("PendingRecount", _Collection(db.volview_loadable_pending)),
+    ):
+        monkeypatch.setattr(loadable, name, lambda c=collection: _Model(c))
+    monkeypatch.setattr(loadable, "_recountQueue", loadable.RecountQueue(interval=0))
+    return db
+
+
+def _addItem(db, itemId, folderId, **fields):
+    db.item.insert_one(dict({"_id": itemId, "folderId": folderId}, **fields))
+    loadable._handleItemSaved(_Event({"_id": itemId}))
+
+
+def _addFile(db, fileId, itemId, name):
+    file = {"_id": fileId, "itemId": itemId, "name": name}
+    db.file.insert_one(file)
+    loadable._handleFileSaved(_Event(file))
+    return file
+
+
+def _counts(db):
+    return {doc["_id"]: doc["count"] for doc in db.volview_loadable.find()}
+
+
+def test_a_folder_is_counted_once_then_kept_current(db):
+    _addItem(db, "slice", "series")
+    _addFile(db, "f1", "slice", "a.dcm")
+    assert _counts(db) == {"slice": 1}
+
+    assert loadable.folderLoadableCount({"_id": "study"}) == 1
+    _addItem(db, "scan", "study")
+    _addFile(db, "f2", "scan", "b.nrrd")
+    _addFile(db, "f3", "scan", "notes.txt")
+    assert _counts(db)["study"] == 2
+    assert "root" not in _counts(db)
+
+
+def test_removing_a_file_decrements_its_folders(db):
+    _addItem(db, "slice", "series")
+    file = _addFile(db, "f1", "slice", "a.dcm")
+    loadable.folderLoadableCount({"_id": "root"})
+
+    loadable._handleFileRemove(_Event(file))
+    db.file.delete_one({"_id": "f1"})
+    assert _counts(db) == {"slice": 0, "root": 0}
+
+
+def test_first_count_stores_the_items_it_counted(db):
+    # Items from before the plugin tracked them.
+    db.item.insert_many(
+        [{"_id": "old", "folderId": "series"}, {"_id": "bare", "folderId": "study"}]
+    )
+    db.file.insert_one({"_id": "f1", "itemId": "old", "name": "x.nii.gz"})
+
+    assert loadable.folderLoadableCount({"_id": "root"}) == 1
+    assert _counts(db) == {"old": 1, "bare": 0, "root": 1}
+    # Counted from the stored documents afterwards.
+    db.file.delete_one({"_id": "f1"})
+    assert loadable.folderLoadableCount({"_id": "root"}) == 1
+
+
+def test_an_item_move_moves_its_count(db):
+    _addItem(db, "scan", "series")
+    _addFile(db, "f1", "scan", "b.nrrd")
+    loadable.folderLoadableCount({"_id": "study"})
+    loadable.folderLoadableCount({"_id": "other"})
+
+    db.item.update_one({"_id": "scan"}, {"$set": {"folderId": "other"}})
+    loadable._handleItemSaved(_Event({"_id": "scan"}))
+    assert _counts(db) == {"scan": 1, "study": 0, "other": 1}
+
+
+def test_a_folder_move_moves_its_subtree_count(db):
+    _addItem(db, "scan", "series")
+    _addFile(db, "f1", "scan", "b.nrrd")
+    loadable.folderLoadableCount({"_id": "study"})
+    loadable.folderLoadableCount({"_id": "other"})
+
+    moved = {"_id": "series", "parentId": "other", "parentCollection": "folder"}
+    loadable._handleFolderSaving(_Event(moved))
+    db.folder.replace_one({"_id": "series"}, moved)
+    loadable._handleFolderSaved(_Event(moved))
+    counts = _counts(db)
+    assert (counts["study"], counts["other"], counts["series"]) == (0, 1, 1)
+
+
+def test_the_job_output_marker_recounts_the_folders_items(db):
+    _addItem(db, "seg", "series")
+    _addFile(db, "f1", "seg", "seg.nrrd")
+    loadable.folderLoadableCount({"_id": "root"})
+
+    marked = {
+        "_id": "series",
+        "parentId": "study",
+        "parentCollection": "folder",
+        "meta": {utils.JOB_OUTPUT_FOLDER_META_KEY: True},
+    }
+    loadable._handleFolderSaving(_Event(marked))
+    db.folder.replace_one({"_id": "series"}, marked)
+    loadable._handleFolderSaved(_Event(marked))
+    assert _counts(db) == {"seg": 0, "root": 0}
+
+
+def test_a_zero_count_answers_without_a_scan(db, monkeypatch):
+    def scan(folder, user):
+        raise AssertionError("scanned")
+
+    monkeypatch.setattr(loadable, "folderHasLoadableFile", scan)
+    loadable.folderLoadableCount({"_id": "root"})
+    assert loadable.isLoadableFolder({"_id": "root"}, {"admin": False}) is False
+
+
+def test_queued_recounts_are_batched_until_read(db, monkeypatch):
+    queue = loadable.RecountQueue(interval=60)
+    monkeypatch.setattr(loadable, "_recountQueue", queue)
+    monkeypatch.setattr(queue, "_work", lambda: None)
+    counted = []
+    countFiles = loadable._countFiles
+
+    def spy(itemIds, excludeFileIds=()):
+        counted.append(sorted(itemIds))
+        return countFiles(itemIds, excludeFileIds)
+
+    monkeypatch.setattr(loadable, "_countFiles", spy)
+    _addItem(db, "slice", "series")
+    _addFile(db, "f1", "slice", "a.dcm")
+    _addItem(db, "scan", "study")
+    _addFile(db, "f2", "scan", "b.nrrd")
+    assert counted == []
+
+    assert loadable.folderLoadableCount({"_id": "root"}) == 2
+    assert counted == [["scan", "slice"]]
+    assert db.volview_loadable_pending.count_documents({}) == 0
+
+
+def _queued(monkeypatch):
+    queue = loadable.RecountQueue(interval=60)
+    monkeypatch.setattr(loadable, "_recountQueue", queue)
+    monkeypatch.setattr(queue, "_work", lambda: None)
+    return queue
+
+
+def test_recounts_queued_by_another_process_are_drained_by_a_reader(db, monkeypatch):
+    loadable.folderLoadableCount({"_id": "root"})
+    _queued(monkeypatch)
+    _addItem(db, "slice", "series")
+    _addFile(db, "f1", "slice", "a.dcm")
+    # The queuing process exits before its batch runs; another one reads.
+    monkeypatch.setattr(loadable, "_recountQueue", loadable.RecountQueue(interval=60))
+    assert loadable.knownFolderCounts(["root"]) == {"root": 1}
+    assert db.volview_loadable_pending.count_documents({}) == 0
+
+
+def test_a_folder_moved_before_it_was_counted_is_settled_by_the_queue(db, monkeypatch):
+    _addItem(db, "scan", "series")
+    _addFile(db, "f1", "scan", "b.nrrd")
+    loadable.folderLoadableCount({"_id": "study"})
+    loadable.folderLoadableCount({"_id": "other"})
+    _queued(monkeypatch)
+    scanned = []
+    monkeypatch.setattr(
+        loadable,
+        "_subtreeFolderIds",
+        lambda folderId, scan=loadable._subtreeFolderIds: (
+            scanned.append(folderId) or scan(folderId)
+        ),
+    )
+
+    moved = {"_id": "series", "parentId": "other", "parentCollection": "folder"}
+    loadable._handleFolderSaving(_Event(moved))
+    db.folder.replace_one({"_id": "series"}, moved)
+    loadable._handleFolderSaved(_Event(moved))
+    # Nothing under the folder was scanned on the request.
+    assert scanned == []
+    # A file saved before the move settles reaches the new ancestors once.
+    _addItem(db, "seg", "series")
+    _addFile(db, "f2", "seg", "seg.nrrd")
+
+    assert loadable.knownFolderCounts(["study", "other", "series"]) == {
+        "study": 0,
+        "other": 2,
+        "series": 2,
+    }
+    assert scanned == ["series"]
+    assert db.volview_loadable_pending.count_documents({}) == 0
+
+
+def test_a_change_during_the_first_count_is_not_counted_twice(db, monkeypatch):
+    _addItem(db, "slice", "series")
+    countChunk = loadable._countChunk
+    seen = []
+
+    def changing(items):
+        seen.append(db.volview_loadable.find_one({"_id": "root"}))
+        if len(seen) == 1:
+            # Counted by the scan and added to the stored count as well.
+            _addFile(db, "f1", "slice", "a.dcm")
+        return countChunk(items)
+
+    monkeypatch.setattr(loadable, "_countChunk", changing)
+    assert loadable.folderLoadableCount({"_id": "root"}) == 1
+    assert len(seen) == 2
+    assert (seen[0]["count"], seen[0]["kind"]) == (0, "folder")
+    assert "counting" in seen[0]
+    stored = db.volview_loadable.find_one({"_id": "root"})
+    assert stored["count"] == 1
+    assert "counting" not in stored
@@ -0,0 +1,144 @@
+"""Offline parity between the loadability ``$match`` and the Python predicates.
+
+The ``volview_loadable`` routes answer inside Mongo with
+``utils.loadableFileMatch``; the launch manifest filters with
+``isSessionFile`` / ``isLoadableImage``. Both must agree on which files open.
+"""
+
+import itertools
+
+import pytest
+
+from girder_volview import utils
+
+filtering = pytest.importorskip("mongomock.filtering")
+
+
+FILES = [
+    {"name": "scan.nrrd"},
+    {"name": "scan.nii.gz"},
+    {"name": "notes.txt"},
+    {"name": "notes.txt", "mimeType": "application/vnd.unknown.nifti-1"},
+    {"name": "slice", "mimeType": "application/dicom"},
+    {"name": "slice.dcm"},
+    {"name": "slide.tif"},
+    {"name": "slide", "mimeType": "image/tiff"},
+    {"name": "session.volview.zip"},
+    {"name": "session.abc.volview.json"},
+    {"name": "scan.NRRD"},
+    {"name": "archive.zip.bak"},
+]
+ITEMS = [
+    {},
+    {"largeImage": {"fileId": "f"}},
+    {"meta": {"dicom": {"Modality": "SM"}}},
+    {"meta": {"dicom": {"Modality": "CT"}}},
+    {"meta": {utils.TRANSIENT_STAGED_META_KEY: True}},
+    # Falsy markers, which Python's truth tests ignore.
+    {"largeImage": {}},
+    {"largeImage": 0},
+    {"meta": {utils.TRANSIENT_STAGED_META_KEY: []}},
+    {"meta": {utils.TRANSIENT_STAGED_META_KEY: {}}},
+    {"meta": {utils.TRANSIENT_STAGED_META_KEY: ""}},
+    {"meta": {utils.TRANSIENT_STAGED_META_KEY: [0]}},
+]
+FOLDERS = [
+    {},
+    {"meta": {utils.JOB_OUTPUT_FOLDER_META_KEY: True}},
+    {"meta": {utils.JOB_OUTPUT_FOLDER_META_KEY: {}}},
+    {"meta": {utils.JOB_OUTPUT_FOLDER_META_KEY: []}},
+    {"meta": {utils.JOB_OUTPUT_FOLDER_META_KEY: False}},
+]
+
+
+def _pythonAnswer(file, item, folder):
+    file = dict(file, itemId="i")
+    item = dict(item, _id="i", folderId="f")
+    itemCache = {"i": item}
+    folderCache = {"f": folder}
+    return utils.isSessionFile(file) or utils.isLoadableImage(
+        file, None, itemCache, folderCache
+    )
+
+
+@pytest.mark.parametrize(
+    "file,item,folder", list(itertools.product(FILES, ITEMS, FOLDERS))
+)
+def test_match_agrees_with_the_launch_predicates(file, item, folder):
+    subtreeDoc = dict(folder, item=item, file=file)
+    itemDoc = dict(item, folder=folder, file=file)
+    expected = _pythonAnswer(file, item, folder)
+
+    assert filtering.filter_applies(utils.loadableFileMatch(), subtreeDoc) is expected
+    itemMatch = utils.loadableFileMatch(folderPrefix="folder.", itemPrefix="")
+    assert filtering.filter_applies(itemMatch, itemDoc) is expected
+
+
+def test_folder_check_stops_at_the_first_loadable_file(monkeypatch):
+    pipelines = []
+
+    class FolderCollection:
+        def aggregate(self, pipeline):
+            pipelines.append(pipeline)
+            return iter([{"_id": "f"}])
+
+    class Folders:
+        collection = FolderCollection()
+
+        def permissionClauses(self, user, level=None):
+            return {}
+
+    monkeypatch.setattr(utils, "Folder", Folders)
+    assert utils.folderHasLoadableFile({"_id": "root"}, {"admin": True})
+    (pipeline,) = pipelines
+    assert pipeline[-3:-1] == [
+        {"$match": utils.loadableFileMatch()},
+        {"$limit": 1},
+    ]
+
+
+def test_batched_folders_each_stop_at_their_first_loadable_file(monkeypatch):
+    pipelines = []
+
+    class FolderCollection:
+        def aggregate(self, pipeline):
+            pipelines.append(pipeline)
+            return iter([{"_id": "a"}])
+
+    class Folders:
+        collection = FolderCollection()
+
+        def permissionClauses(self, user, level=None, prefix=""):
+            return {prefix + "public": True}
+
+    monkeypatch.setattr(utils, "Folder", Folders)
+    assert utils.loadableFolderIds(["a", "b"]) == {"a"}
+    assert utils.loadableFolderIds([]) == set()
+    (pipeline,) = pipelines
+    assert pipeline[0]["$match"] == {
+        "$and": [{"_id": {"$in": ["a", "b"]}}, {"public": True}]
+    }
+    perRoot = pipeline[1]["$lookup"]["pipeline"]
+    assert perRoot[-3:-1] == [{"$match": utils.loadableFileMatch()}, {"$limit": 1}]
+
+
+def test_batched_items_are_as_readable_as_their_folders(monkeypatch):
+    pipelines = []
+
+    class ItemCollection:
+        def aggregate(self, pipeline):
+            pipelines.append(pipeline)
+            return iter([{"_id": "i"}])
+
+    class Folders:
+        def permissionClauses(self, user, level=None, prefix=""):
+            return {prefix + "public": True} if level is not None else {}
+
+    monkeypatch.setattr(utils, "Folder", Folders)
+    monkeypatch.setattr(
+        utils, "Item", lambda: type("M", (), {"collection": ItemCollection()})()
+    )
+    assert utils.loadableItemIds(["i", "j"]) == {"i"}
+    assert {"$match": {"folder.public": True}} in pipelines[0]
+    assert utils.loadableItemIds(["i"], level=None) == {"i"}
+    assert {"$match": {}} in pipelines[1]
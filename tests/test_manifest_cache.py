@@ -0,0 +1,215 @@
+"""Offline coverage for the launch manifest cache and its invalidation."""
+
+import pytest
+
+from conftest import _Event
+from girder_volview import manifest_cache
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    """A fresh process cache over a stub folder tree: root > study > series."""
+    parents = {"series": "study", "study": "root", "root": None}
+    items = {"slice": {"_id": "slice", "folderId": "series", "baseParentId": "c"}}
+    loads = []
+
+    class Folders:
+        def load(self, folderId, **kwargs):
+            loads.append(folderId)
+            if folderId not in parents:
+                return None
+            parentId = parents[folderId]
+            return {
+                "_id": folderId,
+                "parentId": parentId or "c",
+                "parentCollection": "folder" if parentId else "collection",
+            }
+
+    class Items:
+        def load(self, itemId, **kwargs):
+            return items.get(itemId)
+
+        def find(self, query, **kwargs):
+            return [items[itemId] for itemId in query["_id"]["$in"] if itemId in items]
+
+    monkeypatch.setattr(manifest_cache, "Folder", Folders)
+    monkeypatch.setattr(manifest_cache, "Item", Items)
+    instance = manifest_cache.ManifestCache(maxEntries=2, ttl=60)
+    monkeypatch.setattr(manifest_cache, "_manifestCache", instance)
+    instance.loads = loads
+    instance.items = items
+    return instance
+
+
+def _cached(key, scopes, roots=("c",), value=None):
+    calls = []
+
+    def compute():
+        calls.append(key)
+        return {"resources": [value or key]}
+
+    manifest = manifest_cache.cachedManifest(key, compute, scopes, roots)
+    return manifest, calls
+
+
+def test_repeat_opens_are_served_from_the_cache(cache):
+    first, calls = _cached("root-open", ["root"])
+    again, moreCalls = _cached("root-open", ["root"])
+    assert first == again == {"resources": ["root-open"]}
+    assert calls == ["root-open"] and moreCalls == []
+    status = cache.status()
+    assert (status["hits"], status["misses"], status["hitRate"]) == (1, 1, 0.5)
+
+
+def test_returned_manifests_are_copies(cache):
+    manifest, _ = _cached("root-open", ["root"])
+    manifest["resources"].append("mutated")
+    assert _cached("root-open", ["root"])[0] == {"resources": ["root-open"]}
+
+
+def test_least_recently_used_entry_is_evicted(cache):
+    _cached("a", ["root"])
+    _cached("b", ["root"])
+    _cached("a", ["root"])
+    _cached("c", ["root"])
+    assert _cached("a", ["root"])[1] == []
+    assert _cached("b", ["root"])[1] == ["b"]
+
+
+def test_expired_entries_are_recomputed(cache, monkeypatch):
+    _cached("a", ["root"])
+    now = manifest_cache.time.monotonic()
+    monkeypatch.setattr(manifest_cache.time, "monotonic", lambda: now + 61)
+    assert _cached("a", ["root"])[1] == ["a"]
+    assert cache.status()["expired"] == 1
+
+
+def test_a_change_deep_in_the_tree_drops_its_ancestors_entries(cache):
+    _cached("root-open", ["root"])
+    _cached("other-open", ["elsewhere"])
+    manifest_cache._handleFileChange(_Event({"_id": "f", "itemId": "slice"}))
+    assert _cached("root-open", ["root"])[1] == ["root-open"]
+    assert _cached("other-open", ["elsewhere"])[1] == []
+
+
+def test_ancestry_walks_are_memoized(cache):
+    _cached("root-open", ["root"])
+    for _ in range(3):
+        manifest_cache._handleFileChange(_Event({"_id": "f", "itemId": "slice"}))
+    assert cache.loads == ["series", "study", "root"]
+
+
+def test_changes_in_other_trees_skip_the_walk(cache):
+    _cached("root-open", ["root"])
+    cache.items["slice"]["baseParentId"] = "another-collection"
+    manifest_cache._handleFileChange(_Event({"_id": "f", "itemId": "slice"}))
+    assert cache.loads == []
+    assert _cached("root-open", ["root"])[1] == []
+
+
+def test_checked_picks_are_invalidated_from_any_tree(cache):
+    _cached("picks", ["root", "slice"], roots=None)
+    cache.items["slice"]["baseParentId"] = "another-collection"
+    manifest_cache._handleItemChange(_Event(dict(cache.items["slice"])))
+    assert _cached("picks", ["root", "slice"], roots=None)[1] == ["picks"]
+
+
+def test_bulk_metadata_writes_invalidate_explicitly(cache):
+    _cached("study-filter", ["study"])
+    manifest_cache.invalidateItems(["slice"])
+    assert _cached("study-filter", ["study"])[1] == ["study-filter"]
+
+
+def test_a_manifest_computed_across_a_change_is_not_kept(cache):
+    def compute():
+        # The item changes while the manifest is being built.
+        manifest_cache._handleItemChange(_Event(dict(cache.items["slice"])))
+        return {"resources": ["stale"]}
+
+    manifest_cache.cachedManifest("root-open", compute, ["root"], ["c"])
+    assert cache.status()["entries"] == 0
+    assert _cached("root-open", ["root"])[1] == ["root-open"]
+
+
+def test_acl_fingerprint_separates_users_and_group_sets():
+    key = manifest_cache.manifestKey
+    user = {"_id": "u", "groups": ["g2", "g1"]}
+    reordered = {"_id": "u", "groups": ["g1", "g2"]}
+    fewerGroups = {"_id": "u", "groups": ["g1"]}
+    assert key("folder", "f", user) == key("folder", "f", reordered)
+    assert key("folder", "f", user) != key("folder", "f", fewerGroups)
+    assert key("folder", "f", user) != key("folder", "f", None)
+
+
+def _sharedGenerations(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.volview_manifest_generation
+
+    class Counters:
+        def find(self, query):
+            return collection.find(query)
+
+        def bulk_write(self, requests, ordered=True):
+            for request in requests:
+                collection.update_one(
+                    request._filter, request._doc, upsert=request._upsert
+                )
+
+    monkeypatch.setattr(
+        manifest_cache,
+        "ManifestGeneration",
+        lambda: type("M", (), {"collection": Counters()})(),
+    )
+    return manifest_cache.SharedGenerations()
+
+
+def test_a_change_made_through_another_process_drops_the_entry(cache, monkeypatch):
+    shared = _sharedGenerations(monkeypatch)
+    here = manifest_cache.ManifestCache(maxEntries=2, ttl=60, shared=shared)
+    there = manifest_cache.ManifestCache(maxEntries=2, ttl=60, shared=shared)
+    monkeypatch.setattr(manifest_cache, "_manifestCache", here)
+    _cached("root-open", ["root"])
+    _cached("picks", ["root", "slice"], roots=None)
+    assert _cached("root-open", ["root"])[1] == []
+
+    # The other process has nothing cached, but still counts the change.
+    monkeypatch.setattr(manifest_cache, "_manifestCache", there)
+    cache.items["slice"]["baseParentId"] = "another-collection"
+    manifest_cache._handleItemChange(_Event(dict(cache.items["slice"])))
+
+    monkeypatch.setattr(manifest_cache, "_manifestCache", here)
+    # Entries of other trees are kept; those that may span any tree are not.
+    assert _cached("root-open", ["root"])[1] == []
+    assert _cached("picks", ["root", "slice"], roots=None)[1] == ["picks"]
+    cache.items["slice"]["baseParentId"] = "c"
+    monkeypatch.setattr(manifest_cache, "_manifestCache", there)
+    manifest_cache._handleFileChange(_Event({"_id": "f", "itemId": "slice"}))
+    monkeypatch.setattr(manifest_cache, "_manifestCache", here)
+    assert _cached("root-open", ["root"])[1] == ["root-open"]
+    assert here.status()["invalidated"] == 2
+
+
+def test_the_version_moves_with_changes_and_ttl_windows(cache, monkeypatch):
+    assert manifest_cache.manifestVersion("k", ["c"]) is None
+
+    shared = _sharedGenerations(monkeypatch)
+    monkeypatch.setattr(
+        manifest_cache,
+        "_manifestCache",
+        manifest_cache.ManifestCache(maxEntries=2, ttl=60, shared=shared),
+    )
+    now = [600.0]
+    monkeypatch.setattr(manifest_cache.time, "time", lambda: now[0])
+    version = manifest_cache.manifestVersion("k", ["c"])
+    assert version == manifest_cache.manifestVersion("k", ["c"])
+    assert version != manifest_cache.manifestVersion("other", ["c"])
+
+    # A change elsewhere leaves it; one in its tree moves it.
+    manifest_cache.manifestCache().changed(["another-collection"])
+    assert manifest_cache.manifestVersion("k", ["c"]) == version
+    manifest_cache.manifestCache().changed(["c"])
+    moved = manifest_cache.manifestVersion("k", ["c"])
+    assert moved != version
+
+    now[0] += 60
+    assert manifest_cache.manifestVersion("k", ["c"]) != moved
@@ -0,0 +1,170 @@
+"""The cursor-paginated bare folder-open manifest."""
+
+import pytest
+
+from conftest import _uploadFile, mongo_reachable
+from girder.exceptions import RestException
+from girder.models.folder import Folder
+from girder_volview import utils
+from girder_volview.backend import launch
+
+mongomock = pytest.importorskip("mongomock")
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """root > (sub, hidden), with items in each; "hidden" is not readable."""
+    db = mongomock.MongoClient().db
+    db.folder.insert_many(
+        [
+            {"_id": "root", "name": "root", "parentCollection": "user"},
+            {
+                "_id": "sub",
+                "name": "sub",
+                "parentId": "root",
+                "parentCollection": "folder",
+                "public": True,
+            },
+            {
+                "_id": "hidden",
+                "name": "hidden",
+                "parentId": "root",
+                "parentCollection": "folder",
+            },
+        ]
+    )
+    db.item.insert_many(
+        [
+            {"_id": "i1", "name": "a", "folderId": "root"},
+            {"_id": "i2", "name": "b", "folderId": "sub"},
+            {"_id": "i3", "name": "c", "folderId": "hidden"},
+            {"_id": "i4", "name": "d", "folderId": "root"},
+        ]
+    )
+    db.file.insert_many(
+        [
+            {"_id": "f2", "itemId": "i1", "name": "a2.dcm"},
+            {"_id": "f1", "itemId": "i1", "name": "a1.dcm"},
+            {"_id": "f3", "itemId": "i2", "name": "b.nrrd"},
+        ]
+    )
+
+    class Folders:
+        collection = db.folder
+
+        def permissionClauses(self, user, level=None):
+            return {"public": True}
+
+    monkeypatch.setattr(utils, "Folder", Folders)
+    monkeypatch.setattr(utils, "Item", lambda: type("M", (), {"collection": db.item})())
+    return db
+
+
+def test_items_are_paged_in_id_order(db):
+    first = utils.subtreeItemPage(["root", "sub"], limit=2)
+    assert [item["_id"] for item in first] == ["i1", "i2"]
+    assert [file["_id"] for file in first[0]["files"]] == ["f1", "f2"]
+    second = utils.subtreeItemPage(["root", "sub"], after="i2", limit=2)
+    assert [(item["_id"], item["files"]) for item in second] == [("i4", [])]
+
+
+def test_folders_are_walked_depth_first_past_unreadable_ones(db):
+    db.folder.insert_many(
+        [
+            {
+                "_id": "deep",
+                "name": "deep",
+                "parentId": "sub",
+                "parentCollection": "folder",
+                "public": True,
+            },
+            {
+                "_id": "under",
+                "name": "under",
+                "parentId": "hidden",
+                "parentCollection": "folder",
+                "public": True,
+            },
+            {
+                "_id": "tail",
+                "name": "tail",
+                "parentId": "root",
+                "parentCollection": "folder",
+                "public": True,
+            },
+        ]
+    )
+    root = {"_id": "root"}
+    walk = []
+    folder = root
+    while folder is not None:
+        folder = utils.nextSubtreeFolder(root, folder)
+        walk.append(folder and folder["_id"])
+    assert walk == ["sub", "deep", "tail", None]
+
+    assert utils.subtreeFolder(root, "deep")["_id"] == "deep"
+    assert utils.subtreeFolder(root, "root") is root
+    # Not readable, or reached only through a folder that is not.
+    assert utils.subtreeFolder(root, "hidden") is None
+    assert utils.subtreeFolder(root, "under") is None
+
+
+def test_cursor_round_trips_and_rejects_garbage():
+    from bson.objectid import ObjectId
+
+    folderId, itemId = ObjectId(), ObjectId()
+    cursor = launch._encodeManifestCursor(folderId, itemId)
+    assert "=" not in cursor
+    assert launch._decodeManifestCursor(cursor) == (folderId, itemId)
+    cursor = launch._encodeManifestCursor(folderId)
+    assert launch._decodeManifestCursor(cursor) == (folderId, None)
+    for garbage in ("!!", "e30", launch._encodeManifestCursor("nope")):
+        with pytest.raises(RestException):
+            launch._decodeManifestCursor(garbage)
+
+
+@pytest.mark.parametrize("limit", [0, launch.MANIFEST_PAGE_MAX + 1, "x"])
+def test_page_size_is_bounded(limit):
+    with pytest.raises(RestException):
+        launch._manifestPageSize(limit)
+    assert launch._manifestPageSize(None) == launch.MANIFEST_PAGE_DEFAULT
+
+
+@pytest.mark.skipif(
+    not mongo_reachable(),
+    reason="needs a live pytest-girder Mongo; unavailable offline",
+)
+@pytest.mark.plugin("volview")
+def test_paged_manifest_holds_the_whole_manifest(server, owner, ownerFolder):
+    for index in range(5):
+        _uploadFile(ownerFolder, owner, "scan%d.nrrd" % index)
+    _uploadFile(ownerFolder, owner, "notes.txt")
+    sub = Folder().createFolder(ownerFolder, "sub", creator=owner)
+    for index in range(2):
+        _uploadFile(sub, owner, "sub%d.nrrd" % index)
+
+    whole = server.request(
+        path="/folder/%s/volview" % ownerFolder["_id"], user=owner, isJson=True
+    )
+    resources = []
+    params = {"limit": 2}
+    pages = 0
+    while True:
+        page = server.request(
+            path="/folder/%s/volview_page" % ownerFolder["_id"],
+            user=owner,
+            params=params,
+            isJson=True,
+        )
+        assert page.status == 200
+        resources.extend(page.json["resources"])
+        pages += 1
+        if page.json["nextCursor"] is None:
+            break
+        params = {"limit": 2, "cursor": page.json["nextCursor"]}
+
+    # Three full pages of the folder, then one of "sub" as the walk reaches it,
+    # then an empty one that ends the walk.
+    assert pages == 5
+    key = lambda resource: resource["url"]  # noqa: E731
+    assert sorted(resources, key=key) == sorted(whole.json["resources"], key=key)
@@ -0,0 +1,150 @@
+"""Offline coverage for the streamed bare folder-open manifest."""
+
+import json
+
+import pytest
+
+from girder_volview import utils
+from girder_volview.backend import launch
+
+pytestmark = pytest.mark.usefixtures("_fixed_api_root")
+
+ROOT = {"_id": "root", "name": "root"}
+JOB = {
+    "_id": "job",
+    "name": "job",
+    "parentId": "root",
+    "meta": {utils.JOB_OUTPUT_FOLDER_META_KEY: True},
+}
+
+
+def _entry(fileId, name, itemId="i"):
+    return None, {"_id": fileId, "name": name, "itemId": itemId}
+
+
+def _joined(stream):
+    return json.loads(b"".join(stream()))
+
+
+@pytest.mark.parametrize("count", [0, 1, 2000])
+def test_streamed_chunks_join_to_the_manifest(count):
+    files = [_entry("f%d" % index, "slice%05d.dcm" % index) for index in range(count)]
+    stream = utils.streamManifest(iter(files), "root")
+    assert _joined(stream) == utils.filesToManifest(files, "root")
+
+
+def test_rows_are_yielded_as_the_cursor_returns_them(monkeypatch):
+    rows = [
+        dict(ROOT, item={"_id": "i2"}, file={"_id": "f2"}),
+        dict(ROOT, item={"_id": "i1"}),
+        dict(JOB, item={"_id": "i3"}, file={"_id": "f3"}),
+    ]
+
+    class FolderCollection:
+        def aggregate(self, pipeline):
+            return iter(rows)
+
+    class Folders:
+        collection = FolderCollection()
+
+        def permissionClauses(self, user, level=None):
+            return {}
+
+    monkeypatch.setattr(utils, "Folder", Folders)
+    assert [
+        (file["_id"], item["_id"], folder["_id"])
+        for file, item, folder in utils.subtreeFileRows(ROOT)
+    ] == [("f2", "i2", "root"), ("f3", "i3", "job")]
+
+
+@pytest.fixture
+def streamed(monkeypatch):
+    rows = [
+        (
+            {"_id": "f1", "name": "b.nrrd", "itemId": "i1"},
+            {"_id": "i1", "name": "b.nrrd", "folderId": "root"},
+            ROOT,
+        ),
+        (
+            {"_id": "f2", "name": "seg.nrrd", "itemId": "i2"},
+            {"_id": "i2", "name": "seg", "folderId": "job"},
+            JOB,
+        ),
+        (
+            {"_id": "f3", "name": "notes.txt", "itemId": "i3"},
+            {"_id": "i3", "name": "notes", "folderId": "root"},
+            ROOT,
+        ),
+        (
+            {"_id": "f4", "name": "a.dcm", "itemId": "i4"},
+            {
+                "_id": "i4",
+                "name": "a",
+                "folderId": "root",
+                "meta": {utils.TRANSIENT_STAGED_META_KEY: True},
+            },
+            ROOT,
+        ),
+    ]
+    monkeypatch.setattr(launch, "folderSessionFile", lambda folder: None)
+    monkeypatch.setattr(launch, "subtreeFileRows", lambda folder, user: iter(rows))
+    return rows
+
+
+def test_streamed_folder_open_lists_the_loadable_images(streamed):
+    stream = launch._streamedFolderManifest(ROOT, None)
+    assert _joined(stream) == utils.filesToManifest([(None, streamed[0][0])], "root")
+
+
+def test_streamed_folder_open_resumes_the_newest_session(streamed, monkeypatch):
+    session = _entry("s1", "session.volview.zip")
+    monkeypatch.setattr(launch, "folderSessionFile", lambda folder: session)
+    stream = launch._streamedFolderManifest(ROOT, None)
+    assert _joined(stream) == utils.filesToManifest([session], "root")
+
+
+@pytest.mark.parametrize(
+    "settings,count,expected",
+    [
+        ({}, None, False),
+        ({}, 9999, False),
+        ({}, 10000, True),
+        ({"manifest_stream_threshold": 10}, 10, True),
+        ({"manifest_stream_threshold": 0}, 10**6, False),
+    ],
+)
+def test_only_folders_counted_past_the_threshold_stream(
+    monkeypatch, settings, count, expected
+):
+    monkeypatch.setattr(launch, "getConfig", lambda: {"volview": settings})
+    counts = {} if count is None else {"root": count}
+    monkeypatch.setattr(launch, "knownFolderCounts", lambda folderIds: counts)
+    assert launch._streamsManifest(ROOT) is expected
+
+
+def test_folder_session_is_found_among_direct_session_items(monkeypatch):
+    older = {"_id": "s1", "name": "session.volview.zip", "itemId": "a", "created": 1}
+    newer = {"_id": "s2", "name": "session.volview.zip", "itemId": "b", "created": 2}
+    queries = []
+
+    class Items:
+        def find(self, query, fields=None):
+            queries.append(query)
+            if "meta.linkedResources.filter" in query:
+                return iter([])
+            return iter(
+                [
+                    {"_id": "a", "name": "session.volview.zip"},
+                    {"_id": "b", "name": "session.volview.zip (1)"},
+                ]
+            )
+
+        def fileList(self, item, subpath=True, data=True):
+            if item["_id"] == "a":
+                return iter([("session.volview.zip", older)])
+            return iter([("session.volview.zip (1)/session.volview.zip", newer)])
+
+    monkeypatch.setattr(utils, "Item", Items)
+    path, file = utils.folderSessionFile(ROOT)
+    assert file is newer
+    assert queries[0]["folderId"] == "root"
@@ -0,0 +1,218 @@
+"""Offline coverage for series bundles: the streamed stored zip and its manifest."""
+
+import io
+import zipfile
+
+import pytest
+from bson.objectid import ObjectId
+
+from girder.exceptions import RestException
+from girder_volview import bundle, utils
+
+CONTENTS = {
+    "a": b"slice one " * 50,
+    "b": b"",
+    "c": bytes(range(256)) * 3,
+    "d": "naïve/slice".encode("utf8"),
+}
+
+
+@pytest.fixture
+def stored():
+    """file id -> the CRC a bundle stored on it."""
+    return {}
+
+
+@pytest.fixture
+def files(monkeypatch, stored):
+    reads = []
+
+    class Collection:
+        def update_one(self, query, update):
+            stored[query["_id"]] = update["$set"][bundle.CRC_FIELD]
+
+    class Files:
+        collection = Collection()
+
+        def download(self, file, offset=0, endByte=None, headers=True):
+            data = CONTENTS[file["_id"]][offset:endByte]
+            reads.append(file["_id"])
+
+            def stream():
+                if not data:
+                    # As an S3 assetstore sends a file of no bytes.
+                    yield ""
+                # Small chunks, so reads are cut across chunk boundaries.
+                for start in range(0, len(data), 7):
+                    yield data[start : start + 7]
+
+            return stream
+
+    monkeypatch.setattr(bundle, "File", Files)
+    monkeypatch.setattr(bundle, "cacheKey", lambda file: "sha512:%s" % file["_id"])
+    docs = [
+        {"_id": key, "name": "slice-%s.dcm" % key, "size": len(value)}
+        for key, value in CONTENTS.items()
+    ]
+    docs[-1]["name"] = "naïve/slice.dcm"
+    return docs, reads
+
+
+def _bytes(archive, offset=0, endByte=None):
+    return b"".join(archive.stream(offset, endByte)())
+
+
+def test_archive_is_a_valid_stored_zip_of_its_size(files):
+    docs, _ = files
+    archive = bundle.StoredZip(docs)
+    data = _bytes(archive)
+    assert len(data) == archive.size
+
+    with zipfile.ZipFile(io.BytesIO(data)) as zipped:
+        assert zipped.testzip() is None
+        assert zipped.namelist() == [
+            "00001_slice-a.dcm",
+            "00002_slice-b.dcm",
+            "00003_slice-c.dcm",
+            "00004_naïve_slice.dcm",
+        ]
+        assert all(
+            info.compress_type == zipfile.ZIP_STORED for info in zipped.infolist()
+        )
+        assert zipped.read("00003_slice-c.dcm") == CONTENTS["c"]
+
+
+@pytest.mark.parametrize(
+    "offset,endByte", [(0, 10), (5, 700), (600, None), (40, 41), (0, None)]
+)
+def test_ranges_are_slices_of_the_whole_archive(files, offset, endByte):
+    docs, _ = files
+    whole = _bytes(bundle.StoredZip(docs))
+    stop = len(whole) if endByte is None else endByte
+    assert _bytes(bundle.StoredZip(docs), offset, endByte) == whole[offset:stop]
+
+
+def test_a_range_inside_one_member_reads_only_that_member(files):
+    docs, reads = files
+    archive = bundle.StoredZip(docs)
+    start = archive.offsets[2] + 100
+    _bytes(archive, start, start + 10)
+    assert reads == ["c"]
+
+
+def test_crcs_are_stored_and_read_back(files, stored):
+    docs, reads = files
+    whole = _bytes(bundle.StoredZip(docs))
+    assert set(stored) == set(CONTENTS)
+    del reads[:]
+
+    for doc in docs:
+        doc[bundle.CRC_FIELD] = stored[doc["_id"]]
+    archive = bundle.StoredZip(docs)
+    # The central directory, with no member read again.
+    assert _bytes(archive, archive.centralOffset) == whole[archive.centralOffset :]
+    assert reads == []
+
+    # A CRC stored for other contents is not trusted.
+    docs[0][bundle.CRC_FIELD] = dict(stored["a"], key="sha512:old")
+    _bytes(bundle.StoredZip(docs), archive.centralOffset)
+    assert reads == ["a"]
+
+
+def test_oversized_bundles_are_refused(monkeypatch, files):
+    docs, _ = files
+    monkeypatch.setattr(bundle, "ZIP_MAX_MEMBERS", 3)
+    with pytest.raises(RestException):
+        bundle.StoredZip(docs)
+    with pytest.raises(RestException):
+        bundle.StoredZip([{"_id": "x", "name": "huge", "size": 2**32}])
+    # A central directory at 0xFFFFFFFF would read as the ZIP64 sentinel.
+    name = "00001_x"
+    size = bundle.ZIP_MAX_BYTES - 30 - len(name) - 16
+    with pytest.raises(RestException):
+        bundle.StoredZip([{"_id": "x", "name": "x", "size": size}])
+    assert bundle.StoredZip([{"_id": "x", "name": "x", "size": size - 1}])
+
+
+def test_whole_series_are_replaced_by_their_bundle(monkeypatch, _fixed_api_root):
+    monkeypatch.setattr(utils, "getApiRoot", lambda: "api/v1")
+    monkeypatch.setattr(bundle, "getApiRoot", lambda: "api/v1")
+    folderId = ObjectId()
+    ct = [ObjectId() for _ in range(3)]
+    mr = [ObjectId() for _ in range(2)]
+    other = ObjectId()
+    series = {
+        **{fileId: "1.2.ct" for fileId in ct},
+        **{fileId: "1.2.mr" for fileId in mr},
+    }
+    monkeypatch.setattr(
+        bundle,
+        "fileSeries",
+        lambda fileIds: {
+            str(fileId): (folderId, series[fileId])
+            for fileId in fileIds
+            if fileId in series
+        },
+    )
+    # The MR series has a third slice the manifest does not list.
+    inFolder = {"1.2.ct": ct, "1.2.mr": mr + [ObjectId()]}
+    monkeypatch.setattr(
+        bundle,
+        "seriesFiles",
+        lambda folder, uid: [
+            {"_id": fileId, "name": "x", "size": 1} for fileId in inFolder[uid]
+        ],
+    )
+    listed = [mr[0], ct[0], other, ct[1], mr[1], ct[2]]
+    manifest = utils.filesToManifest(
+        [(None, {"_id": fileId, "name": "s.dcm"}) for fileId in listed], folderId
+    )
+
+    bundled = bundle.bundledManifest(manifest)["resources"]
+    assert [resource["name"] for resource in bundled] == [
+        "s.dcm",
+        "1.2.ct.zip",
+        "s.dcm",
+        "s.dcm",
+        "config.json",
+    ]
+    assert bundled[1]["url"] == (
+        "/api/v1/folder/%s/volview_bundle/1.2.ct.zip?series=1.2.ct" % folderId
+    )
+    assert bundled[2] == manifest["resources"][2]
+
+
+@pytest.fixture
+def exchange(monkeypatch):
+    """A fresh cherrypy request and response for the range helpers."""
+    import cherrypy
+
+    monkeypatch.setattr(
+        cherrypy.serving, "request", cherrypy._cprequest.Request(*[None] * 4)
+    )
+    monkeypatch.setattr(cherrypy.serving, "response", cherrypy._cprequest.Response())
+    return cherrypy.serving.request, cherrypy.serving.response
+
+
+@pytest.mark.parametrize(
+    "header,span,status,contentRange",
+    [
+        # Left for cherrypy to default to 200.
+        (None, (0, 100), None, None),
+        ("bytes=10-19", (10, 20), 206, "bytes 10-19/100"),
+        ("bytes=90-", (90, 100), 206, "bytes 90-99/100"),
+        ("bytes=200-300", None, 416, "bytes */100"),
+    ],
+)
+def test_range_responses_share_one_helper(exchange, header, span, status, contentRange):
+    import girder_volview
+
+    request, response = exchange
+    if header is not None:
+        request.headers["Range"] = header
+    assert girder_volview._rangeResponse(100, "1.2.ct.zip", "application/zip") == span
+    assert response.status == status
+    assert response.headers.get("Content-Range") == contentRange
+    if span is not None:
+        assert response.headers["Content-Length"] == str(span[1] - span[0])
+        assert response.headers["Content-Type"] == "application/zip"
@@ -0,0 +1,109 @@
+"""Offline coverage for the single-aggregation folder file listing."""
+
+import pytest
+
+from girder_volview import utils
+
+
+def _row(folder, item=None, file=None):
+    doc = dict(folder)
+    if item is not None:
+        doc["item"] = item
+    if file is not None:
+        doc["file"] = file
+    return doc
+
+
+ROOT = {"_id": "0-root", "name": "root"}
+SUB = {"_id": "1-sub", "name": "sub", "parentId": "0-root"}
+EMPTY = {"_id": "2-empty", "name": "empty", "parentId": "0-root"}
+DEEP = {"_id": "3-deep", "name": "deep", "parentId": "2-empty"}
+JOB = {
+    "_id": "4-job",
+    "name": "job",
+    "parentId": "0-root",
+    "meta": {utils.JOB_OUTPUT_FOLDER_META_KEY: True},
+}
+
+
+def _item(itemId, name, folderId, **fields):
+    return dict({"_id": itemId, "name": name, "folderId": folderId}, **fields)
+
+
+def _file(fileId, name, itemId):
+    return {"_id": fileId, "name": name, "itemId": itemId}
+
+
+@pytest.fixture
+def subtree(monkeypatch):
+    """A stub folder collection answering the aggregation in arbitrary order."""
+    calls = []
+    rows = [
+        _row(DEEP, _item("i5", "ct", "3-deep"), _file("f7", "a.dcm", "i5")),
+        _row(ROOT, _item("i2", "b.nrrd", "0-root"), _file("f2", "b.nrrd", "i2")),
+        _row(SUB, _item("i3", "mr", "1-sub"), _file("f4", "y.nii", "i3")),
+        _row(ROOT, _item("i1", "scans", "0-root"), _file("f1", "x.nrrd", "i1")),
+        _row(EMPTY),
+        _row(SUB, _item("i3", "mr", "1-sub"), _file("f3", "x.nii", "i3")),
+        _row(ROOT, _item("i4", "no-files", "0-root")),
+        _row(JOB, _item("i6", "seg", "4-job"), _file("f8", "seg.nrrd", "i6")),
+    ]
+
+    class FolderCollection:
+        def aggregate(self, pipeline):
+            calls.append(pipeline)
+            return iter([dict(row) for row in rows])
+
+    class Folders:
+        collection = FolderCollection()
+
+        def permissionClauses(self, user, level=None):
+            return {"public": True} if user is None else {}
+
+    class Unqueried:
+        def __init__(self):
+            raise AssertionError("the listing already cached this")
+
+    monkeypatch.setattr(utils, "Folder", Folders)
+    monkeypatch.setattr(utils, "Item", Unqueried)
+    return calls
+
+
+def test_entries_match_file_list_paths_and_order(subtree):
+    entries = utils.subtreeFileEntries(ROOT)
+    assert [(path, file["_id"]) for path, file in entries] == [
+        ("sub/mr/x.nii", "f3"),
+        ("sub/mr/y.nii", "f4"),
+        ("empty/deep/ct/a.dcm", "f7"),
+        ("job/seg/seg.nrrd", "f8"),
+        ("scans/x.nrrd", "f1"),
+        ("b.nrrd", "f2"),
+    ]
+
+
+def test_subfolder_walk_is_restricted_to_readable_folders(subtree):
+    utils.subtreeFileEntries(ROOT)
+    (pipeline,) = subtree
+    (lookup,) = [stage["$graphLookup"] for stage in pipeline if "$graphLookup" in stage]
+    assert lookup["restrictSearchWithMatch"] == {
+        "$and": [{"parentCollection": "folder"}, {"public": True}]
+    }
+
+
+def test_listing_fills_the_launch_predicate_caches(subtree):
+    itemCache, folderCache = {}, {}
+    entries = utils.subtreeFileEntries(ROOT, {"_id": "u"}, itemCache, folderCache)
+    assert set(itemCache) == {"i1", "i2", "i3", "i4", "i5", "i6"}
+    assert set(folderCache) == {"0-root", "1-sub", "2-empty", "3-deep", "4-job"}
+
+    # The predicates then run from the caches alone (``Item`` would raise).
+    files = utils.singleVolViewZipOrImageFiles(
+        entries, {"_id": "u"}, itemCache=itemCache, folderCache=folderCache
+    )
+    assert [file["_id"] for _, file in files] == ["f3", "f4", "f7", "f1", "f2"]
+
+
+def test_checked_folders_share_the_listing(subtree):
+    assert [path for path, _ in utils.getFiles(utils.Folder, [None, ROOT])][-1] == (
+        "b.nrrd"
+    )
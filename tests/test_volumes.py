@@ -0,0 +1,454 @@
+"""Server-side volumes: assembling DICOM slices and listing converted series."""
+
+import datetime
+
+import numpy as np
+import pytest
+from bson.objectid import ObjectId
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian
+
+from girder_volview import utils, volumes
+
+
+def _slice(z, pixels, slope=None, intercept=None, orientation=(1, 0, 0, 0, 1, 0)):
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    pixels = np.asarray(pixels, dtype=np.uint16)
+    ds.Rows, ds.Columns = pixels.shape
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 0
+    ds.PixelSpacing = [0.5, 0.25]
+    ds.ImageOrientationPatient = list(orientation)
+    ds.ImagePositionPatient = [10.0, 20.0, z]
+    if slope is not None:
+        ds.RescaleSlope = slope
+    if intercept is not None:
+        ds.RescaleIntercept = intercept
+    ds.PixelData = pixels.tobytes()
+    return ds
+
+
+def test_slices_are_stacked_along_the_normal():
+    datasets = [_slice(z, np.full((2, 3), z)) for z in (4.0, 0.0, 2.0)]
+    voxels, origin, directions = volumes.assembleVolume(datasets)
+
+    assert voxels.shape == (3, 2, 3)
+    assert voxels.dtype == np.uint16
+    assert [int(plane[0, 0]) for plane in voxels] == [0, 2, 4]
+    assert list(origin) == [10.0, 20.0, 0.0]
+    assert [list(direction) for direction in directions] == [
+        [0.25, 0.0, 0.0],
+        [0.0, 0.5, 0.0],
+        [0.0, 0.0, 2.0],
+    ]
+
+
+def test_integral_rescale_picks_the_narrowest_signed_type():
+    datasets = [_slice(z, [[0, 3000]], slope=1, intercept=-1024) for z in (0, 1)]
+    voxels, _, _ = volumes.assembleVolume(datasets)
+    assert voxels.dtype == np.int16
+    assert voxels[0].tolist() == [[-1024, 1976]]
+
+
+def test_fractional_rescale_is_float():
+    datasets = [_slice(z, [[2, 4]], slope=0.5, intercept=0) for z in (0, 1)]
+    voxels, _, _ = volumes.assembleVolume(datasets)
+    assert voxels.dtype == np.float32
+    assert voxels[1].tolist() == [[1.0, 2.0]]
+
+
+def test_mixed_geometry_is_refused():
+    datasets = [_slice(0, [[1]]), _slice(1, [[1]], orientation=(0, 1, 0, 1, 0, 0))]
+    with pytest.raises(volumes.VolumeConversionError):
+        volumes.assembleVolume(datasets)
+    with pytest.raises(volumes.VolumeConversionError):
+        volumes.assembleVolume([_slice(0, [[1]]), _slice(1, [[1, 2]])])
+
+
+@pytest.mark.parametrize(
+    "positions",
+    [
+        # Two phases at each location.
+        (0.0, 0.0, 5.0, 5.0),
+        # A skipped stretch.
+        (0.0, 1.0, 10.0),
+    ],
+)
+def test_repeated_or_uneven_positions_are_refused(positions):
+    datasets = [_slice(z, [[1]]) for z in positions]
+    with pytest.raises(volumes.VolumeConversionError):
+        volumes.assembleVolume(datasets)
+
+
+def test_position_jitter_within_tolerance_is_stacked():
+    datasets = [_slice(z, [[1]]) for z in (0.0, 2.001, 4.0, 5.999)]
+    _, _, directions = volumes.assembleVolume(datasets)
+    assert abs(directions[2][2] - 1.999667) < 1e-6
+
+
+def test_nrrd_header_describes_the_raw_voxels():
+    voxels = np.arange(24, dtype=np.int16).reshape(2, 3, 4)
+    data = volumes.nrrdBytes(voxels, (1, 2, 3), ((1, 0, 0), (0, 1, 0), (0, 0, 2)))
+    header, raw = data.split(b"\n\n", 1)
+    lines = header.decode("ascii").split("\n")
+    assert lines[0] == "NRRD0004"
+    assert "type: int16" in lines
+    assert "sizes: 4 3 2" in lines
+    assert "space origin: (1.0,2.0,3.0)" in lines
+    assert np.frombuffer(raw, "<i2").tolist() == list(range(24))
+
+
+def test_nrrd_is_read_in_chunks_without_building_it_whole():
+    voxels = np.arange(24, dtype=np.float64).reshape(2, 3, 4)
+    volume = (voxels, (1, 2, 3), ((1, 0, 0), (0, 1, 0), (0, 0, 2)))
+    reader = volumes._NrrdReader(*volume)
+    chunks = iter(lambda: reader.read(7), b"")
+    data = b"".join(chunks)
+    assert data == volumes.nrrdBytes(*volume)
+    assert len(data) == reader.size
+    assert "type: double" in data.split(b"\n\n", 1)[0].decode("ascii")
+
+    with pytest.raises(volumes.VolumeConversionError):
+        volumes.nrrdHeader(voxels.astype(np.complex64), *volume[1:])
+
+
+def test_slices_are_read_once_each_in_order():
+    slices = [_slice(z, np.full((2, 3), z)) for z in (2.0, 0.0, 1.0)]
+    reads = []
+
+    class Lazy:
+        def __len__(self):
+            return len(slices)
+
+        def __getitem__(self, index):
+            reads.append(index)
+            return slices[index]
+
+    voxels, _, _ = volumes.assembleVolume(Lazy())
+    assert reads == [0, 1, 2]
+    assert [int(plane[0, 0]) for plane in voxels] == [0, 1, 2]
+
+
+def test_previews_are_strided_reads_of_the_volume():
+    voxels = np.arange(300 * 40 * 10, dtype=np.int32).reshape(300, 40, 10)
+    directions = (np.array([0.5, 0, 0]), np.array([0, 0.5, 0]), np.array([0, 0, 1]))
+    preview, origin, steps = volumes.previewVolume(voxels, (1, 2, 3), directions, 16)
+
+    assert preview.shape == (16, 14, 10)
+    assert preview.flags["C_CONTIGUOUS"]
+    assert (preview == voxels[::19, ::3, ::1]).all()
+    assert origin == (1, 2, 3)
+    assert [list(step) for step in steps] == [[0.5, 0, 0], [0, 1.5, 0], [0, 0, 19]]
+    assert volumes.previewVolume(voxels, origin, directions, 300) is None
+    assert volumes.previewVolume(voxels, origin, directions, 0) is None
+
+
+def test_volume_key_needs_every_content_key(monkeypatch):
+    monkeypatch.setattr(volumes, "cacheKey", lambda file: file.get("sha512"))
+    files = [{"sha512": "a"}, {"sha512": "b"}]
+    assert volumes.volumeKey(files) == volumes.volumeKey(files[::-1])
+    assert volumes.volumeKey(files + [{}]) is None
+    assert volumes.volumeKey([]) is None
+
+
+@pytest.fixture
+def converted(monkeypatch, _fixed_api_root):
+    """A manifest of two whole series, only the first of them converted."""
+    monkeypatch.setattr(utils, "getApiRoot", lambda: "api/v1")
+    monkeypatch.setattr(volumes, "getApiRoot", lambda: "api/v1")
+    monkeypatch.setattr(volumes, "isEnabled", lambda: True)
+    monkeypatch.setattr(volumes, "volumeKey", lambda files: "key-%d" % len(files))
+    folderId = ObjectId()
+    ct = [ObjectId() for _ in range(3)]
+    mr = [ObjectId() for _ in range(2)]
+    monkeypatch.setattr(
+        volumes,
+        "wholeSeries",
+        lambda resources: iter(
+            [
+                ((folderId, "1.2.ct"), [0, 2, 3], ct),
+                ((folderId, "1.2.mr"), [1, 4], mr),
+            ]
+        ),
+    )
+
+    class Cache:
+        mr = None
+
+        def record(self, folder, uid):
+            if uid != "1.2.ct":
+                return self.mr
+            return {
+                "key": "key-3",
+                "fileId": ObjectId(),
+                "previewKey": "key-3",
+                "previewFileId": ObjectId(),
+            }
+
+    monkeypatch.setattr(volumes, "VolumeCache", Cache)
+    queued = []
+    monkeypatch.setattr(volumes, "requestConversion", lambda *args: queued.append(args))
+    monkeypatch.setattr(volumes, "_mayConvert", lambda folderId, user: user != "reader")
+    listed = [ct[0], mr[0], ct[1], ct[2], mr[1]]
+    manifest = utils.filesToManifest(
+        [(None, {"_id": fileId, "name": "s.dcm"}) for fileId in listed], folderId
+    )
+    return folderId, manifest, queued, Cache
+
+
+def test_converted_series_are_listed_as_their_volume(converted):
+    folderId, manifest, queued, _ = converted
+    resources = volumes.withVolumes(manifest, "writer")["resources"]
+    assert [resource["name"] for resource in resources] == [
+        "1.2.ct.nrrd",
+        "s.dcm",
+        "s.dcm",
+        "config.json",
+    ]
+    assert resources[0]["url"] == (
+        "/api/v1/folder/%s/volview_volume/1.2.ct.nrrd?series=1.2.ct" % folderId
+    )
+    assert queued == [(folderId, "1.2.mr", "key-2")]
+
+
+def test_only_a_user_who_may_write_the_folder_queues_a_conversion(converted):
+    _, manifest, queued, _ = converted
+    resources = volumes.withVolumes(manifest, "reader")["resources"]
+    # Volumes already built are still listed for readers.
+    assert resources[0]["name"] == "1.2.ct.nrrd"
+    assert queued == []
+
+
+def test_conversion_is_off_by_default(converted, monkeypatch):
+    _, manifest, queued, _ = converted
+    monkeypatch.setattr(volumes, "isEnabled", lambda: False)
+    assert volumes.withVolumes(manifest, "writer") is manifest
+    assert queued == []
+
+
+def test_a_preview_is_listed_until_its_volume_is(converted):
+    folderId, manifest, queued, cache = converted
+    cache.mr = {"pendingKey": "key-2", "previewKey": "key-2", "previewFileId": 1}
+    resources = volumes.withVolumes(manifest, "writer")["resources"]
+    # The converted series is listed as its volume alone; the other keeps its
+    # slices, with its preview just ahead of them.
+    assert [resource["name"] for resource in resources] == [
+        "1.2.ct.nrrd",
+        "1.2.mr.preview.nrrd",
+        "s.dcm",
+        "s.dcm",
+        "config.json",
+    ]
+    assert resources[1]["url"] == (
+        "/api/v1/folder/%s/volview_volume/1.2.mr.preview.nrrd"
+        "?series=1.2.mr&preview=true" % folderId
+    )
+    assert resources[1]["preview"] is True
+    assert "preview" not in resources[0]
+    assert queued == [(folderId, "1.2.mr", "key-2")]
+    # A preview of older contents is not listed.
+    cache.mr = {"previewKey": "key-1", "previewFileId": 1}
+    resources = volumes.withVolumes(manifest, "writer")["resources"]
+    assert "1.2.mr.preview.nrrd" not in [resource["name"] for resource in resources]
+
+
+@pytest.fixture
+def conversion(monkeypatch):
+    """A series ready to convert, with its record and uploads captured."""
+    folderId = ObjectId()
+    files = [{"_id": ObjectId(), "size": 10} for _ in range(3)]
+    monkeypatch.setattr(volumes, "seriesFiles", lambda folder, uid: files)
+    monkeypatch.setattr(volumes, "volumeKey", lambda files: "key")
+    monkeypatch.setattr(volumes, "_settings", lambda: {})
+    monkeypatch.setattr(
+        volumes,
+        "Folder",
+        lambda: type("M", (), {"load": lambda self, id, **kwargs: {"_id": id}})(),
+    )
+    records = []
+    monkeypatch.setattr(
+        volumes, "_record", lambda *args, **kwargs: records.append((args, kwargs))
+    )
+    removed = []
+    monkeypatch.setattr(
+        volumes,
+        "File",
+        lambda: type("M", (), {"remove": lambda self, file: removed.append(file)})(),
+    )
+    monkeypatch.setattr(volumes, "_release", lambda *args: None)
+    volume = (np.zeros((300, 2, 2), np.int16), (0, 0, 0), np.eye(3))
+    monkeypatch.setattr(volumes, "assembleVolume", lambda datasets: volume)
+    return folderId, records, removed
+
+
+@pytest.mark.parametrize("error", [MemoryError(), KeyError("float64"), OSError()])
+def test_every_conversion_failure_is_recorded(conversion, monkeypatch, error):
+    folderId, records, _ = conversion
+
+    def assemble(datasets):
+        raise error
+
+    monkeypatch.setattr(volumes, "assembleVolume", assemble)
+    volumes.convertSeries(folderId, "1.2.ct", "key")
+    ((args, kwargs),) = records
+    assert args == (folderId, "1.2.ct", "key")
+    assert kwargs["error"].startswith(type(error).__name__)
+
+
+def test_the_preview_is_recorded_before_the_volume_is_read(conversion, monkeypatch):
+    folderId, records, removed = conversion
+    files = [{"_id": ObjectId(), "size": 10} for _ in range(300)]
+    monkeypatch.setattr(volumes, "seriesFiles", lambda folder, uid: files)
+    monkeypatch.setattr(volumes, "_settings", lambda: {"volume_preview_size": 128})
+    monkeypatch.setattr(volumes.manifest_cache, "invalidateFolders", lambda ids: None)
+    steps = []
+
+    def assemble(datasets):
+        steps.append(("read", len(datasets)))
+        return (np.zeros((len(datasets), 2, 2), np.int16), (0, 0, 0), np.eye(3))
+
+    def upload(folder, name, volume):
+        steps.append(("upload", name, volume[0].shape[0]))
+        return {"_id": name}
+
+    def recordPreview(folderId, uid, key, fileId):
+        steps.append(("record", fileId))
+        return True
+
+    monkeypatch.setattr(volumes, "assembleVolume", assemble)
+    monkeypatch.setattr(volumes, "_upload", upload)
+    monkeypatch.setattr(volumes, "_recordPreview", recordPreview)
+    volumes.convertSeries(folderId, "1.2.ct", "key")
+    assert steps == [
+        ("read", 100),
+        ("upload", "1.2.ct.preview.nrrd", 100),
+        ("record", "1.2.ct.preview.nrrd"),
+        ("read", 300),
+        ("upload", "1.2.ct.nrrd", 300),
+    ]
+    ((args, kwargs),) = records
+    assert kwargs["fileId"] == "1.2.ct.nrrd"
+    assert kwargs["previewFileId"] == "1.2.ct.preview.nrrd"
+    assert removed == []
+
+
+def test_a_short_series_preview_is_cut_from_its_volume(conversion, monkeypatch):
+    folderId, records, removed = conversion
+    monkeypatch.setattr(volumes, "_settings", lambda: {"volume_preview_size": 128})
+    monkeypatch.setattr(volumes.manifest_cache, "invalidateFolders", lambda ids: None)
+    uploads = []
+
+    def upload(folder, name, volume):
+        if uploads:
+            raise OSError("assetstore full")
+        uploads.append({"_id": ObjectId(), "name": name})
+        return uploads[-1]
+
+    monkeypatch.setattr(volumes, "_upload", upload)
+    monkeypatch.setattr(volumes, "_recordPreview", lambda *args: True)
+    volumes.convertSeries(folderId, "1.2.ct", "key")
+    assert [upload["name"] for upload in uploads] == ["1.2.ct.preview.nrrd"]
+    # The recorded preview goes with the record of the failure.
+    assert removed == []
+    assert records[0][1]["error"] == "OSError: assetstore full"
+
+
+def test_previews_are_kept_with_their_volume_and_need_the_claim(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.volview_volume
+    monkeypatch.setattr(
+        volumes, "VolumeCache", lambda: type("M", (), {"collection": collection})()
+    )
+    removed = []
+
+    class Files:
+        def load(self, id, **kwargs):
+            return id
+
+        def remove(self, file):
+            removed.append(file)
+
+    monkeypatch.setattr(volumes, "File", Files)
+    folderId = ObjectId()
+    assert not volumes._recordPreview(folderId, "1.2.ct", "a", "p0")
+    collection.insert_one(
+        {"folderId": folderId, "seriesInstanceUID": "1.2.ct", "pendingKey": "a"}
+    )
+    assert volumes._recordPreview(folderId, "1.2.ct", "a", "p1")
+    assert volumes._recordPreview(folderId, "1.2.ct", "a", "p2")
+    assert removed == ["p1"]
+    volumes._record(folderId, "1.2.ct", "a", fileId="v", previewFileId="p2")
+    assert removed == ["p1"]
+    doc = collection.find_one()
+    assert (doc["previewKey"], doc["previewFileId"], doc["fileId"]) == ("a", "p2", "v")
+    volumes._record(folderId, "1.2.ct", "b", error="changed")
+    assert removed == ["p1", "v", "p2"]
+
+
+def test_a_series_is_scheduled_once_until_recorded(monkeypatch):
+    mongomock = pytest.importorskip("mongomock")
+    collection = mongomock.MongoClient().db.volview_volume
+    collection.create_index([("folderId", 1), ("seriesInstanceUID", 1)], unique=True)
+    monkeypatch.setattr(
+        volumes, "VolumeCache", lambda: type("M", (), {"collection": collection})()
+    )
+    scheduled = []
+
+    class Jobs:
+        def createLocalJob(self, **kwargs):
+            return kwargs["otherFields"]
+
+        def updateJob(self, job, status=None):
+            return job
+
+    class Conversions:
+        def full(self):
+            return False
+
+        def submit(self, job):
+            scheduled.append(job[volumes._STATE_FIELD]["key"])
+            return True
+
+    monkeypatch.setattr(volumes, "Job", Jobs)
+    monkeypatch.setattr(volumes, "conversionQueue", Conversions)
+    folderId = ObjectId()
+    volumes.requestConversion(folderId, "1.2.ct", "a")
+    volumes.requestConversion(folderId, "1.2.ct", "a")
+    assert scheduled == ["a"]
+    # New contents are scheduled in their own right.
+    volumes.requestConversion(folderId, "1.2.ct", "b")
+    assert scheduled == ["a", "b"]
+    # A claim whose job died lapses.
+    collection.update_one({}, {"$set": {"pendingSince": datetime.datetime(2000, 1, 1)}})
+    volumes.requestConversion(folderId, "1.2.ct", "b")
+    assert scheduled == ["a", "b", "b"]
+
+
+def test_conversions_run_on_their_own_bounded_queue(monkeypatch):
+    import threading
+
+    release = threading.Event()
+    ran = []
+
+    def fakeRun(job):
+        release.wait(5)
+        ran.append((job, threading.current_thread().name))
+
+    monkeypatch.setattr(volumes, "run", fakeRun)
+    conversions = volumes.ConversionQueue(workers=1, maxsize=1)
+    assert conversions.submit("a")
+    # Wait until the worker holds "a", leaving the one queue slot free.
+    while conversions._queue.qsize():
+        threading.Event().wait(0.01)
+    assert conversions.submit("b")
+    assert conversions.full()
+    assert not conversions.submit("c")
+    release.set()
+    conversions.join()
+    assert ran == [("a", "volview-volume-0"), ("b", "volview-volume-0")]